@@ -1,22 +1,39 @@
 from typing import Optional, List, Mapping, Any, Dict
 from abc import ABC, abstractmethod
 import os
+import time
 import shutil
 import logging
 import json
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from llama_index.core.ingestion import IngestionPipeline
-from format_converter import documentfile2document
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.schema import BaseNode, MetadataMode
+from format_converter import documentfile2document, write_node_file, EMBEDDING_SIDECAR_SUFFIX
+from manifest import Manifest
+from embedding_cache import EmbeddingCache, embed_texts
 
 class BaseIngestion(ABC):
     show_progress = False
+    # reruns only rechunk new or changed files, see Manifest
+    incremental = True
 
     def __init__(self, config, inp_folder):
+        self.config = config
         self.input_file_formats = ["document", "node"]
         self.output_file_format = "node"
         self.file_exclude = config.get("file_exclude", [])
         self.num_workers = config.get("num_workers", 1)
+        self.embed_batch_size = config.get("embed_batch_size", 64)
+        self.embed_buffer_size = config.get("embed_buffer_size", 8192)
+        self.embedding_dtype = config.get("embedding_dtype", "float32")
+        self.embed_cache_path = config.get("embed_cache_path", None)
+        self.embed_cache_max_entries = config.get("embed_cache_max_entries", None)
         self.pipeline = self.load_pipeline()
+        self.embed_model = self.load_embed_model()
+        self.embed_cache = None
+        if self.embed_model is not None and self.embed_cache_path:
+            self.embed_cache = EmbeddingCache(self.embed_cache_path, self.embed_model.model_name, self.embed_cache_max_entries)
 
     @abstractmethod
     def load_pipeline(self) -> IngestionPipeline:
@@ -25,37 +42,88 @@ class BaseIngestion(ABC):
         """
         pass
 
-    def process_file(self, input_file, input_folder, output_folder):
+    def load_embed_model(self) -> Optional[BaseEmbedding]:
+        """
+        Embedding model applied to the nodes of all files in shared batches after the
+        pipeline ran. None if the pipeline embeds the nodes itself.
+        """
+        return None
+
+    def output_file_path(self, input_file, output_folder):
+        return os.path.join(output_folder, '.'.join(input_file.split('.')[:-1]) + f'.{self.output_file_format}')
+
+    def process_file(self, input_file, input_folder, output_folder, manifest):
+        """
+        Run the pipeline on one file. Returns the result type, the file path and, when the
+        nodes still have to be embedded, the nodes; otherwise they are written right away.
+        """
         suffix = input_file.split('.')[-1]
         file_path = os.path.join(input_folder, input_file)
-        
+
         if input_file in self.file_exclude:
             logging.info(f"Skipping {file_path} as it is in the exclude list")
-            return "exclude", file_path
-        
+            return "exclude", file_path, None
+
         if suffix not in self.input_file_formats:
             logging.info(f"Skipping {file_path} as it is not supported")
-            return "unsupported", file_path
-        
-        output_file_path = os.path.join(output_folder, '.'.join(input_file.split('.')[:-1]) + f'.{self.output_file_format}')
-        
-        if not os.path.exists(output_file_path):
+            return "unsupported", file_path, None
+
+        output_file_path = self.output_file_path(input_file, output_folder)
+
+        if not manifest.is_unchanged(input_file, file_path, output_file_path):
             logging.info(f"Parsing {file_path}")
-            
+
             try:
                 documents = documentfile2document(file_path)
                 # print(documents)
                 nodes = self.pipeline.run(documents=documents, show_progress=self.show_progress)
-                nodes_json = [node.to_dict() for node in nodes]
-                with open(output_file_path, 'w') as json_file:
-                    json.dump(nodes_json, json_file, indent=2, ensure_ascii=False)
+                if self.embed_model is not None:
+                    return "processed", file_path, nodes
+                self.write_nodes(nodes, input_file, file_path, output_file_path, manifest)
             except Exception as e:
                 logging.error(f"Failed to parse {file_path}: {e}")
-                return "failed", file_path
+                manifest.forget(input_file)
+                return "failed", file_path, None
         else:
             logging.info(f"Skipping {file_path} as it is already parsed")
-            
-        return "processed", file_path
+
+        return "processed", file_path, None
+
+    def write_nodes(self, nodes, input_file, file_path, output_file_path, manifest):
+        write_node_file(output_file_path, nodes, embedding_dtype=self.embedding_dtype)
+        manifest.record(input_file, file_path, output_file_path)
+
+    def embed_nodes(self, nodes: List[BaseNode]):
+        """
+        Embed nodes from many files at once, see embed_texts.
+        """
+        nodes = [node for node in nodes if node.embedding is None]
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        embeddings = embed_texts(self.embed_model, texts, batch_size=self.embed_batch_size, cache=self.embed_cache)
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+        return len(nodes)
+
+    def embed_and_write(self, pending, output_folder, manifest, results):
+        """
+        Embed the nodes of the pending files together and scatter them back to their files.
+        """
+        start = time.time()
+        try:
+            embedded = self.embed_nodes([node for _, _, nodes in pending for node in nodes])
+        except Exception as e:
+            logging.error(f"Failed to embed the nodes of {len(pending)} files: {e}")
+            for input_file, file_path, _ in pending:
+                manifest.forget(input_file)
+                results["failed"].append(file_path)
+            return 0, 0
+        elapsed = time.time() - start
+        for input_file, file_path, nodes in pending:
+            self.write_nodes(nodes, input_file, file_path, self.output_file_path(input_file, output_folder), manifest)
+            results["processed"].append(file_path)
+        if embedded:
+            logging.info(f"Embedded {embedded} chunks from {len(pending)} files in {elapsed:.1f}s ({embedded / max(elapsed, 1e-6):.1f} chunks/s)")
+        return embedded, elapsed
 
     def process(self, input_folder: str, output_folder: str):
         files = os.listdir(input_folder)
@@ -65,23 +133,50 @@ class BaseIngestion(ABC):
             "exclude": [],
             "failed": []
         }
-        
+
+        manifest = Manifest(output_folder, self.config, "chunk", sidecar_suffixes=[EMBEDDING_SIDECAR_SUFFIX])
+        pending = []
+        pending_nodes = 0
+        embedded, embed_time = 0, 0.0
         with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
-            future_to_file = {executor.submit(self.process_file, file, input_folder, output_folder): file for file in files}
-            
+            future_to_file = {executor.submit(self.process_file, file, input_folder, output_folder, manifest): file for file in files}
+
+            current_names = set()
             for future in as_completed(future_to_file):
-                result_type, file = future.result()
-                results[result_type].append(file)
-        
+                result_type, file, nodes = future.result()
+                input_file = future_to_file[future]
+                if result_type in ("processed", "failed"):
+                    current_names.add(input_file)
+                if nodes is None:
+                    results[result_type].append(file)
+                    continue
+                pending.append((input_file, file, nodes))
+                pending_nodes += len(nodes)
+                if pending_nodes >= self.embed_buffer_size:
+                    count, elapsed = self.embed_and_write(pending, output_folder, manifest, results)
+                    embedded, embed_time = embedded + count, embed_time + elapsed
+                    pending, pending_nodes = [], 0
+        if pending:
+            count, elapsed = self.embed_and_write(pending, output_folder, manifest, results)
+            embedded, embed_time = embedded + count, embed_time + elapsed
+        manifest.remove_deleted(current_names)
+        manifest.save()
+
         # 使用结果集 results 中的信息进行日志记录等后续操作
         logging.info(f"Processed {len(results['processed'])} files")
         logging.info(f"Files skipped as they are not supported: {results['unsupported']}")
         logging.info(f"Files skipped as they are in the exclude list: {results['exclude']}")
         logging.info(f"Files failed: {results['failed']}")
+        if self.embed_cache is not None:
+            logging.info(f"Embedding cache: {self.embed_cache.stats()}")
 
         with open(os.path.join(output_folder, 'log.txt'), 'w') as f:
             f.write(f"Processed {len(results['processed'])} files\n")
             f.write(f"Files skipped as they are not supported: {results['unsupported']}\n")
             f.write(f"Files skipped as they are in the exclude list: {results['exclude']}\n")
             f.write(f"Files failed: {results['failed']}\n")
+            if embedded:
+                f.write(f"Embedded {embedded} chunks in {embed_time:.1f}s ({embedded / max(embed_time, 1e-6):.1f} chunks/s)\n")
+            if self.embed_cache is not None:
+                f.write(f"Embedding cache: {self.embed_cache.stats()}\n")
         return output_folder
@@ -1,3 +1,4 @@
+import copy
 import requests
 import json
 
@@ -10,10 +11,11 @@ from llama_index.embeddings.dashscope import (
     DashScopeTextEmbeddingType,
 )
 from llama_index.core.extractors import TitleExtractor
-from ingestion.baseIngestion import BaseIngestion
-from format_converter import documentfile2document, idpfile2document, text2document
+from chunk.baseIngestion import BaseIngestion
+from format_converter import documentfile2document, text2document
 from llama_index.core.embeddings import BaseEmbedding
 from llama_index.core.bridge.pydantic import Field
+from utils import load_embed_model
 
 
 
@@ -27,7 +29,7 @@ class LiChunk(BaseIngestion):
 
     def load_pipeline(self) -> IngestionPipeline:
         """
-        build ingestion pipeline
+        build ingestion pipeline, embedding is done across files by load_embed_model
         """
         splitter = SentenceSplitter(
             include_metadata=True, include_prev_next_rel=True,
@@ -35,18 +37,21 @@ class LiChunk(BaseIngestion):
             chunk_overlap=self.overlap_size,
             separator=' ',       
             paragraph_separator='\n\n\n', secondary_chunking_regex='[^,.;。？！]+[,.;。？！]?')
+        pipeline = IngestionPipeline(
+            transformations=[
+                splitter
+            ]
+        )
+        return pipeline
+
+    def load_embed_model(self) -> BaseEmbedding:
         if self.embed_model_name == 'online':
             embed_model = DashScopeEmbedding(
                 model_name=DashScopeTextEmbeddingModels.TEXT_EMBEDDING_V2,
                 text_type=DashScopeTextEmbeddingType.TEXT_TYPE_DOCUMENT,
             )
         else:
-            embed_model = HuggingFaceEmbedding(model_name=self.embed_model_name)
-
-        pipeline = IngestionPipeline(
-            transformations=[
-                splitter,
-                embed_model
-            ]
-        )
-        return pipeline
+            # the model weights are shared by the process, embed_batch_size is set per stage
+            embed_model = copy.copy(load_embed_model(self.embed_model_name))
+            embed_model.embed_batch_size = self.embed_batch_size
+        return embed_model
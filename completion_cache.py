@@ -0,0 +1,148 @@
+import time
+import json
+import random
+import hashlib
+import threading
+import contextvars
+import email.utils
+from datetime import datetime, timezone
+
+import requests
+
+from sqlite_cache import SQLiteCache
+
+DEFAULT_CACHE_PATH = 'cache/llm_completions.sqlite'
+
+# set by a caller retrying after it rejected a completion: lookups miss, so the request is sent
+# again and its answer replaces the cached one. Context-local, i.e. per thread and per asyncio task.
+refresh_completions = contextvars.ContextVar("refresh_completions", default=False)
+
+
+def retryable(status):
+    """
+    Whether an attempt that ended with status is worth sending again: throttled (429), a server
+    error (5xx) or no response at all (0).
+    """
+    return status == 0 or status == 429 or status >= 500
+
+
+def parse_retry_after(value):
+    """
+    Seconds a Retry-After header asks to wait, given as seconds or as an HTTP date; None when
+    absent or malformed.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt, retry_after=None, base=0.5, cap=30.0):
+    """
+    Seconds to wait before retrying after attempt (0 for the first): the server's Retry-After
+    when it sent one, else jittered exponential backoff. The retry policy of every llm client.
+    """
+    if retry_after is not None:
+        return retry_after
+    return min(cap, base * 2 ** attempt) * (0.5 + random.random())
+
+
+def parse_response(res):
+    """
+    (text, token usage or None) of a chat completion, from an OpenAI-compatible response or one
+    wrapped by our gateway ({"data": {"response": ...}}).
+    """
+    if "data" in res and isinstance(res["data"], dict):
+        res = res["data"]["response"]
+    return res["choices"][0]["message"]["content"], res.get("usage")
+
+
+def estimate_usage(payload, text):
+    """
+    Token usage of a completion whose response carried none, about four characters per token.
+    """
+    prompt_chars = sum(len(message["content"]) for message in payload["messages"])
+    return {"prompt_tokens": prompt_chars // 4, "completion_tokens": len(text) // 4}
+
+
+class CompletionCache:
+    """
+    On-disk chat completions keyed by the request payload: model, sampling parameters and the
+    exact messages. Entries keep the token usage of the request, so hits count the prompt and
+    completion tokens not paid again and, with prices per 1k tokens, their cost.
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=None, ttl=None, prompt_price=0.0, completion_price=0.0):
+        self.store = SQLiteCache(path, "completions", max_entries=max_entries, ttl=ttl)
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        self.saved_prompt_tokens = 0
+        self.saved_completion_tokens = 0
+        self.lock = threading.Lock()
+
+    def key(self, payload):
+        payload = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, payload):
+        """
+        Cached completion text of the request payload, None on a miss or under refresh_completions.
+        """
+        if refresh_completions.get():
+            return None
+        value = self.store.get(self.key(payload))
+        if value is None:
+            return None
+        entry = json.loads(value)
+        with self.lock:
+            self.saved_prompt_tokens += entry["usage"].get("prompt_tokens", 0)
+            self.saved_completion_tokens += entry["usage"].get("completion_tokens", 0)
+        return entry["text"]
+
+    def put(self, payload, text, usage=None):
+        if text is None:
+            return
+        entry = {"text": text, "usage": usage or estimate_usage(payload, text)}
+        self.store.put(self.key(payload), json.dumps(entry, ensure_ascii=False).encode('utf-8'))
+
+    def cost_saved(self):
+        return (self.saved_prompt_tokens * self.prompt_price + self.saved_completion_tokens * self.completion_price) / 1000
+
+    def stats(self):
+        return (f"{self.store.stats()}, saved {self.saved_prompt_tokens} prompt and {self.saved_completion_tokens} "
+                f"completion tokens (${self.cost_saved():.2f})")
+
+
+def chat_completion(session, url, headers, payload, cache=None, timeout=60, max_retries=3):
+    """
+    Completion text of a chat request sent with a requests session, served from the cache when
+    it holds the payload. Retryable statuses and connection errors are sent again up to
+    max_retries times after backoff_delay, other error statuses raise requests.HTTPError.
+    """
+    text = cache.get(payload) if cache is not None else None
+    if text is not None:
+        return text
+    for attempt in range(max_retries + 1):
+        try:
+            response = session.post(url, headers=headers, json=payload, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == max_retries:
+                raise
+            time.sleep(backoff_delay(attempt))
+            continue
+        if not retryable(response.status_code) or attempt == max_retries:
+            response.raise_for_status()
+            break
+        time.sleep(backoff_delay(attempt, parse_retry_after(response.headers.get("retry-after"))))
+    text, usage = parse_response(response.json())
+    if cache is not None:
+        cache.put(payload, text, usage)
+    return text
@@ -1,9 +1,16 @@
+import os
+import sys
 import requests
 import json
 import time
 import re
- 
+
+# run as python ./data_generation/<script>.py, the repo root holds the shared completion cache
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from completion_cache import CompletionCache, chat_completion, DEFAULT_CACHE_PATH
+
 url = 'https://api.openai.com/v1/chat/completions'
+api_key = os.environ.get('OPENAI_API_KEY', 'YOUR_API_KEY')
 headers = {
             'Authorization': f'Bearer {api_key}',
             'Content-Type': 'application/json',
@@ -12,6 +19,8 @@ headers = {
 def main():
   f = open('./datasets/gen_query.json', 'r')
   fw = open('./datasets/gen_keyword.json', 'w')
+  session = requests.Session()
+  cache = CompletionCache(DEFAULT_CACHE_PATH)
 
   for line in f:
       line = json.loads(line)
@@ -91,9 +100,7 @@ def main():
                   "messages": [{"role": "user", "content": content}]
                 }
         try:
-            response = requests.post(url, headers=headers, json=data)
-            res = json.loads(response.text)
-            ans = res['data']['response']['choices'][0]['message']['content']
+            ans = chat_completion(session, url, headers, data, cache=cache)
             matches = re.findall(r"\{.*?\}", ans.replace('\n', ''))
             answer_dict = eval(matches[0])  
             line['fine_keywords'] = answer_dict['fine_keywords']
@@ -101,6 +108,7 @@ def main():
             fw.write(json.dumps(line, ensure_ascii=False)+'\n')
         except Exception as e:
             print(f"{e}")
-    
+  print(f"Completion cache: {cache.stats()}")
+
 if __name__ == '__main__':
   main()
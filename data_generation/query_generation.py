@@ -1,11 +1,17 @@
 import os
+import sys
 import requests
 import json
 import time
 import re
 import tiktoken
 
+# run as python ./data_generation/<script>.py, the repo root holds the shared completion cache
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from completion_cache import CompletionCache, chat_completion, DEFAULT_CACHE_PATH
+
 url = 'https://api.openai.com/v1/chat/completions'
+api_key = os.environ.get('OPENAI_API_KEY', 'YOUR_API_KEY')
 headers = {
             'Authorization': f'Bearer {api_key}',
             'Content-Type': 'application/json',
@@ -37,6 +43,8 @@ def split_paragraph(paragraph, max_length=1200):
 def main():
     fw = open('./datasets/gen_query.json', 'w')
     dir_path = './datasets/docdata/offline_parse_li_native_pdf'
+    session = requests.Session()
+    cache = CompletionCache(DEFAULT_CACHE_PATH)
 
     for path in os.listdir(dir_path):
         if not path.endswith('.pdf.document'):
@@ -100,15 +108,14 @@ def main():
                     }
          
             try:
-                response = requests.post(url, headers=headers, json=data)
-                res = json.loads(response.text)
-                ans = res['data']['response']['choices'][0]['message']['content']
+                ans = chat_completion(session, url, headers, data, cache=cache)
                 matches = re.findall(r"\{.*?\}", ans.replace('\n', ''))
                 answer_dict = eval(matches[0])  
                 line['query_dict'] = answer_dict
                 fw.write(json.dumps(line, ensure_ascii=False)+'\n')
             except Exception as e:
                 print(f"{e}")
-        
+    print(f"Completion cache: {cache.stats()}")
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,66 @@
+import re
+import hashlib
+import unicodedata
+from array import array
+
+from sqlite_cache import SQLiteCache
+
+
+def normalize_text(text):
+    """
+    Whitespace runs do not change the tokens an embedding model sees, so texts that
+    only differ in whitespace share one cache entry.
+    """
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFC', text)).strip()
+
+
+class EmbeddingCache:
+    """
+    On-disk embeddings keyed by (embedding model name, normalized text hash), stored as float32.
+    """
+    def __init__(self, path, model_name, max_entries=None):
+        self.model_name = model_name
+        self.store = SQLiteCache(path, "embeddings", max_entries=max_entries)
+
+    def key(self, text):
+        payload = f"{self.model_name}\0{normalize_text(text)}"
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_many(self, texts):
+        """
+        Return {index in texts: embedding} for the cached texts.
+        """
+        keys = [self.key(text) for text in texts]
+        found = self.store.get_many(keys)
+        embeddings = {}
+        for idx, key in enumerate(keys):
+            if key in found:
+                vector = array('f')
+                vector.frombytes(found[key])
+                embeddings[idx] = vector.tolist()
+        return embeddings
+
+    def put_many(self, texts, embeddings):
+        self.store.put_many({self.key(text): array('f', embedding).tobytes() for text, embedding in zip(texts, embeddings)})
+
+    def stats(self):
+        return self.store.stats()
+
+
+def embed_texts(embed_model, texts, batch_size=64, cache=None):
+    """
+    Embed texts with embed_model, serving what the cache holds and embedding the rest
+    sorted by length so each batch holds texts of similar length and little padding.
+    """
+    embeddings = cache.get_many(texts) if cache is not None else {}
+    missing = [idx for idx in range(len(texts)) if idx not in embeddings]
+    missing.sort(key=lambda idx: len(texts[idx]))
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        batch_texts = [texts[idx] for idx in batch]
+        batch_embeddings = embed_model.get_text_embedding_batch(batch_texts)
+        if cache is not None:
+            cache.put_many(batch_texts, batch_embeddings)
+        for idx, embedding in zip(batch, batch_embeddings):
+            embeddings[idx] = embedding
+    return [embeddings[idx] for idx in range(len(texts))]
@@ -3,12 +3,15 @@ from abc import ABC, abstractmethod
 import os
 import logging
 import json
+import asyncio
 from tqdm import tqdm
 import concurrent.futures
 from llama_index.core.evaluation.base import BaseEvaluator, EvaluationResult
 from llama_index.core.base.response.schema import Response
 from llama_index.core.schema import NodeWithScore, TextNode
-from utils import set_llm
+from utils import set_llm, run_async, log_llm_stats
+from llms.asyncClient import gather_bounded
+from completion_cache import refresh_completions
 
 
 class BaseEvaluator(ABC):
@@ -17,6 +20,13 @@ class BaseEvaluator(ABC):
         self.base_llm = config["base_llm"]
         self.thread_num = config.get("thread_num", 1)
         self.search_eval_results = config.get("search_eval_results", "")
+        # examples go through the async llm client instead of threads, its adaptive concurrency
+        # and rpm/tpm limits (llm_config) decide how many requests are in flight
+        self.async_mode = config.get("async_mode", False)
+        self.async_window = config.get("async_window", 256)
+        self.llm_config = config.get("llm_config", {})
+        # attempts after an evaluator raised, e.g. on a judge output it cannot parse
+        self.eval_retries = config.get("eval_retries", 3)
 
     @property
     @abstractmethod
@@ -35,7 +45,17 @@ class BaseEvaluator(ABC):
         rag_dataset = json.load(open(os.path.join(input_folder, "predictions.json")))
 
         response_list = []
-        if self.thread_num > 1:
+        if self.async_mode:
+            eval_results = run_async(gather_bounded(self.aprocess_example, tqdm(rag_dataset['examples']), self.async_window))
+            for example, rsps in zip(rag_dataset['examples'], eval_results):
+                reference_answer = example.get("reference_answer", "")
+                del example["reference_answer"]
+                example["reference_answer"] = reference_answer
+                example["eval_result"] = rsps
+                if "recall_results" in example:
+                    del example["recall_results"]
+                response_list.append(example)
+        elif self.thread_num > 1:
             with concurrent.futures.ThreadPoolExecutor(max_workers=self.thread_num) as executor:
                 task = []
                 for example in rag_dataset['examples']:
@@ -65,6 +85,7 @@ class BaseEvaluator(ABC):
                     del example["recall_results"]
                 response_list.append(example)
 
+        log_llm_stats()
         statistic = self.do_statistic(response_list)
 
         if self.search_eval_results:
@@ -84,26 +105,58 @@ class BaseEvaluator(ABC):
                 f.write(f"{key},{value:.4f}\n")
         return output_folder
 
-    def process_example(self, example: Dict[str, Any]) -> Dict[str, Any]:
-        ers = {}
-        query = example["query"]
+    def prediction(self, example: Dict[str, Any]) -> Response:
         source_nodes = []
         for node in example["predictions"]["source_nodes"]:
             source_nodes.append(NodeWithScore(node=TextNode.from_dict(node["node"]), score=node["score"]))
-        response = Response(example["predictions"]["response"], source_nodes, example["predictions"]["metadata"])
+        return Response(example["predictions"]["response"], source_nodes, example["predictions"]["metadata"])
+
+    def failed_result(self, query, response, error):
+        return EvaluationResult(query=query, response=response.response, invalid_result=True,
+                                invalid_reason=f"failed after {self.eval_retries + 1} attempts: {error}")
+
+    def process_example(self, example: Dict[str, Any]) -> Dict[str, Any]:
+        ers = {}
+        query = example["query"]
+        response = self.prediction(example)
 
         for evaluator in self.evaluators:
-            while True:
+            for attempt in range(self.eval_retries + 1):
+                # a retry must not be answered with the cached judge output that just failed
+                token = refresh_completions.set(attempt > 0)
                 try:
-                    # print(evaluator, query, response)
                     er = evaluator.evaluate_response(query, response, reference=example.get("reference_answer", ""))
                     break
                 except Exception as e:
                     logging.error(f"Error in evaluating {evaluator.__class__.__name__} for example {query}: {e}")
-                    continue
+                    er = self.failed_result(query, response, e)
+                finally:
+                    refresh_completions.reset(token)
             ers[evaluator.__class__.__name__] = json.loads(er.json())
         return ers
 
+    async def aprocess_example(self, example: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        process_example with the evaluators of the example run concurrently.
+        """
+        query = example["query"]
+        response = self.prediction(example)
+
+        async def evaluate(evaluator):
+            # runs as its own task, so refresh_completions only applies to this evaluator
+            for attempt in range(self.eval_retries + 1):
+                refresh_completions.set(attempt > 0)
+                try:
+                    return await evaluator.aevaluate_response(query, response, reference=example.get("reference_answer", ""))
+                except Exception as e:
+                    logging.error(f"Error in evaluating {evaluator.__class__.__name__} for example {query}: {e}")
+                    error = e
+            return self.failed_result(query, response, error)
+
+        evaluators = self.evaluators
+        ers = await asyncio.gather(*[evaluate(evaluator) for evaluator in evaluators])
+        return {evaluator.__class__.__name__: json.loads(er.json()) for evaluator, er in zip(evaluators, ers)}
+
     def do_statistic(self, response_list: List[Dict[str, Any]]) -> Dict[str, Any]:
         """
         Do statistic on the evaluation results.
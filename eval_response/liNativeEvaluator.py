@@ -7,17 +7,22 @@ from llama_index.core.evaluation import (
 )
 
 from eval_response.baseEvaluator import BaseEvaluator
-from utils import set_mit_llm
+from utils import set_llm
 
 class LiNativeEvaluator(BaseEvaluator):
+    def __init__(self, config, inp_folder):
+        super(LiNativeEvaluator, self).__init__(config, inp_folder)
+        set_llm(self.base_llm, **self.llm_config)
+        # built once, so every example shares the llm and its connection pool
+        self._evaluators = [
+            FaithfulnessEvaluator(),
+            CorrectnessEvaluator(),
+            RelevancyEvaluator()
+        ]
+
     @property
     def evaluators(self) -> List[BaseEvaluator]:
         """
         The used evaluators.
         """
-        set_mit_llm(base_llm=self.base_llm)
-        return [
-            FaithfulnessEvaluator(),
-            CorrectnessEvaluator(),
-            RelevancyEvaluator()
-        ]
\ No newline at end of file
+        return self._evaluators
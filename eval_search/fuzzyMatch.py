@@ -0,0 +1,81 @@
+def max_edits(pattern, error_ratio):
+    """
+    Edits allowed for a keyword, error_ratio of its length rounded down.
+    """
+    return int(len(pattern) * error_ratio)
+
+
+def edit_distance(pattern, text):
+    """
+    Smallest edit distance between pattern and any substring of text, with Myers'
+    bit-parallel algorithm: one pass over text, the pattern columns packed in an int.
+    """
+    m = len(pattern)
+    if m == 0:
+        return 0
+    peq = {}
+    for i, ch in enumerate(pattern):
+        peq[ch] = peq.get(ch, 0) | (1 << i)
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv, mv, score = mask, 0, m
+    best = m
+    for ch in text:
+        eq = peq.get(ch, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+            if score < best:
+                best = score
+        # a substring may start anywhere, so no carry into the first row
+        ph = (ph << 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return best
+
+
+def split_pieces(pattern, edits):
+    """
+    (offset, piece) of edits + 1 disjoint pieces of pattern. A match with at most `edits` edits
+    leaves one of them intact, so only text around exact piece occurrences needs verifying.
+    """
+    num_pieces = edits + 1
+    bounds = [len(pattern) * idx // num_pieces for idx in range(num_pieces + 1)]
+    return [(lo, pattern[lo:hi]) for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+
+def fuzzy_contains(pattern, text, edits, pieces=None):
+    """
+    Whether text holds a substring within `edits` edits of pattern. Myers runs only on the
+    windows around exact occurrences of the split_pieces, which may be passed precomputed.
+    """
+    if pattern in text:
+        return True
+    if edits <= 0:
+        return False
+    if edits >= len(pattern):
+        return True
+    m = len(pattern)
+    windows = []
+    for offset, piece in pieces or split_pieces(pattern, edits):
+        start = text.find(piece)
+        while start >= 0:
+            lo = max(0, start - offset - edits)
+            windows.append((lo, start - offset + m + edits))
+            start = text.find(piece, start + 1)
+    if not windows:
+        return False
+    windows.sort()
+    merged = [list(windows[0])]
+    for lo, hi in windows[1:]:
+        if lo <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+    return any(edit_distance(pattern, text[lo:hi]) <= edits for lo, hi in merged)
@@ -0,0 +1,155 @@
+from eval_search.fuzzyMatch import max_edits, fuzzy_contains
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+class KeywordMatcher:
+    """
+    The coarse and fine keywords of one example compiled into a single Aho-Corasick automaton
+    (pyahocorasick, optional dependency) so each normalized chunk is scanned once. Without
+    pyahocorasick every distinct keyword is looked up with `in` on the chunk instead.
+    Keywords and texts are compared lowercased, scan results are kept per chunk key so the
+    top-k, recall and offline passes of an example never scan a chunk twice.
+    With error_ratio > 0 a keyword also matches substrings within error_ratio * its length
+    edits, checked with fuzzy_contains where the exact scan misses.
+    """
+    def __init__(self, coarse_keywords, fine_keywords, error_ratio=0):
+        self.grouped = not (len(fine_keywords) > 0 and type(fine_keywords[0]) == str)
+        groups = fine_keywords if self.grouped else [fine_keywords]
+        self.patterns = []
+        pattern_ids = {}
+
+        def pattern_id(keyword):
+            pattern = keyword.lower()
+            if pattern not in pattern_ids:
+                pattern_ids[pattern] = len(self.patterns)
+                self.patterns.append(pattern)
+            return pattern_ids[pattern]
+
+        self.fine_groups = [[(keyword, pattern_id(keyword)) for keyword in keywords] for keywords in groups]
+        self.coarse_ids = {pattern_id(keyword) for keyword in coarse_keywords}
+        self.fine_ids = {pid for keywords in self.fine_groups for _, pid in keywords}
+        # the empty keyword is in every text, as with `in`
+        self.always = {pid for pid, pattern in enumerate(self.patterns) if not pattern}
+        self.edits = [max_edits(pattern, error_ratio) for pattern in self.patterns]
+        self.fuzzy_ids = {pid for pid, edits in enumerate(self.edits) if edits > 0}
+        # longest text a fine keyword match can span, joins of chunks are scanned this far
+        self.overlap = max((len(self.patterns[pid]) + self.edits[pid] - 1 for pid in self.fine_ids), default=0)
+        self.automaton = None
+        if ahocorasick is not None and len(self.always) < len(self.patterns):
+            self.automaton = ahocorasick.Automaton()
+            for pid, pattern in enumerate(self.patterns):
+                if pattern:
+                    self.automaton.add_word(pattern, (pid, len(pattern)))
+            self.automaton.make_automaton()
+        self.chunk_hits = {}
+
+    def iter_matches(self, text):
+        """
+        (start, end, pattern id) of every occurrence of a non-empty keyword in text.
+        """
+        if self.automaton is not None:
+            for last, (pid, length) in self.automaton.iter(text):
+                yield last + 1 - length, last + 1, pid
+            return
+        for pid, pattern in enumerate(self.patterns):
+            if not pattern:
+                continue
+            start = text.find(pattern)
+            while start >= 0:
+                yield start, start + len(pattern), pid
+                start = text.find(pattern, start + 1)
+
+    def scan(self, text):
+        """
+        Ids of the keywords occurring in text.
+        """
+        if self.automaton is not None:
+            hits = {pid for _, (pid, _) in self.automaton.iter(text)} | self.always
+        else:
+            hits = {pid for pid, pattern in enumerate(self.patterns) if pattern in text}
+        for pid in self.fuzzy_ids - hits:
+            if fuzzy_contains(self.patterns[pid], text, self.edits[pid]):
+                hits.add(pid)
+        return hits
+
+    def hits(self, key, text):
+        if key is None:
+            return self.scan(text)
+        if key not in self.chunk_hits:
+            self.chunk_hits[key] = self.scan(text)
+        return self.chunk_hits[key]
+
+    def iter_match(self, chunks):
+        """
+        chunks: [(key, lowercased normalized text)]. Yields, after each chunk, whether it contains
+        a coarse keyword and the ids of the fine keywords found in the concatenation of the chunks
+        selected so far, including keywords that only occur across the boundary of two of them.
+        """
+        found = set(self.always & self.fine_ids)
+        overlap = self.overlap
+        tail = ''
+        for key, text in chunks:
+            hits = self.hits(key, text)
+            selected = bool(hits & self.coarse_ids)
+            if selected:
+                found |= hits & self.fine_ids
+                if overlap > 0:
+                    found |= self.join_matches(tail, text[:overlap])
+                    tail = text[-overlap:] if len(text) >= overlap else (tail + text)[-overlap:]
+            yield selected, found
+
+    def match(self, chunks):
+        """
+        Indices of the chunks containing a coarse keyword and the ids of the fine keywords found in them.
+        """
+        selected, found = [], set(self.always & self.fine_ids)
+        for idx, (is_selected, found) in enumerate(self.iter_match(chunks)):
+            if is_selected:
+                selected.append(idx)
+        return selected, found
+
+    def group_ranks(self, chunks):
+        """
+        1-based rank of the chunk after which each fine keyword group is found, None for groups
+        never found; ungrouped keywords form one group. One pass gives every cutoff.
+        """
+        ranks = [None] * len(self.fine_groups)
+        pending = list(range(len(self.fine_groups)))
+        for rank, (_, found) in enumerate(self.iter_match(chunks), 1):
+            for group in [group for group in pending if all(pid in found for _, pid in self.fine_groups[group])]:
+                ranks[group] = rank
+                pending.remove(group)
+            if not pending:
+                break
+        return ranks
+
+    def join_matches(self, tail, head):
+        """
+        Ids of the fine keywords starting in tail and ending in head, the text following it.
+        Fuzzy keywords count when matched anywhere in tail + head.
+        """
+        if not tail or not head:
+            return set()
+        found = {pid for start, end, pid in self.iter_matches(tail + head)
+                 if start < len(tail) < end and pid in self.fine_ids}
+        for pid in (self.fuzzy_ids & self.fine_ids) - found:
+            if fuzzy_contains(self.patterns[pid], tail + head, self.edits[pid]):
+                found.add(pid)
+        return found
+
+    def missing(self, found):
+        """
+        (number of fine keyword groups fully found, fine keywords not found).
+        Ungrouped keywords count no groups, like find_gold always did.
+        """
+        keyword_hit, missing_keywords = 0, []
+        for keywords in self.fine_groups:
+            group_missing = [keyword for keyword, pid in keywords if pid not in found]
+            if self.grouped and not group_missing:
+                keyword_hit += 1
+            missing_keywords += group_missing
+        return keyword_hit, missing_keywords
@@ -0,0 +1,121 @@
+import logging
+
+import numpy as np
+
+from eval_search.fuzzyMatch import split_pieces, fuzzy_contains
+
+# bits per code point in a packed bigram key
+CODE_BITS = 21
+CODE_MASK = (1 << CODE_BITS) - 1
+
+
+def sorted_unique(values):
+    """
+    Sorted distinct values and the index of their first occurrence in the sorted array.
+    """
+    values = np.sort(values)
+    first = np.ones(len(values), dtype=bool)
+    first[1:] = values[1:] != values[:-1]
+    return values[first], np.flatnonzero(first)
+
+
+def bigram_keys(pattern):
+    codes = [ord(ch) for ch in pattern]
+    return {(first << CODE_BITS) | second for first, second in zip(codes[:-1], codes[1:])}
+
+
+class NgramIndex:
+    """
+    Inverted index from the character bigrams of the lowercased texts to the sorted ids of the
+    texts containing them. Only texts holding every bigram of a keyword are candidates, a
+    substring check on those confirms the match. Postings are CSR arrays built block-wise
+    with numpy, so a million chunks index in seconds to a minute.
+    """
+    def __init__(self, texts, block_size=16384):
+        self.texts = texts
+        keys, docs, last_chars = [], [], []
+        for start in range(0, len(texts), block_size):
+            lowered = [text.lower() for text in texts[start:start + block_size]]
+            lengths = np.fromiter(map(len, lowered), dtype=np.int64, count=len(lowered))
+            codes = np.frombuffer(''.join(lowered).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+            doc = np.repeat(np.arange(len(lowered), dtype=np.uint64), lengths)
+            same_doc = doc[:-1] == doc[1:]
+            bigrams = ((codes[:-1] << CODE_BITS) | codes[1:])[same_doc]
+            # one posting per (bigram, text), sorted by bigram then text
+            postings, _ = sorted_unique((bigrams << CODE_BITS) | doc[:-1][same_doc])
+            keys.append(postings >> CODE_BITS)
+            docs.append((postings & CODE_MASK).astype(np.int64) + start)
+            last = np.full(len(lowered), -1, dtype=np.int64)
+            nonempty = lengths > 0
+            last[nonempty] = codes[np.cumsum(lengths)[nonempty] - 1]
+            last_chars.append(last)
+        keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.uint64)
+        docs = np.concatenate(docs) if docs else np.zeros(0, dtype=np.int64)
+        order = np.argsort(keys, kind='stable')
+        self.keys, starts = sorted_unique(keys[order])
+        self.indptr = np.append(starts, len(order)).astype(np.int64)
+        self.doc_ids = docs[order].astype(np.int32)
+        self.last_chars = np.concatenate(last_chars) if last_chars else np.zeros(0, dtype=np.int64)
+        logging.info(f"Indexed {len(texts)} texts: {len(self.keys)} bigrams, {len(self.doc_ids)} postings")
+
+    def postings(self, key):
+        pos = np.searchsorted(self.keys, key)
+        if pos == len(self.keys) or self.keys[pos] != key:
+            return np.zeros(0, dtype=np.int32)
+        return self.doc_ids[self.indptr[pos]:self.indptr[pos + 1]]
+
+    def candidates(self, pattern):
+        """
+        Sorted ids of the texts that may contain the lowercase pattern.
+        """
+        if not pattern:
+            return np.arange(len(self.texts), dtype=np.int32)
+        if len(pattern) == 1:
+            # texts with a bigram starting with the character, or ending in it
+            code = ord(pattern)
+            lo, hi = np.searchsorted(self.keys, [code << CODE_BITS, (code + 1) << CODE_BITS])
+            starting = self.doc_ids[self.indptr[lo]:self.indptr[hi]]
+            return np.union1d(starting, np.flatnonzero(self.last_chars == code)).astype(np.int32)
+        lists = sorted((self.postings(key) for key in bigram_keys(pattern)), key=len)
+        result = lists[0]
+        for docs in lists[1:]:
+            if len(result) == 0:
+                break
+            result = np.intersect1d(result, docs, assume_unique=True)
+        return result
+
+    def fuzzy_candidates(self, pattern, edits):
+        """
+        Sorted ids of the texts that may hold the pattern within `edits` edits: those holding one of
+        its split_pieces intact and, as an edit destroys at most two bigrams, all but 2 * edits of its
+        distinct bigrams.
+        """
+        if edits >= len(pattern):
+            return self.candidates('')
+        pieces = split_pieces(pattern, edits)
+        candidates = self.candidates(pieces[0][1])
+        for _, piece in pieces[1:]:
+            candidates = np.union1d(candidates, self.candidates(piece)).astype(np.int32)
+        keys = bigram_keys(pattern)
+        min_shared = len(keys) - 2 * edits
+        if min_shared > 1 and len(candidates) > 0:
+            counts = np.bincount(np.concatenate([self.postings(key) for key in keys]), minlength=len(self.texts))
+            candidates = candidates[counts[candidates] >= min_shared]
+        return candidates
+
+    def search(self, pattern, docs=None, first_only=False, edits=0):
+        """
+        Sorted ids of the texts containing the lowercase pattern, within `edits` edits, restricted
+        to the sorted ids in docs.
+        """
+        candidates = self.fuzzy_candidates(pattern, edits) if edits > 0 else self.candidates(pattern)
+        if docs is not None:
+            candidates = np.intersect1d(candidates, docs, assume_unique=True)
+        pieces = split_pieces(pattern, edits) if 0 < edits < len(pattern) else None
+        found = []
+        for doc in candidates.tolist():
+            if fuzzy_contains(pattern, self.texts[doc].lower(), edits, pieces):
+                found.append(doc)
+                if first_only:
+                    break
+        return np.asarray(found, dtype=np.int32)
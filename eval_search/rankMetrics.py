@@ -0,0 +1,34 @@
+import numpy as np
+
+
+def metrics_by_k(group_ranks, num_examples, max_k):
+    """
+    Hit@k, recall@k, MRR@k and nDCG@k for k = 1..max_k from the group_ranks of each evaluated
+    example (the rank at which each fine keyword group is found, None if never):
+    - hit@k: all groups found within the top k, what top_hit is for top_k = k
+    - recall@k: fraction of the groups found within the top k
+    - MRR@k: reciprocal of the rank finding the last group, 0 past k
+    - nDCG@k: each group discounted by 1 / log2(1 + its rank), ideal is every group at rank 1
+    Averaged over num_examples, so examples that were skipped count as misses.
+    """
+    num_groups = max((len(ranks) for ranks in group_ranks), default=0)
+    ranks = np.full((len(group_ranks), max(num_groups, 1)), np.inf)
+    valid = np.zeros(ranks.shape, dtype=bool)
+    for row, example_ranks in enumerate(group_ranks):
+        valid[row, :len(example_ranks)] = True
+        ranks[row, :len(example_ranks)] = [np.inf if rank is None else rank for rank in example_ranks]
+    groups_per_example = np.maximum(valid.sum(axis=1), 1)[:, None]
+    full_rank = np.where(valid, ranks, 0).max(axis=1)[:, None]
+
+    ks = np.arange(1, max_k + 1)
+    found = valid[:, :, None] & (ranks[:, :, None] <= ks)
+    hit = full_rank <= ks
+    gains = np.where(valid, 1.0 / np.log2(ranks + 1), 0.0)
+    denominator = max(num_examples, 1)
+    return {
+        "k": ks,
+        "hit": hit.sum(axis=0) / denominator,
+        "recall": (found.sum(axis=1) / groups_per_example).sum(axis=0) / denominator,
+        "mrr": np.where(hit, 1.0 / np.maximum(full_rank, 1), 0.0).sum(axis=0) / denominator,
+        "ndcg": ((found * gains[:, :, None]).sum(axis=1) / groups_per_example).sum(axis=0) / denominator,
+    }
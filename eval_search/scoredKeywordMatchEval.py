@@ -2,79 +2,177 @@ import os
 import json
 import logging
 import csv
-from llama_index.core.schema import TextNode
+import itertools
+import multiprocessing
+import numpy as np
 from eval_search.utils import clean_text
+from eval_search.keywordMatcher import KeywordMatcher
+from eval_search.ngramIndex import NgramIndex
+from eval_search.rankMetrics import metrics_by_k
+from normalized_text import NormalizedTextStore, NORMALIZED_TEXT_FILE
 from eval_search.baseEval import BaseEval
+from format_converter import iter_recall_results, load_node_store, RECALL_RESULTS_FILE, PARSED_FILES_FILE
+from utils import fork_is_safe
+
+# the evaluator forked workers run, set before the pool starts so the offline corpus is inherited, not pickled
+_worker_evaluator = None
+
+
+def evaluate_batch(examples):
+    return [_worker_evaluator.evaluate(example) for example in examples]
+
 
 class ScoredKeywordMatchEval(BaseEval):
     def __init__(self, config, input_folder):
         super(ScoredKeywordMatchEval, self).__init__(config, input_folder)
-        self.eval_error_ratio = 0
+        # keywords match substrings within eval_error_ratio * their length edits
+        self.eval_error_ratio = config.get("eval_error_ratio", 0)
+        # evaluate examples in this many forked processes, worker_batch_size examples per task
+        self.num_workers = config.get("num_workers", 1)
+        self.worker_batch_size = config.get("worker_batch_size", 64)
         self.offline_doc = []
+        # bigram index over the offline corpus for the offline_hit fallback, instead of scanning every chunk
+        self.use_offline_index = config.get("offline_index", True)
+        self.offline_index = None
+        self.node_store = None
+        # cleaned texts of the nodes, persisted beside parsed_files.json by the search stage
+        self.text_store = NormalizedTextStore()
         self.load_offline_doc()
 
     def load_offline_doc(self):
-        fpath = os.path.join(self.input_folder, "parsed_files.json")
+        fpath = os.path.join(self.input_folder, PARSED_FILES_FILE)
         if os.path.exists(fpath):
-            for node in json.load(open(fpath)):
-                node['text'] = clean_text(node['text'])
-                self.offline_doc.append({'node': node})
+            # also the store the node references of the recall results resolve against
+            self.node_store = load_node_store(fpath)
+            self.text_store = NormalizedTextStore(os.path.join(self.input_folder, NORMALIZED_TEXT_FILE))
+            # written by the search stage, nodes it misses are normalized here without writing it back
+            normalized = [self.text_store.get(node) for node in self.node_store.values()]
+            for node, entry in zip(self.node_store.values(), normalized):
+                self.offline_doc.append({'node': dict(node, text=entry["clean"])})
+            if self.use_offline_index:
+                self.offline_index = NgramIndex([entry["clean_lower"] for entry in normalized])
         else:
             logging.error(f"Parsed files not found in the input folder. Please check if {fpath} exists and the soft link is correct.")
 
-    def find_gold_from_offline(self, fine_keywords, query='', error_ratio=0.15, return_results=False):
-        return self.find_gold(self.offline_doc, fine_keywords, query, error_ratio, return_results, need_norm=False)
+    def find_gold_from_offline(self, fine_keywords, coarse_keywords, query='', error_ratio=0.15, return_results=False, matcher=None):
+        """
+        find_gold over the whole offline corpus, reading only the chunks the n-gram index lists for the keywords.
+        """
+        if self.offline_index is None:
+            return self.find_gold(self.offline_doc, fine_keywords, coarse_keywords, query, error_ratio=error_ratio,
+                                  return_results=return_results, need_norm=False, matcher=matcher)
+        if matcher is None:
+            matcher = KeywordMatcher(coarse_keywords, fine_keywords, error_ratio)
+        selected = np.zeros(0, dtype=np.int32)
+        for pid in matcher.coarse_ids:
+            selected = np.union1d(selected, self.offline_index.search(matcher.patterns[pid], edits=matcher.edits[pid]))
+        found = matcher.always & matcher.fine_ids
+        for pid in matcher.fine_ids - found:
+            if len(self.offline_index.search(matcher.patterns[pid], docs=selected, first_only=True, edits=matcher.edits[pid])) > 0:
+                found.add(pid)
+        overlap = matcher.overlap
+        if overlap > 0 and matcher.fine_ids - found:
+            # keywords spanning two consecutive selected chunks, only the chunk ends are read
+            tail = ''
+            for doc in selected.tolist():
+                text = self.offline_doc[doc]['node']['text']
+                found |= matcher.join_matches(tail, text[:overlap].lower())
+                tail = (tail + text[-overlap:].lower())[-overlap:]
+        _, missing_key = matcher.missing(found)
+        if len(missing_key) == 0:
+            return [self.offline_doc[doc] for doc in selected.tolist()] if return_results else True
+        return [] if return_results else False
+
+    def evaluate(self, example):
+        """
+        Add the eval_results of one recall example to it, None when it has no keywords to match.
+        """
+        eval_results = {}
+        query = example["query"]
+        if len(example["fine_keywords"]) > 0 and type(example["fine_keywords"][0]) == str:
+            fine_keywords = [clean_text(keyword) for keyword in example["fine_keywords"]]
+        else:
+            fine_keywords = [[clean_text(keyword) for keyword in keywords] for keywords in example["fine_keywords"]]
+        recall_results = example["recall_results"]['source_nodes']
+        coarse_keywords = [clean_text(keyword) for keyword in example["coarse_keywords"]]
+
+        if not fine_keywords: return None
+        if not coarse_keywords: return None
+
+        hit_by = None
+        # one automaton per example, chunks scanned by the top-k pass are not scanned again
+        matcher = KeywordMatcher(coarse_keywords, fine_keywords, self.eval_error_ratio)
+        gold_result, hit_score, keywords_missing, keywords_content = self.find_gold(recall_results[:self.top_k], fine_keywords, coarse_keywords, query, error_ratio=self.eval_error_ratio, return_results=True, need_norm=True, return_score=True, matcher=matcher)
+
+        if gold_result:
+            hit_by = "top_hit"
+        if hit_by is None:
+            gold_result = self.find_gold(recall_results, fine_keywords, coarse_keywords, query, error_ratio=self.eval_error_ratio, return_results=True, need_norm=True, matcher=matcher)
+            if gold_result:
+                hit_by = "recall_hit"
+        if hit_by is None:
+            gold_result = self.find_gold_from_offline(fine_keywords, coarse_keywords, query, error_ratio=self.eval_error_ratio, return_results=True, matcher=matcher)
+            if gold_result:
+                hit_by = "offline_hit"
+
+        eval_results["hit_by"] = hit_by if hit_by is not None else "no_hit"
+        eval_results['hit_score'] = hit_score
+        eval_results['keywords_missing'] = keywords_missing
+        eval_results['keywords_content'] = keywords_content
+        eval_results["gold_result"] = gold_result
+        # rank at which each fine keyword group is found in the recall list, for the metrics by k
+        eval_results["group_ranks"] = matcher.group_ranks(self.match_chunks(recall_results)[1])
+
+        prompt = '\n\n'.join([r['node']['text'] for r in recall_results[:self.top_k]])
+        eval_results['prompt'] = prompt
+        example["eval_results"] = eval_results
+        del example["recall_results"]
+        example["topk_results"] = recall_results[:self.top_k]
+        return example
+
+    def iter_evaluated(self, examples):
+        """
+        evaluate() each example, in num_workers forked processes when above 1. The workers share
+        the offline corpus and its index through the fork and results come back in input order,
+        so the output is the same as a serial run. Forking needs a single-threaded parent, examples
+        are evaluated in process when other threads run, e.g. parallel pipeline stages.
+        """
+        if self.num_workers <= 1 or not fork_is_safe("keyword match evaluation"):
+            for example in examples:
+                yield self.evaluate(example)
+            return
+        global _worker_evaluator
+        _worker_evaluator = self
+        batches = iter(lambda: list(itertools.islice(examples, self.worker_batch_size)), [])
+        ctx = multiprocessing.get_context("fork")
+        try:
+            with ctx.Pool(self.num_workers) as pool:
+                for results in pool.imap(evaluate_batch, batches):
+                    yield from results
+        finally:
+            # also when a worker raises or the consumer stops early, so the evaluator is not kept alive
+            _worker_evaluator = None
 
     def process(self, input_folder: str, output_folder: str):
-        recall_results_list = json.load(open(os.path.join(input_folder, "recall_results.json")))
         eval_results_list = []
         stats = {"total": 0, "top_hit": 0, "recall_hit": 0, "offline_hit": 0}
         hit_priority = ["top_hit", "recall_hit", "offline_hit"]
-        print(len(recall_results_list))
-        for example in recall_results_list:
-            eval_results = {}
-            stats["total"] += 1
-            query = example["query"]
-            if len(example["fine_keywords"]) > 0 and type(example["fine_keywords"][0]) == str:
-                fine_keywords = [clean_text(keyword) for keyword in example["fine_keywords"]]
-            else:
-                fine_keywords = [[clean_text(keyword) for keyword in keywords] for keywords in example["fine_keywords"]]
-            recall_results = example["recall_results"]['source_nodes']
-            coarse_keywords = [clean_text(keyword) for keyword in example["coarse_keywords"]]
+        group_ranks, max_k = [], [0]
 
-            if not fine_keywords: continue
-            if not coarse_keywords: continue
+        def read_examples():
+            for example in iter_recall_results(os.path.join(input_folder, RECALL_RESULTS_FILE), node_store=self.node_store):
+                stats["total"] += 1
+                max_k[0] = max(max_k[0], len(example["recall_results"]["source_nodes"]))
+                yield example
 
-            hit_by = None
-            gold_result, hit_score, keywords_missing, keywords_content = self.find_gold(recall_results[:self.top_k], fine_keywords, coarse_keywords, query, error_ratio=self.eval_error_ratio, return_results=True, need_norm=True, return_score=True)
-   
-            if gold_result:
-                hit_by = "top_hit"
-            if hit_by is None:
-                gold_result = self.find_gold(recall_results, fine_keywords, coarse_keywords, query, error_ratio=self.eval_error_ratio, return_results=True, need_norm=True)
-                if gold_result:
-                    hit_by = "recall_hit"
-            if hit_by is None:
-                gold_result = self.find_gold_from_offline(fine_keywords, query, error_ratio=self.eval_error_ratio, return_results=True)
-                if gold_result:
-                    hit_by = "offline_hit"
-
-            eval_results["hit_by"] = hit_by
-            eval_results['hit_score'] = hit_score
-            eval_results['keywords_missing'] = keywords_missing
-            eval_results['keywords_content'] = keywords_content
-            eval_results["gold_result"] = gold_result
-            if hit_by is not None:
+        for example in self.iter_evaluated(read_examples()):
+            if example is None:
+                continue
+            group_ranks.append(example["eval_results"]["group_ranks"])
+            hit_by = example["eval_results"]["hit_by"]
+            if hit_by != "no_hit":
                 for stat_update in hit_priority[hit_priority.index(hit_by):]:
                     stats[stat_update] += 1
-            else:
-                eval_results["hit_by"] = "no_hit"
-
-            prompt = '\n\n'.join([TextNode.from_dict(r['node']).get_content() for r in recall_results[:self.top_k]])
-            eval_results['prompt'] = prompt
-            example["eval_results"] = eval_results
-            del example["recall_results"]
-            example["topk_results"] = recall_results[:self.top_k]
             eval_results_list.append(example)
     
         json.dump(eval_results_list, open(os.path.join(output_folder, "eval_results_detail.json"), "w"), indent=2, ensure_ascii=False)
@@ -102,51 +200,49 @@ class ScoredKeywordMatchEval(BaseEval):
             for key, value in stats.items():
                 if key != "total":
                     writer.writerow({"metric": key, "value": "{:.2f}%".format(value / stats["total"] * 100)})
+
+        metrics = metrics_by_k(group_ranks, stats["total"], max_k[0])
+        with open(os.path.join(output_folder, "eval_metrics_by_k.csv"), 'w', newline='', encoding='utf-8') as metricsfile:
+            writer = csv.writer(metricsfile)
+            writer.writerow(["k", "hit@k", "recall@k", "mrr@k", "ndcg@k"])
+            for row in zip(*metrics.values()):
+                writer.writerow([int(row[0])] + ["{:.4f}".format(value) for value in row[1:]])
         return output_folder
 
-    def find_gold(self, search_results, fine_keywords, coarse_keywords, query='', error_ratio=0.15, return_results=False, need_norm=True, return_score=False):
-        idx = 0
-
-        search_results_text = ''
-        max_content = ''
-        good_results = []
-        for result in search_results:
-            node = TextNode.from_dict(result['node'])
-            combined_text = node.get_content()
-            if need_norm:
-                combined_text = clean_text(combined_text)
-            flag = 0
-            for core_keyword in coarse_keywords:
-                if core_keyword.lower() in combined_text.lower():
-                    flag = 1
-            if flag:
-                search_results_text += combined_text
-                max_content += node.get_content()
-                good_results.append(result)
+    def normalize(self, node, need_norm=True):
+        """
+        (content, lowercased matching text) of a node dict, the cleaned text comes from the text store.
+        """
+        content = node['text']
+        if not need_norm:
+            return content, content.lower()
+        return content, self.text_store.get(node)["clean_lower"]
 
-        gold_result = []
-        max_keyword_hit = 0
+    def match_chunks(self, search_results, need_norm=True):
+        """
+        [(content, lowercased matching text)] of the results and the [(key, matching text)] a KeywordMatcher scans.
+        """
+        normalized = [self.normalize(result['node'], need_norm) for result in search_results]
+        return normalized, [((result['node'].get('id_'), need_norm), text) for result, (_, text) in zip(search_results, normalized)]
 
-        keyword_hit = 0
-        if len(fine_keywords) > 0 and type(fine_keywords[0]) == str:
-            missing_key = [keyword for keyword in fine_keywords if not keyword.lower() in search_results_text.lower()]
-        else:
-            missing_key = []
-            for keywords in fine_keywords:
-                cur_mk = [keyword for keyword in keywords if not keyword.lower() in search_results_text.lower()]
-                if len(cur_mk) == 0:
-                    keyword_hit += 1
-                missing_key += cur_mk
+    def find_gold(self, search_results, fine_keywords, coarse_keywords, query='', error_ratio=0.15, return_results=False, need_norm=True, return_score=False, matcher=None):
+        if matcher is None:
+            matcher = KeywordMatcher(coarse_keywords, fine_keywords, error_ratio)
+        normalized, chunks = self.match_chunks(search_results, need_norm)
+        selected, found = matcher.match(chunks)
+        good_results = [search_results[idx] for idx in selected]
+        max_content = ''.join(normalized[idx][0] for idx in selected)
+
+        gold_result = []
+        keyword_hit, missing_key = matcher.missing(found)
         max_keywords_missing = missing_key
         max_keyword_hit = keyword_hit / len(fine_keywords)
-       
-               
 
         if len(missing_key) == 0:
             if return_results:
                 gold_result = good_results
             else:
-                return True, 1, [], node.get_content()
+                return True, 1, [], normalized[-1][0]
 
         if return_results:
             if return_score:
@@ -158,5 +254,3 @@ class ScoredKeywordMatchEval(BaseEval):
                 return False, max_keyword_hit, max_keywords_missing, max_content
             else:
                 return False
-
-
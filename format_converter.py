@@ -1,13 +1,133 @@
 import json
 import os
+import logging
 
+import numpy as np
 from llama_index.core.schema import TextNode, NodeRelationship, RelatedNodeInfo
 from llama_index.core import Document
 
+EMBEDDING_SIDECAR_SUFFIX = '.emb.npy'
+RECALL_RESULTS_FILE = 'recall_results.jsonl'
+COMPLETE_MARKER_SUFFIX = '.complete'
+# node store of a search stage, recall results reference its nodes by id
+PARSED_FILES_FILE = 'parsed_files.json'
+
+def write_node_file(output_file, nodes, embedding_dtype='float32'):
+    """
+    Write nodes as one json record per line without embeddings, and their embeddings as a
+    (num_nodes, dim) matrix in output_file + EMBEDDING_SIDECAR_SUFFIX. Rows of nodes without an embedding are NaN.
+    """
+    embeddings = []
+    with open(output_file, 'w') as f:
+        for node in nodes:
+            node_dict = node.to_dict()
+            embeddings.append(node_dict.pop('embedding', None))
+            f.write(json.dumps(node_dict, ensure_ascii=False) + '\n')
+    sidecar = output_file + EMBEDDING_SIDECAR_SUFFIX
+    dim = next((len(embedding) for embedding in embeddings if embedding is not None), 0)
+    if dim == 0:
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+        return
+    matrix = np.full((len(embeddings), dim), np.nan, dtype=embedding_dtype)
+    for idx, embedding in enumerate(embeddings):
+        if embedding is not None:
+            matrix[idx] = embedding
+    np.save(sidecar, matrix)
+
+def read_node_file(input_file, mmap=True):
+    """
+    Returns (nodes, embeddings). For files written by write_node_file the nodes carry no
+    embedding and embeddings is the memory-mapped sidecar matrix (None if there is none).
+    Legacy files (a json list with inline embeddings) return the nodes as stored and None.
+    """
+    with open(input_file, 'r') as f:
+        head = f.read(4096).lstrip()
+        f.seek(0)
+        if head.startswith('['):
+            return [TextNode.from_dict(doc) for doc in json.load(f)], None
+        nodes = [TextNode.from_dict(json.loads(line)) for line in f if line.strip()]
+    sidecar = input_file + EMBEDDING_SIDECAR_SUFFIX
+    embeddings = None
+    if os.path.exists(sidecar):
+        embeddings = np.load(sidecar, mmap_mode='r' if mmap else None)
+    return nodes, embeddings
+
 def nodefile2node(input_file):
-    nodes = [TextNode.from_dict(doc) for doc in json.load(open(input_file, 'r'))]
+    nodes, embeddings = read_node_file(input_file)
+    if embeddings is not None:
+        for node, embedding in zip(nodes, embeddings):
+            if not np.isnan(embedding[0]):
+                node.embedding = embedding.astype(np.float32).tolist()
     return nodes
 
+def iter_jsonl(input_file):
+    with open(input_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def resume_jsonl(output_file, expected, key='query'):
+    """
+    Count the leading records of output_file whose `key` matches `expected` in order and
+    truncate the file after them, dropping a half written last line or records of other inputs.
+    """
+    if not os.path.exists(output_file):
+        return 0
+    done, offset = 0, 0
+    with open(output_file, 'rb') as f:
+        for line in f:
+            if done >= len(expected) or not line.endswith(b'\n'):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if record.get(key) != expected[done]:
+                break
+            done += 1
+            offset += len(line)
+    with open(output_file, 'r+b') as f:
+        f.truncate(offset)
+    return done
+
+def load_node_store(input_file):
+    """
+    {node id: node dict} of a parsed_files.json.
+    """
+    return {node['id_']: node for node in json.load(open(input_file, 'r', encoding='utf-8'))}
+
+def node_refs(nodes):
+    return [{"node_id": node.node.node_id, "score": node.score, "rank": rank} for rank, node in enumerate(nodes)]
+
+def resolve_node_refs(source_nodes, node_store):
+    """
+    Expand {"node_id", "score", "rank"} references to the {"node", "score"} records of NodeWithScore.to_dict().
+    """
+    return [{"node": node_store[ref["node_id"]], "score": ref["score"]} if "node" not in ref else ref for ref in source_nodes]
+
+def iter_recall_results(input_file, node_store=None):
+    """
+    Stream the examples of a search stage: recall_results.jsonl, or a legacy recall_results.json list.
+    When input_file does not exist the file with the other of the two extensions is read.
+    Node references are resolved against node_store, by default the parsed_files.json next to it.
+    """
+    if not os.path.exists(input_file):
+        input_file = input_file + 'l' if input_file.endswith('.json') else input_file[:-1]
+    if input_file.endswith('.json'):
+        examples = json.load(open(input_file))
+    else:
+        if not os.path.exists(input_file + COMPLETE_MARKER_SUFFIX):
+            logging.warning(f"{input_file} has no completion marker, the search stage may not have finished")
+        examples = iter_jsonl(input_file)
+    for example in examples:
+        source_nodes = example.get("recall_results", {}).get("source_nodes", [])
+        if any("node" not in ref for ref in source_nodes):
+            if node_store is None:
+                node_store = load_node_store(os.path.join(os.path.dirname(input_file), PARSED_FILES_FILE))
+            example["recall_results"]["source_nodes"] = resolve_node_refs(source_nodes, node_store)
+        yield example
+
 def onlchunkfile2node(input_file):
     content_json = json.load(open(input_file, 'r'))
     nodes = []
@@ -4,6 +4,7 @@ import os
 import logging
 import json
 from tqdm import tqdm
+import collections
 import concurrent.futures
 
 from llama_index.core.evaluation.base import BaseEvaluator
@@ -11,7 +12,9 @@ from llama_index.core.base.response.schema import RESPONSE_TYPE
 from llama_index.core.indices.query.schema import QueryBundle
 from llama_index.core.schema import NodeWithScore, TextNode
 
-from utils import import_class, set_mit_llm
+from utils import import_class, set_llm, run_async, log_llm_stats
+from llms.asyncClient import gather_bounded
+from format_converter import iter_recall_results
 from query_engine import BaseQueryEngine
 
 class BaseGenerator(ABC):
@@ -35,6 +38,11 @@ class BaseGenerator(ABC):
         self.searcher_config_name = config.get("searcher_config_name", "")
         self.base_llm = config.get("base_llm", None)
         self.thread_num = config.get("thread_num", 1)
+        # examples go through the async llm client instead of threads, its adaptive concurrency
+        # and rpm/tpm limits (llm_config) decide how many requests are in flight
+        self.async_mode = config.get("async_mode", False)
+        self.async_window = config.get("async_window", 256)
+        self.llm_config = config.get("llm_config", {})
         self.remove_if_exists = config.get("remove_if_exists", False)
         self.search_cache_file = config.get("search_cache_file", '')
         self.top_n = config.get("top_n", 1)
@@ -50,7 +58,7 @@ class BaseGenerator(ABC):
         self.query_engine = self.load_query_engine()
 
     def set_llms(self):
-        set_mit_llm(self.base_llm)
+        set_llm(self.base_llm, **self.llm_config)
 
     def load_search_query_engine(self):
         if self.searcher_config_name == "":
@@ -83,31 +91,35 @@ class BaseGenerator(ABC):
         parent_folder = os.path.dirname(input_folder)
        
         if self.search_cache_file != '':
-            rag_dataset = {"examples": json.load(open(f'{input_folder}{self.search_cache_file}'))}
+            examples = iter_recall_results(f'{input_folder}{self.search_cache_file}')
         else:
-            rag_dataset = json.load(open(os.path.join(parent_folder, "rag_dataset.json")))
+            examples = json.load(open(os.path.join(parent_folder, "rag_dataset.json")))['examples']
         
       
         response_list = []
-        if self.thread_num > 1:
+        if self.async_mode:
+            response_list = run_async(self.aprocess_examples(tqdm(examples)))
+        elif self.thread_num > 1:
             with concurrent.futures.ThreadPoolExecutor(max_workers=self.thread_num) as executor:
-                task = []
-                for example in rag_dataset['examples']:
-                    task.append(executor.submit(self.process_example, example))
-                example_idx = 0
-                for t in tqdm(task):
-                    rsps = t.result()
-                    example = rag_dataset['examples'][example_idx]
-                    example["predictions"] = self.response2dict(rsps)
+                # a bounded window of examples in flight, the rest are streamed as the window drains
+                pending = collections.deque()
+                for example in tqdm(examples):
+                    pending.append((example, executor.submit(self.process_example, example)))
+                    if len(pending) >= self.thread_num * 4:
+                        example, task = pending.popleft()
+                        example["predictions"] = self.response2dict(task.result())
+                        response_list.append(example)
+                for example, task in pending:
+                    example["predictions"] = self.response2dict(task.result())
                     response_list.append(example)
-                    example_idx += 1
         else:
-            for example in tqdm(rag_dataset['examples']):
+            for example in tqdm(examples):
                 rsps = self.process_example(example)
                 example["predictions"] = self.response2dict(rsps)
                 response_list.append(example)
 
      
+        log_llm_stats()
         output_file = os.path.join(output_folder, "predictions.json")
         with open(output_file, "w", encoding='utf-8') as f:
             json.dump({"examples": response_list}, f, indent=2, ensure_ascii=False)
@@ -126,18 +138,33 @@ class BaseGenerator(ABC):
             resp_dict["source_nodes"].append(node.to_dict())
         return resp_dict
 
+    def source_nodes(self, example: Dict[str, Any]) -> List[NodeWithScore]:
+        nodes_fmt = []
+        for node in example['recall_results']['source_nodes'][:self.top_n]:
+            score = node['score']
+            node = TextNode.from_dict(node['node'])
+            nodes_fmt.append(NodeWithScore(node=node, score=score))
+        return nodes_fmt
+
     def process_example(self, example: Dict[str, Any]):
-        nodes = example.get('recall_results', None)
-        if nodes is None:
+        if example.get('recall_results', None) is None:
             response = self.query_engine.query(example["query"])
         else:
-            nodes = nodes['source_nodes'][:self.top_n]
-            nodes_fmt = []
-            for node in nodes:
-                score = node['score']
-                node = TextNode.from_dict(node['node'])
-                nodes_fmt.append(NodeWithScore(node=node, score=score))
-            query = example["query"]
-            query_bundle = QueryBundle(query_str=query)
-            response = self.query_engine.synthesize(query_bundle, nodes_fmt)
-        return response
\ No newline at end of file
+            query_bundle = QueryBundle(query_str=example["query"])
+            response = self.query_engine.synthesize(query_bundle, self.source_nodes(example))
+        return response
+
+    async def aprocess_example(self, example: Dict[str, Any]):
+        if example.get('recall_results', None) is None:
+            response = await self.query_engine.aquery(example["query"])
+        else:
+            query_bundle = QueryBundle(query_str=example["query"])
+            response = await self.query_engine.asynthesize(query_bundle, self.source_nodes(example))
+        example["predictions"] = self.response2dict(response)
+        return example
+
+    async def aprocess_examples(self, examples):
+        """
+        aprocess_example over the examples, async_window of them in flight, in input order.
+        """
+        return await gather_bounded(self.aprocess_example, examples, self.async_window)
\ No newline at end of file
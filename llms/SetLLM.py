@@ -1,5 +1,5 @@
 from typing import Optional, List, Mapping, Any, Dict
-import os, time, requests
+import os, time, requests, asyncio
 import logging
 from llama_index.core.callbacks import CallbackManager
 from llama_index.core.llms import (
@@ -9,7 +9,10 @@ from llama_index.core.llms import (
     LLMMetadata,
 )
 from llama_index.core.llms.callbacks import llm_completion_callback
-from llama_index.core.bridge.pydantic import Field
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+
+from llms.asyncClient import AsyncLLMClient
+from completion_cache import CompletionCache, parse_response, retryable, parse_retry_after, backoff_delay
 
 # gpt-3.5-turbo-0301, gpt-3.5-turbo-16k, gpt-4
 DEFAULT_OPENAI_MODEL = 'gpt-3.5-turbo-0301'
@@ -18,6 +21,7 @@ DEFAULT_TOP_P = 0
 DEFAULT_SEED = 1234
 DEFAULT_INPUT_TOKEN = 3000
 DEFAULT_MAX_TOKEN = 1000
+DEFAULT_API_BASE = 'https://api.openai.com/v1'
 
 class SetLLM(CustomLLM):
     model: Optional[str] = Field(
@@ -61,6 +65,61 @@ class SetLLM(CustomLLM):
         description="The maximum number of input tokens.",
         gt=0,
     )
+    api_base: Optional[str] = Field(
+        default=DEFAULT_API_BASE,
+        description="Base URL of the OpenAI-compatible API, e.g. a local mock server.",
+    )
+    api_key: Optional[str] = Field(
+        default_factory=lambda: os.environ.get("OPENAI_API_KEY", "YOUR_API_KEY"),
+        description="The API key, OPENAI_API_KEY by default.",
+    )
+    request_timeout: Optional[float] = Field(
+        default=60.0,
+        description="Timeout of one API request in seconds.",
+        gt=0,
+    )
+    rpm_limit: Optional[int] = Field(
+        default=None,
+        description="Requests per minute the async client sends at most, unlimited when None.",
+    )
+    tpm_limit: Optional[int] = Field(
+        default=None,
+        description="Estimated tokens per minute the async client sends at most, unlimited when None.",
+    )
+    initial_concurrency: Optional[int] = Field(
+        default=4,
+        description="Requests the async client starts with in flight, adapted to 429s and 5xx from there.",
+        gt=0,
+    )
+    max_concurrency: Optional[int] = Field(
+        default=64,
+        description="Upper bound of the requests in flight and of the pooled connections.",
+        gt=0,
+    )
+    cache_path: Optional[str] = Field(
+        default=None,
+        description="SQLite file of the completion cache, completions are not cached when None.",
+    )
+    cache_max_entries: Optional[int] = Field(
+        default=None,
+        description="Completions the cache keeps at most, least recently used dropped first.",
+    )
+    cache_ttl: Optional[float] = Field(
+        default=None,
+        description="Seconds a cached completion is served, forever when None.",
+    )
+    prompt_price: Optional[float] = Field(
+        default=0.0,
+        description="Price per 1k prompt tokens, for the cost the cache saved.",
+    )
+    completion_price: Optional[float] = Field(
+        default=0.0,
+        description="Price per 1k completion tokens, for the cost the cache saved.",
+    )
+
+    _session: Any = PrivateAttr(default=None)
+    _async_client: Any = PrivateAttr(default=None)
+    _cache: Any = PrivateAttr(default=None)
 
     @property
     def metadata(self) -> LLMMetadata:
@@ -75,65 +134,136 @@ class SetLLM(CustomLLM):
             max_retries=self.max_retries,
         )
 
-    def process(self, query):
-        """
-        dynamic_max_tokens: usually used with prompt_len: "min(gen_kargs['max_new_tokens'], model_max_length-prompt_len)"
-        """
-        api_key = 'YOUR_API_KEY'
-        # ChatGPT API 的 URL
-        url = 'https://api.openai.com/v1/chat/completions'
+    @property
+    def url(self):
+        return f"{self.api_base.rstrip('/')}/chat/completions"
 
-        headers = {
-            'Authorization': f'Bearer {api_key}',
+    @property
+    def headers(self):
+        return {
+            'Authorization': f'Bearer {self.api_key}',
             'Content-Type': 'application/json',
         }
-        payload = {
-                "temperature": self.temperature,
-                "top_p": self.top_p,
-                "model": self.model,
-                "messages": [{"role": "user", "content": query}],
-                "n": self.n,
-                "max_tokens": self.max_tokens,
-                "seed": self.seed,
-            }
+
+    def payload(self, query):
+        return {
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "model": self.model,
+            "messages": [{"role": "user", "content": query}],
+            "n": self.n,
+            "max_tokens": self.max_tokens,
+            "seed": self.seed,
+        }
+
+    @property
+    def session(self):
+        """
+        Keep-alive session of the sync path, its pool sized for max_concurrency threads.
+        """
+        if self._session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
+    def async_client(self):
+        """
+        AsyncLLMClient of the running event loop, created again when a new loop (asyncio.run) starts.
+        """
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_client.loop is not loop:
+            self._async_client = AsyncLLMClient(self.url, self.headers, rpm_limit=self.rpm_limit, tpm_limit=self.tpm_limit,
+                                                initial_concurrency=self.initial_concurrency, max_concurrency=self.max_concurrency,
+                                                timeout=self.request_timeout, max_retries=self.max_retries)
+        return self._async_client
+
+    @property
+    def cache(self):
+        """
+        CompletionCache at cache_path, opened on first use, None without a cache_path.
+        """
+        if self._cache is None and self.cache_path:
+            self._cache = CompletionCache(self.cache_path, max_entries=self.cache_max_entries, ttl=self.cache_ttl,
+                                          prompt_price=self.prompt_price, completion_price=self.completion_price)
+        return self._cache
+
+    def client_stats(self):
+        stats = self._async_client.stats() if self._async_client is not None else {}
+        if self._cache is not None:
+            stats["cache"] = self._cache.stats()
+        return stats
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+
+    def process(self, payload):
+        """
+        (status code, (text, token usage) or None, Retry-After seconds or None) of one attempt,
+        status 0 when no response arrived.
+        """
         try:
-            # print(query)
-            response = requests.post(url, json=payload, headers=headers)
-            res = response.json()
-            return True, res['data']['response']['choices'][0]['message']['content']
-            
-        except:
-            return False, query
-
-    def inference(self, query: str) -> str:
+            response = self.session.post(self.url, json=payload, headers=self.headers, timeout=self.request_timeout)
+        except requests.RequestException as e:
+            logging.warning(f"LLM request failed: {e!r}")
+            return 0, None, None
+        if response.status_code != 200:
+            return response.status_code, None, parse_retry_after(response.headers.get("retry-after"))
+        try:
+            return 200, parse_response(response.json()), None
+        except (ValueError, KeyError, IndexError, TypeError):
+            logging.warning(f"Unexpected LLM response: {response.text[:200]}")
+            return 200, None, None
+
+    def inference(self, query: str):
         """
-        dynamic_max_tokens: usually used with prompt_len: "min(gen_kargs['max_new_tokens'], model_max_length-prompt_len)"
+        (response text, token usage or None), text None after max_retries failed retries. Same
+        retry policy as the async client.
         """
-        try_count = 0
-        response = None
-        while try_count < self.max_retries:
-            flag, res = self.process(query)
-            if not flag:
-                time.sleep(0.5)
-                query = res
-                try_count += 1
-            else:
-                response = res
+        payload = self.payload(query)
+        for attempt in range(self.max_retries + 1):
+            status, result, retry_after = self.process(payload)
+            if result is not None:
+                return result
+            if status != 200 and not retryable(status):
                 break
-        if response is None:
-            logging.error(f"Failed to get response for query: {query}")
-        return response
+            if attempt < self.max_retries:
+                time.sleep(backoff_delay(attempt, retry_after))
+        logging.error(f"Failed to get response for query: {query}")
+        return None, None
 
     @llm_completion_callback()
     def complete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
-        response = self.inference(prompt)
+        cache = self.cache
+        payload = self.payload(prompt)
+        response = cache.get(payload) if cache is not None else None
+        if response is None:
+            response, usage = self.inference(prompt)
+            if cache is not None:
+                cache.put(payload, response, usage)
+        return CompletionResponse(text=response)
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        cache = self.cache
+        payload = self.payload(prompt)
+        response = cache.get(payload) if cache is not None else None
+        if response is None:
+            response, usage = await self.async_client().complete(payload)
+            if response is None:
+                logging.error(f"Failed to get response for query: {prompt}")
+            elif cache is not None:
+                cache.put(payload, response, usage)
         return CompletionResponse(text=response)
 
     @llm_completion_callback()
     def stream_complete(
         self, prompt: str, **kwargs: Any
     ) -> CompletionResponseGen:
-        response = self.inference(prompt)
+        response, _ = self.inference(prompt)
         for token in response:
             response += token
             yield CompletionResponse(text=response, delta=token)
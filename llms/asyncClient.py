@@ -0,0 +1,175 @@
+import time
+import asyncio
+import logging
+import collections
+
+import httpx
+
+from completion_cache import parse_response, retryable, parse_retry_after, backoff_delay
+
+
+def estimate_tokens(payload):
+    """
+    Tokens a request counts against a tokens/minute limit: about four characters per prompt
+    token plus max_tokens, which providers reserve up front.
+    """
+    prompt_chars = sum(len(message["content"]) for message in payload["messages"])
+    return prompt_chars // 4 + payload.get("max_tokens", 0) * payload.get("n", 1)
+
+
+async def gather_bounded(fn, items, window):
+    """
+    Await fn(item) for every item with at most `window` in flight, results in input order.
+    """
+    results, pending = [], collections.deque()
+    for item in items:
+        pending.append(asyncio.ensure_future(fn(item)))
+        if len(pending) >= window:
+            results.append(await pending.popleft())
+    while pending:
+        results.append(await pending.popleft())
+    return results
+
+
+class TokenBucket:
+    """
+    Refills `rate_per_minute` units per minute up to `burst_seconds` worth; acquire waits until
+    the bucket is full enough, then takes the whole amount, so a request larger than the burst
+    leaves a debt later requests wait out. Providers enforce per-minute limits over shorter
+    windows, a full minute's burst up front is throttled.
+    """
+    def __init__(self, rate_per_minute, burst_seconds=1.0):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        # empty at first, the provider may count requests of the last minute already
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= min(amount, self.capacity):
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((min(amount, self.capacity) - self.tokens) / self.rate)
+
+
+class AIMDLimiter:
+    """
+    Concurrency limit that grows by one per window of successful requests (additive increase)
+    and is cut by `decrease` on a 429 or 5xx (multiplicative decrease), at most once per window.
+    Until the first cut it grows by one per success, doubling per window (slow start), so short
+    runs are not spent ramping up from `initial`.
+    """
+    def __init__(self, initial=4, min_limit=1, max_limit=64, decrease=0.5):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.slow_start = True
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, throttled):
+        async with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                # requests already in flight when the limit was cut report the same overload
+                if now - self.last_decrease > 1.0:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self.last_decrease = now
+                    self.slow_start = False
+            else:
+                self.limit = min(self.max_limit, self.limit + (1.0 if self.slow_start else 1.0 / self.limit))
+            self.condition.notify_all()
+
+
+class AsyncLLMClient:
+    """
+    Pooled keep-alive HTTP client for chat completions. Requests pass a requests/min and a
+    tokens/min TokenBucket and an AIMDLimiter, retryable responses are sent again after
+    backoff_delay.
+    """
+    def __init__(self, url, headers, rpm_limit=None, tpm_limit=None, initial_concurrency=4, max_concurrency=64,
+                 timeout=60, max_retries=3):
+        self.url = url
+        self.headers = headers
+        self.max_retries = max_retries
+        self.loop = asyncio.get_running_loop()
+        self.client = httpx.AsyncClient(timeout=timeout, limits=httpx.Limits(max_connections=max_concurrency,
+                                                                              max_keepalive_connections=max_concurrency))
+        self.request_bucket = TokenBucket(rpm_limit) if rpm_limit else None
+        self.token_bucket = TokenBucket(tpm_limit) if tpm_limit else None
+        self.limiter = AIMDLimiter(initial=min(initial_concurrency, max_concurrency), max_limit=max_concurrency)
+        self.requests = 0
+        self.throttled = 0
+        self.failures = 0
+        self.latency = 0.0
+
+    async def post(self, payload):
+        """
+        (status code, json body or None, Retry-After seconds or None) of one attempt.
+        """
+        if self.request_bucket is not None:
+            await self.request_bucket.acquire(1)
+        if self.token_bucket is not None:
+            await self.token_bucket.acquire(estimate_tokens(payload))
+        await self.limiter.acquire()
+        status, body, retry_after = 0, None, None
+        start = time.monotonic()
+        try:
+            response = await self.client.post(self.url, json=payload, headers=self.headers)
+            status = response.status_code
+            if status == 200:
+                body = response.json()
+            retry_after = response.headers.get("retry-after")
+        except (httpx.HTTPError, ValueError) as e:
+            logging.warning(f"LLM request failed: {e!r}")
+        finally:
+            self.latency += time.monotonic() - start
+            self.requests += 1
+            throttled = retryable(status)
+            self.throttled += throttled
+            await self.limiter.release(throttled)
+        return status, body, parse_retry_after(retry_after)
+
+    async def complete(self, payload):
+        """
+        (completion text, token usage or None), text None after max_retries failed attempts.
+        """
+        for attempt in range(self.max_retries + 1):
+            status, body, retry_after = await self.post(payload)
+            if body is not None:
+                try:
+                    return parse_response(body)
+                except (KeyError, IndexError, TypeError):
+                    logging.warning(f"Unexpected LLM response: {str(body)[:200]}")
+            if status != 200 and not retryable(status):
+                break
+            if attempt < self.max_retries:
+                await asyncio.sleep(backoff_delay(attempt, retry_after))
+        self.failures += 1
+        return None, None
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "failures": self.failures,
+            "concurrency_limit": round(self.limiter.limit, 1),
+            "mean_latency_s": round(self.latency / max(self.requests, 1), 3),
+        }
+
+    async def aclose(self):
+        await self.client.aclose()
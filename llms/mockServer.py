@@ -0,0 +1,119 @@
+import sys
+import json
+import time
+import random
+import logging
+import threading
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class MockOpenAIServer:
+    """
+    Local OpenAI-compatible /v1/chat/completions endpoint for throughput tests of the llm clients.
+    Answers after `latency` seconds, with 429 and a Retry-After beyond rpm_limit requests in the
+    last `window` seconds (scaled down from a minute so a benchmark sees several windows) and
+    with 500 for error_rate of the requests.
+    """
+    def __init__(self, host='127.0.0.1', port=0, rpm_limit=600, window=5.0, latency=0.2, error_rate=0.0):
+        self.limit = max(1, int(rpm_limit * window / 60))
+        self.window = window
+        self.latency = latency
+        self.error_rate = error_rate
+        self.accepted = collections.deque()
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        self.in_flight = 0
+        self.httpd = ThreadingHTTPServer((host, port), self.handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def api_base(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def admit(self):
+        """
+        HTTP status of a new request, 200 when it is within the rate limit.
+        """
+        with self.lock:
+            now = time.monotonic()
+            while self.accepted and now - self.accepted[0] > self.window:
+                self.accepted.popleft()
+            if len(self.accepted) >= self.limit:
+                status = 429
+            elif random.random() < self.error_rate:
+                status = 500
+            else:
+                self.accepted.append(now)
+                self.in_flight += 1
+                self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.in_flight)
+                status = 200
+            self.stats[status] += 1
+            return status
+
+    def completion(self, payload):
+        prompt = ' '.join(message["content"] for message in payload.get("messages", []))
+        text = f"mock answer to: {prompt[:64]}"
+        return {
+            "id": f"chatcmpl-mock{self.stats[200]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "mock"),
+            "choices": [{"index": idx, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+                        for idx in range(payload.get("n", 1))],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(text) // 4,
+                      "total_tokens": (len(prompt) + len(text)) // 4},
+        }
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not self.path.endswith("/chat/completions"):
+                    return self.reply(404, {"error": {"message": f"unknown path {self.path}"}})
+                status = server.admit()
+                if status == 429:
+                    return self.reply(429, {"error": {"message": "rate limit exceeded"}}, {"Retry-After": "1"})
+                if status == 500:
+                    return self.reply(500, {"error": {"message": "mock server error"}})
+                time.sleep(server.latency)
+                with server.lock:
+                    server.in_flight -= 1
+                self.reply(200, server.completion(payload))
+
+            def reply(self, status, body, headers=None):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        logging.info(f"Mock OpenAI server listening on {self.api_base}")
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    server = MockOpenAIServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8000)
+    server.httpd.serve_forever()
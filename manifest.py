@@ -0,0 +1,121 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+
+from utils import stable_hash
+from pipeline_scheduler import code_version
+
+
+def file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    Per stage folder record of the input files a stage consumed (content hash, size, mtime)
+    and the output each one produced, together with the fingerprint of the stage config and
+    of the operator code. Used to redo only new or changed inputs and to drop the outputs of deleted inputs.
+    """
+    file_name = "manifest.json"
+
+    def __init__(self, output_folder, config, operator_name, sidecar_suffixes=()):
+        self.path = os.path.join(output_folder, self.file_name)
+        self.output_folder = output_folder
+        # files written next to each output, removed along with it
+        self.sidecar_suffixes = sidecar_suffixes
+        self.config_fingerprint = stable_hash([config, code_version(operator_name)])
+        self.lock = threading.Lock()
+        self.files = {}
+        # entries of a run with another config or code, every input is processed again but
+        # remove_deleted still drops the outputs of theirs that the new run does not write
+        self.stale = {}
+        # outputs written before manifests existed are trusted once, as they were before
+        self.adopt_existing = not os.path.exists(self.path)
+        if not self.adopt_existing:
+            manifest = json.load(open(self.path))
+            if manifest.get("config_fingerprint") == self.config_fingerprint:
+                self.files = manifest.get("files", {})
+            else:
+                self.stale = manifest.get("files", {})
+                logging.info(f"Config or code changed since the last run, reprocessing every file in {output_folder}")
+
+    def is_unchanged(self, name, input_file, output_file):
+        """
+        Whether output_file is up to date with input_file. Only hashes the input when its size or mtime moved.
+        """
+        if not os.path.exists(output_file):
+            return False
+        stat = os.stat(input_file)
+        with self.lock:
+            entry = self.files.get(name)
+        if entry is None:
+            if self.adopt_existing:
+                self.record(name, input_file, output_file)
+                return True
+            return False
+        if entry["output"] != os.path.basename(output_file) or entry["size"] != stat.st_size:
+            return False
+        if entry["mtime"] == stat.st_mtime:
+            return True
+        if entry["sha256"] != file_sha256(input_file):
+            return False
+        with self.lock:
+            entry["mtime"] = stat.st_mtime
+        return True
+
+    def record(self, name, input_file, output_file):
+        stat = os.stat(input_file)
+        entry = {
+            "sha256": file_sha256(input_file),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "output": os.path.basename(output_file),
+        }
+        with self.lock:
+            self.files[name] = entry
+
+    def forget(self, name):
+        with self.lock:
+            self.files.pop(name, None)
+
+    def remove_output(self, output):
+        output_file = os.path.join(self.output_folder, output)
+        for suffix in ('',) + tuple(self.sidecar_suffixes):
+            if os.path.exists(output_file + suffix):
+                os.remove(output_file + suffix)
+        return output_file
+
+    def remove_deleted(self, current_names):
+        """
+        Drop entries, and their outputs, whose input is no longer in current_names, and the
+        outputs of stale entries that the current run did not write again.
+        """
+        removed = []
+        for name in list(self.files):
+            if name in current_names:
+                continue
+            output_file = self.remove_output(self.files[name]["output"])
+            logging.info(f"Removed {output_file} as its source {name} was deleted")
+            self.forget(name)
+            removed.append(name)
+        current_outputs = {entry["output"] for entry in self.files.values()}
+        for name, entry in self.stale.items():
+            if entry["output"] not in current_outputs:
+                output_file = self.remove_output(entry["output"])
+                logging.info(f"Removed {output_file} of {name}, written by the previous config or code")
+                if name not in current_names:
+                    removed.append(name)
+        self.stale = {}
+        return removed
+
+    def save(self):
+        with self.lock:
+            manifest = {"config_fingerprint": self.config_fingerprint, "files": self.files}
+            with open(self.path, 'w') as f:
+                json.dump(manifest, f, indent=2, ensure_ascii=False)
@@ -0,0 +1,89 @@
+import os
+import json
+import inspect
+import hashlib
+import logging
+
+from eval_search.utils import clean_text
+from utils import atomic_write
+
+# written next to the parsed_files.json of a search stage
+NORMALIZED_TEXT_FILE = 'normalized_text.jsonl'
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+def normalize(node):
+    """
+    {"id_", "hash", "content", "clean", "clean_lower"} of a node dict.
+    """
+    text = node['text']
+    digest = content_hash(text)
+    clean = clean_text(text)
+    return {"id_": node.get('id_') or digest, "hash": digest, "content": text, "clean": clean, "clean_lower": clean.lower()}
+
+
+# source hash of the normalization, the header record of a store file; files of another version are not read
+NORMALIZER_VERSION = hashlib.sha256((inspect.getsource(clean_text) + inspect.getsource(normalize)).encode('utf-8')).hexdigest()[:16]
+
+
+def is_current(path):
+    """
+    Whether path is a store file written by this version of the normalization.
+    """
+    if not os.path.exists(path):
+        return False
+    with open(path, 'r', encoding='utf-8') as f:
+        try:
+            return json.loads(f.readline()).get("normalizer") == NORMALIZER_VERSION
+        except ValueError:
+            return False
+
+
+class NormalizedTextStore:
+    """
+    Content, clean_text and lowercased clean_text of node dicts, keyed by node id and checked
+    against the hash of the content, so a node edited under the same id is normalized again.
+    Written as json lines, a NORMALIZER_VERSION header then one record per node, by the search
+    stage that writes the nodes; readers normalize the nodes the file misses in memory and never
+    write it.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        if path is not None and os.path.exists(path):
+            if not is_current(path):
+                logging.info(f"{path} was written by another version of clean_text, normalizing again")
+                return
+            with open(path, 'r', encoding='utf-8') as f:
+                f.readline()
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry["id_"]] = entry
+
+    def get(self, node):
+        """
+        {"id_", "hash", "content", "clean", "clean_lower"} of a node dict.
+        """
+        digest = content_hash(node['text'])
+        entry = self.entries.get(node.get('id_') or digest)
+        if entry is None or entry["hash"] != digest:
+            entry = normalize(node)
+            self.entries[entry["id_"]] = entry
+        return entry
+
+    @staticmethod
+    def write(path, nodes):
+        """
+        Normalize node dicts one at a time into path.
+        """
+        count = 0
+        with atomic_write(path) as tmp_path, open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({"normalizer": NORMALIZER_VERSION}) + '\n')
+            for node in nodes:
+                f.write(json.dumps(normalize(node), ensure_ascii=False) + '\n')
+                count += 1
+        logging.info(f"Saved {count} normalized texts to {path}")
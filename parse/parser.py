@@ -1,12 +1,19 @@
 from typing import Optional, List, Mapping, Any, Dict
 from abc import ABC, abstractmethod
 import os
+import time
 import shutil
 import logging
+import multiprocessing
+from multiprocessing.connection import wait
 
-from utils import truncate_filename
+from utils import truncate_filename, fork_is_safe
+from manifest import Manifest
 
 class Parser(ABC):
+    # reruns only reparse new or changed files, see Manifest
+    incremental = True
+
     @property
     @abstractmethod
     def supported_input_formats(self) -> List[str]:
@@ -16,10 +23,13 @@ class Parser(ABC):
         pass
 
     def __init__(self, config, inp_folder):
+        self.config = config
         self.input_file_formats = config["input_file_suffix"]
         self.output_file_format = 'document'
         self.file_exclude = config.get("file_exclude", [])
         self.copy_file_if_format_not_in_suffix_list = config.get("copy_file_if_format_not_in_suffix_list", False)
+        self.num_workers = config.get("num_workers", 1)
+        self.parse_timeout = config.get("parse_timeout", None)
         self.validate_input_format()
 
     def validate_input_format(self):
@@ -34,6 +44,56 @@ class Parser(ABC):
         """
         pass
 
+    def _parse_file_in_child(self, input_file: str, output_file: str):
+        try:
+            success = self.parse_file(input_file, output_file)
+        except Exception as e:
+            logging.error(f"Failed to parse {input_file}: {e}")
+            os._exit(2)
+        os._exit(0 if success else 1)
+
+    def parse_files(self, tasks):
+        """
+        Parse (input_file, output_file) pairs, yielding (input_file, success).
+        With num_workers > 1 or a parse_timeout every file is parsed in its own forked
+        process, so a crash only fails that file and a hung file is killed after parse_timeout seconds.
+        Forking needs a single-threaded parent, files are parsed in process (without the timeout)
+        when other threads run, e.g. parallel pipeline stages.
+        """
+        if (self.num_workers <= 1 and not self.parse_timeout) or not fork_is_safe("parsing"):
+            for input_file, output_file in tasks:
+                logging.info(f"Parsing {input_file}")
+                yield input_file, self.parse_file(input_file, output_file)
+            return
+
+        ctx = multiprocessing.get_context("fork")
+        pending = list(tasks)
+        running = {}
+        while pending or running:
+            while pending and len(running) < max(1, self.num_workers):
+                input_file, output_file = pending.pop(0)
+                logging.info(f"Parsing {input_file}")
+                proc = ctx.Process(target=self._parse_file_in_child, args=(input_file, output_file), daemon=True)
+                proc.start()
+                running[proc] = (input_file, output_file, time.monotonic())
+            wait([proc.sentinel for proc in running], timeout=1)
+            for proc, (input_file, output_file, start) in list(running.items()):
+                timed_out = False
+                if proc.is_alive():
+                    if not self.parse_timeout or time.monotonic() - start < self.parse_timeout:
+                        continue
+                    logging.error(f"Parsing {input_file} timed out after {self.parse_timeout}s, killing it")
+                    proc.kill()
+                    timed_out = True
+                proc.join()
+                del running[proc]
+                success = proc.exitcode == 0
+                if not timed_out and proc.exitcode not in (0, 1, 2):
+                    logging.error(f"Parsing {input_file} crashed with exit code {proc.exitcode}")
+                if not success and os.path.exists(output_file):
+                    os.remove(output_file)
+                yield input_file, success
+
     def process(self, input_folder: str, output_folder: str):
         """
         Parse all files in the input folder and write the parsed output to the output folder.
@@ -44,6 +104,10 @@ class Parser(ABC):
         files_skipped_supported = []
         files_skipped_excluded = []
         files_failed = []
+        parse_tasks = []
+        task_names = {}
+        current_names = set()
+        manifest = Manifest(output_folder, self.config, "parse")
         for file in files:
             processed += 1
             input_file = os.path.join(input_folder, file)
@@ -55,22 +119,34 @@ class Parser(ABC):
             if suffix not in self.input_file_formats:
                 if self.copy_file_if_format_not_in_suffix_list:
                     output_file = os.path.join(output_folder, file)
-                    shutil.copy(input_file, output_file)
+                    current_names.add(file)
+                    if not manifest.is_unchanged(file, input_file, output_file):
+                        shutil.copy(input_file, output_file)
+                        manifest.record(file, input_file, output_file)
+                        logging.info(f"Copying {input_file} to {output_file}")
                     files_copied.append(input_file)
-                    logging.info(f"Copying {input_file} to {output_file}")
                 else:
                     files_skipped_supported.append(input_file)
                     logging.info(f"Skipping {input_file} as it is not supported")
                 continue
             output_file = os.path.join(output_folder, file + f'.{self.output_file_format}')
             output_file = truncate_filename(output_file)
-            if not os.path.exists(output_file):
-                logging.info(f"Parsing ({processed}/{len(files)}) {input_file}")
-                success = self.parse_file(input_file, output_file)
-                if not success:
-                    files_failed.append(input_file)
+            current_names.add(file)
+            if not manifest.is_unchanged(file, input_file, output_file):
+                parse_tasks.append((input_file, output_file))
+                task_names[input_file] = (file, output_file)
             else:
                 logging.info(f"Skipping {input_file} as it is already parsed")
+        manifest.remove_deleted(current_names)
+        for parsed, (input_file, success) in enumerate(self.parse_files(parse_tasks)):
+            logging.info(f"Parsed ({parsed + 1}/{len(parse_tasks)}) {input_file}")
+            file, output_file = task_names[input_file]
+            if success:
+                manifest.record(file, input_file, output_file)
+            else:
+                manifest.forget(file)
+                files_failed.append(input_file)
+        manifest.save()
         logging.info(f"Processed {processed} files")
         logging.info(f"Files copied: {files_copied}")
         logging.info(f"Files skipped as they are not supported: {files_skipped_supported}")
@@ -0,0 +1,321 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from utils import import_class, stable_hash
+
+# sources outside the operator packages that change what an operator writes
+SHARED_SOURCES = ["utils.py", "format_converter.py", "dataset_filters.py", "query_engine", "llms",
+                  "sqlite_cache.py", "completion_cache.py"]
+# sources of other packages an operator imports, keyed by operator
+OPERATOR_SOURCES = {
+    "parse": ["manifest.py"],
+    "chunk": ["manifest.py", "embedding_cache.py"],
+    "search": ["normalized_text.py", "eval_search/utils.py", "embedding_cache.py", "rerank_cache.py"],
+    "eval_search": ["normalized_text.py"],
+}
+# operator config keys naming the config of another operator the stage loads and runs
+OPERATOR_REFERENCES = {"searcher_config_name": "search"}
+# operator config keys naming a folder of the dataset the stage reads besides its input folder
+FOLDER_REFERENCES = ["search_eval_results"]
+# written while a stage runs, lets a resumable operator continue after a crash
+RUNNING_FILE = "running.json"
+# files of a dataset folder that stages read besides their input folder
+DATASET_FILES = ["rag_dataset.json"]
+
+_code_versions = {}
+
+
+def _hash_sources(digest, path):
+    if os.path.isfile(path):
+        digest.update(path.encode('utf-8'))
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+        return
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+        for file in sorted(files):
+            if file.endswith('.py'):
+                _hash_sources(digest, os.path.join(root, file))
+
+
+def code_version(operator_name):
+    """
+    Hash of the python sources the operator package, the modules it imports from elsewhere
+    (OPERATOR_SOURCES) and the shared modules are made of.
+    """
+    if operator_name not in _code_versions:
+        digest = hashlib.sha256()
+        for path in [operator_name] + OPERATOR_SOURCES.get(operator_name, []) + SHARED_SOURCES:
+            if os.path.exists(path):
+                _hash_sources(digest, path)
+        _code_versions[operator_name] = digest.hexdigest()
+    return _code_versions[operator_name]
+
+
+def folder_fingerprint(folder):
+    """
+    Fingerprint of a folder the pipeline did not produce (e.g. the start point).
+    Folders written by a stage carry their fingerprint in config.json.
+    """
+    stage_config = os.path.join(folder, "config.json")
+    if os.path.exists(stage_config):
+        fingerprint = json.load(open(stage_config)).get("fingerprint")
+        if fingerprint:
+            return fingerprint
+    signature = []
+    if os.path.isdir(folder):
+        for file in sorted(os.listdir(folder)):
+            stat = os.stat(os.path.join(folder, file))
+            signature.append([file, stat.st_size, stat.st_mtime])
+    return stable_hash(signature)
+
+
+def dataset_fingerprint(dataset_folder):
+    """
+    Fingerprint of the dataset level files (DATASET_FILES) that stages read besides their input folder.
+    Other files in the dataset folder, e.g. reports, do not invalidate the stages.
+    """
+    signature = []
+    for file in DATASET_FILES:
+        path = os.path.join(dataset_folder, file)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            signature.append([file, stat.st_size, stat.st_mtime])
+    return stable_hash(signature)
+
+
+def root_fingerprint(config, dataset):
+    """
+    Fingerprint of what the first stage of a pipeline reads for one dataset.
+    """
+    dataset_folder = os.path.join('datasets', dataset)
+    start_folder = os.path.join(dataset_folder, config["start_point"])
+    return stable_hash([folder_fingerprint(start_folder), dataset_fingerprint(dataset_folder)])
+
+
+def load_operator_config(operator_name, config_name):
+    operator_config_path = os.path.join(operator_name, "config", f"{config_name}.json")
+    return json.load(open(operator_config_path))
+
+
+def operator_references(operator_config):
+    """
+    {config key: config and code version} of the other operators the operator config names (OPERATOR_REFERENCES).
+    """
+    references = {}
+    for key, operator_name in OPERATOR_REFERENCES.items():
+        if operator_config.get(key):
+            references[key] = {
+                "operator_config": load_operator_config(operator_name, operator_config[key]),
+                "code_version": code_version(operator_name),
+            }
+    return references
+
+
+class Stage:
+    """
+    inputs: {config key: Stage or fingerprint} of the folders the operator reads besides its
+    input folder (FOLDER_REFERENCES), stages among them are dependencies like the upstream.
+    """
+    def __init__(self, name, operation, operator_config, output_folder, upstream=None, input_folder=None, root_fingerprint=None,
+                 inputs=None):
+        self.name = name
+        self.operation = operation
+        self.operator_name = operation["operator"]
+        self.operator_config = operator_config
+        self.output_folder = output_folder
+        self.upstream = upstream
+        self.input_folder = input_folder
+        self.inputs = inputs or {}
+        upstream_fingerprint = upstream.fingerprint if upstream is not None else root_fingerprint
+        self.fingerprint = stable_hash({
+            "operator": self.operator_name,
+            "operator_config": operator_config,
+            "code_version": code_version(self.operator_name),
+            "upstream": upstream_fingerprint,
+            "references": operator_references(operator_config),
+            "inputs": {key: value.fingerprint if isinstance(value, Stage) else value for key, value in self.inputs.items()},
+        })
+
+    @property
+    def dependencies(self):
+        deps = [self.upstream] if self.upstream is not None else []
+        return deps + [value for value in self.inputs.values() if isinstance(value, Stage)]
+
+    def is_materialized(self):
+        stage_config = os.path.join(self.output_folder, "config.json")
+        if not os.path.exists(stage_config):
+            return False
+        return json.load(open(stage_config)).get("fingerprint") == self.fingerprint
+
+    def is_resumable(self, OpClass):
+        """
+        An interrupted run of this very stage left the folder and the operator can pick up from its partial output.
+        """
+        running_file = os.path.join(self.output_folder, RUNNING_FILE)
+        if not getattr(OpClass, "resumable", False) or not os.path.exists(running_file):
+            return False
+        return json.load(open(running_file)).get("fingerprint") == self.fingerprint
+
+    def load_operator_class(self):
+        class_name = self.operator_config["class_name"]
+        class_file = self.operator_config["class_file"]
+        module_path = f"{self.operator_name}.{class_file}"
+        return import_class(module_path, class_name)
+
+    def run(self):
+        inp_folder = self.upstream.output_folder if self.upstream is not None else self.input_folder
+        if self.is_materialized():
+            logging.info(f"Skipping {self.name}, {self.output_folder} is up to date")
+            return self.output_folder
+
+        # Dynamically importing the operator class
+        OpClass = self.load_operator_class()
+        if os.path.exists(self.output_folder) and not getattr(OpClass, "incremental", False) and not self.is_resumable(OpClass):
+            logging.info(f"Output folder {self.output_folder} is stale, removing it.")
+            shutil.rmtree(self.output_folder)
+        if not os.path.exists(self.output_folder):
+            os.makedirs(self.output_folder)
+        running_file = os.path.join(self.output_folder, RUNNING_FILE)
+        with open(running_file, "w") as f:
+            json.dump({"fingerprint": self.fingerprint}, f)
+
+        # Instantiate the operator with its configuration
+        operator = OpClass(self.operator_config, inp_folder)
+        if not hasattr(operator, "process"):
+            raise ValueError(f"The operator {self.operator_config['class_name']} does not support processing")
+        self.output_folder = operator.process(inp_folder, self.output_folder)
+
+        operation = dict(self.operation)
+        operation['input_folder'] = inp_folder
+        operation['operator_config'] = self.operator_config
+        operation['fingerprint'] = self.fingerprint
+        with open(os.path.join(self.output_folder, "config.json"), "w") as f:
+            json.dump(operation, f, indent=2, ensure_ascii=False)
+        if os.path.exists(running_file):
+            os.remove(running_file)
+        logging.info(f"Finished processing {self.name}")
+        return self.output_folder
+
+
+class PipelineScheduler:
+    """
+    Runs stages as a DAG: a stage starts once its dependencies finished, independent
+    branches run concurrently and stages whose fingerprint is already materialized are skipped.
+    """
+    def __init__(self, max_workers=1):
+        self.max_workers = max_workers
+        self.stages = []
+        self.stage_by_fingerprint = {}
+
+    def add_stage(self, stage):
+        """
+        Add a stage, returning the already registered stage if one with the same fingerprint exists.
+        """
+        if stage.fingerprint in self.stage_by_fingerprint:
+            return self.stage_by_fingerprint[stage.fingerprint]
+        self.stage_by_fingerprint[stage.fingerprint] = stage
+        self.stages.append(stage)
+        return stage
+
+    def folder_input(self, folder):
+        """
+        The registered stage writing folder, so a stage reading it waits for it, else the folder's fingerprint.
+        """
+        for stage in self.stages:
+            if os.path.normpath(stage.output_folder) == os.path.normpath(folder):
+                return stage
+        if not os.path.exists(folder):
+            logging.warning(f"{folder} is read by a stage but neither exists nor is written by an earlier stage")
+        return folder_fingerprint(folder)
+
+    def add_pipeline(self, config, dataset):
+        """
+        Expand config["pipeline"] for one dataset into stages. An operation may name itself
+        with "name" and read from an earlier operation with "input" (default: the previous one).
+        Folders an operator config names (FOLDER_REFERENCES) must be written by an earlier stage
+        of this scheduler to be waited for. Returns the stages in pipeline order.
+        """
+        dataset_folder = os.path.join('datasets', dataset)
+        start_folder = os.path.join(dataset_folder, config["start_point"])
+        root = root_fingerprint(config, dataset)
+        save_folder_prefix_list = config["save_folder_prefix_list"]
+        start_prefix = [config["start_prefix"]] if config["start_prefix"] else []
+
+        named = {}
+        prefixes = {}
+        stages = []
+        prev_stage = None
+        for operation in config["pipeline"]:
+            operation = dict(operation)
+            if "input" in operation:
+                if operation["input"] == config["start_point"]:
+                    upstream = None
+                else:
+                    upstream = named[operation["input"]]
+            else:
+                upstream = prev_stage
+            prefix = list(prefixes[id(upstream)]) if upstream is not None else list(start_prefix)
+            prefix += [operation[key] for key in save_folder_prefix_list if key in operation]
+            output_folder = os.path.join(dataset_folder, '_'.join(prefix))
+
+            operator_config = load_operator_config(operation["operator"], operation["config_name"])
+            inputs = {key: self.folder_input(os.path.join(dataset_folder, operator_config[key]))
+                      for key in FOLDER_REFERENCES if operator_config.get(key)}
+            name = operation.get("name", f"{dataset}/{'_'.join(prefix)}")
+            stage = Stage(name, operation, operator_config, output_folder,
+                          upstream=upstream, input_folder=start_folder, root_fingerprint=root, inputs=inputs)
+            stage = self.add_stage(stage)
+            prefixes[id(stage)] = prefix
+            if "name" in operation:
+                named[operation["name"]] = stage
+            stages.append(stage)
+            prev_stage = stage
+        return stages
+
+    def submit(self, executor, stage):
+        """
+        executor.submit(stage.run), or stage.run in this thread with a single worker so operators
+        that fork worker processes (parse, eval_search) run in a single-threaded process.
+        """
+        if self.max_workers > 1:
+            return executor.submit(stage.run)
+        future = Future()
+        try:
+            future.set_result(stage.run())
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def run(self):
+        pending = list(self.stages)
+        done = set()
+        failed = set()
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for stage in list(pending):
+                    deps = stage.dependencies
+                    if any(id(dep) in failed for dep in deps):
+                        logging.error(f"Skipping {stage.name} as an upstream stage failed")
+                        failed.add(id(stage))
+                        pending.remove(stage)
+                    elif all(id(dep) in done for dep in deps):
+                        running[self.submit(executor, stage)] = stage
+                        pending.remove(stage)
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(id(stage))
+                    except Exception as e:
+                        logging.exception(f"Stage {stage.name} failed: {e}")
+                        failed.add(id(stage))
+        return len(failed) == 0
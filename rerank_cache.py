@@ -0,0 +1,33 @@
+import struct
+import hashlib
+
+from sqlite_cache import SQLiteCache
+
+
+class RerankCache:
+    """
+    On-disk cross-encoder scores keyed by (reranker model, max_length, query, candidate content hash).
+    """
+    def __init__(self, path, model_name, max_length=512, max_entries=None):
+        self.model_name = model_name
+        self.max_length = max_length
+        self.store = SQLiteCache(path, "rerank_scores", max_entries=max_entries)
+
+    def key(self, query, text):
+        content_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        payload = f"{self.model_name}\0{self.max_length}\0{query}\0{content_hash}"
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_many(self, pairs):
+        """
+        Return {index in pairs: score} for the cached pairs.
+        """
+        keys = [self.key(query, text) for query, text in pairs]
+        found = self.store.get_many(keys)
+        return {idx: struct.unpack('f', found[key])[0] for idx, key in enumerate(keys) if key in found}
+
+    def put_many(self, pairs, scores):
+        self.store.put_many({self.key(query, text): struct.pack('f', float(score)) for (query, text), score in zip(pairs, scores)})
+
+    def stats(self):
+        return self.store.stats()
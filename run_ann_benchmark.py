@@ -0,0 +1,116 @@
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import logging
+
+import numpy as np
+
+from format_converter import read_node_file
+from search.denseIndex import DenseIndex, normalize_rows, embed_queries
+from search.annIndex import ANN_BACKENDS
+
+# set logging level
+logging.basicConfig(level=logging.INFO)
+
+
+def load_matrix(chunk_folder):
+    """
+    The persisted dense index of the chunk folder if a searcher built one, else the normalized .node embeddings.
+    """
+    dense_indexes = sorted(glob.glob(os.path.join(chunk_folder, "dense_index_*.npy")), key=os.path.getmtime)
+    if dense_indexes:
+        logging.info(f"Using dense index {dense_indexes[-1]}")
+        return np.load(dense_indexes[-1], mmap_mode='r')
+    blocks = []
+    for file in sorted(os.listdir(chunk_folder)):
+        if not file.endswith('.node'):
+            continue
+        nodes, embeddings = read_node_file(os.path.join(chunk_folder, file))
+        if embeddings is None:
+            embeddings = np.asarray([node.embedding for node in nodes if node.embedding is not None], dtype=np.float32)
+        else:
+            embeddings = np.asarray(embeddings[~np.isnan(embeddings[:, 0])], dtype=np.float32)
+        if len(embeddings) > 0:
+            blocks.append(embeddings)
+    if not blocks:
+        raise ValueError(f"No embeddings found in {chunk_folder}")
+    return normalize_rows(np.concatenate(blocks))
+
+
+def load_queries(config, matrix):
+    """
+    Embedded queries of the dataset's rag_dataset.json when embed_model_name is set,
+    otherwise corpus rows sampled as queries.
+    """
+    num_queries = config.get("num_queries", 1000)
+    rng = np.random.default_rng(config.get("seed", 0))
+    if config.get("embed_model_name"):
+        from utils import load_embed_model
+        rag_dataset = json.load(open(os.path.join(os.path.dirname(config["chunk_folder"].rstrip('/')), "rag_dataset.json")))
+        queries = [example["query"] for example in rag_dataset["examples"]]
+        if len(queries) > num_queries:
+            queries = [queries[idx] for idx in np.sort(rng.choice(len(queries), num_queries, replace=False))]
+        return embed_queries(load_embed_model(config["embed_model_name"]), queries)
+    rows = np.sort(rng.choice(len(matrix), min(num_queries, len(matrix)), replace=False))
+    return np.asarray(matrix[rows], dtype=np.float32)
+
+
+def recall_at_k(exact_indices, approx_indices):
+    hits = [len(set(exact) & set(approx[approx >= 0])) for exact, approx in zip(exact_indices, approx_indices)]
+    return sum(hits) / exact_indices.size
+
+
+def per_query_latency(index, queries, top_k):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query[None, :], top_k)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return float(np.percentile(latencies, 50)), float(np.percentile(latencies, 99))
+
+
+def run_benchmark(config):
+    """
+    Recall@k against exact search, per-query p50/p99 latency and build time for every
+    parameter set in config["param_grid"]. Results go to <chunk_folder>/ann_benchmark.csv.
+    """
+    top_k = config.get("top_k", 30)
+    matrix = load_matrix(config["chunk_folder"])
+    queries = load_queries(config, matrix)
+    logging.info(f"Benchmarking over {len(matrix)} rows with {len(queries)} queries, top_k={top_k}")
+
+    exact = DenseIndex(matrix)
+    exact_scores, exact_indices = exact.search(queries, top_k)
+    p50, p99 = per_query_latency(exact, queries, top_k)
+    rows = [{"backend": "exact", "params": "{}", "build_time_s": 0.0, f"recall@{top_k}": 1.0, "p50_ms": p50, "p99_ms": p99}]
+
+    for params in config["param_grid"]:
+        backend = params.get("backend", config.get("backend", "ivf"))
+        params = {key: value for key, value in params.items() if key != "backend"}
+        index_class = ANN_BACKENDS[backend][0]
+        start = time.time()
+        index = index_class.build(matrix, **params)
+        build_time = time.time() - start
+        _, approx_indices = index.search(queries, top_k)
+        p50, p99 = per_query_latency(index, queries, top_k)
+        rows.append({"backend": backend, "params": json.dumps(params), "build_time_s": build_time,
+                     f"recall@{top_k}": recall_at_k(exact_indices, approx_indices), "p50_ms": p50, "p99_ms": p99})
+        logging.info(f"{backend} {params}: {rows[-1]}")
+
+    output_file = os.path.join(config["chunk_folder"], "ann_benchmark.csv")
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    logging.info(f"Benchmark results saved to {output_file}")
+    return rows
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: python run_ann_benchmark.py <benchmark_config_path>")
+        exit(1)
+    run_benchmark(json.load(open(sys.argv[1])))
@@ -0,0 +1,57 @@
+import os
+import sys
+import csv
+import copy
+import json
+import time
+import logging
+import itertools
+
+from eval_search.scoredKeywordMatchEval import ScoredKeywordMatchEval
+from format_converter import iter_recall_results, RECALL_RESULTS_FILE
+
+# set logging level
+logging.basicConfig(level=logging.INFO)
+
+
+def run_benchmark(config):
+    """
+    Time ScoredKeywordMatchEval.evaluate over the recall results of a search stage output for
+    every ratio in config["error_ratios"], exact matching (0) first, and count the hits of each.
+    Results go to <search_folder>/keyword_benchmark.csv.
+    """
+    search_folder = config["search_folder"]
+    evaluator = ScoredKeywordMatchEval(config, search_folder)
+    examples = list(itertools.islice(iter_recall_results(os.path.join(search_folder, RECALL_RESULTS_FILE), node_store=evaluator.node_store),
+                                     config.get("num_examples", 1000)))
+    logging.info(f"Benchmarking keyword matching on {len(examples)} examples")
+
+    rows = []
+    for error_ratio in config.get("error_ratios", [0, 0.1, 0.2]):
+        evaluator.eval_error_ratio = error_ratio
+        hits = {"top_hit": 0, "recall_hit": 0, "offline_hit": 0, "no_hit": 0}
+        start = time.time()
+        for example in examples:
+            result = evaluator.evaluate(copy.copy(example))
+            if result is not None:
+                hits[result["eval_results"]["hit_by"]] += 1
+        seconds = time.time() - start
+        rows.append({"error_ratio": error_ratio, "seconds": round(seconds, 3),
+                     "ms_per_example": round(seconds * 1000 / max(len(examples), 1), 3),
+                     "overhead_vs_exact": round(seconds / max(rows[0]["seconds"], 1e-6), 2) if rows else 1.0, **hits})
+        logging.info(f"error_ratio {error_ratio}: {rows[-1]}")
+
+    output_file = os.path.join(search_folder, "keyword_benchmark.csv")
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    logging.info(f"Benchmark results saved to {output_file}")
+    return rows
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: python run_keyword_benchmark.py <benchmark_config_path>")
+        exit(1)
+    run_benchmark(json.load(open(sys.argv[1])))
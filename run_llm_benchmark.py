@@ -0,0 +1,84 @@
+import sys
+import csv
+import json
+import time
+import logging
+import asyncio
+import concurrent.futures
+
+from llms.SetLLM import SetLLM
+from llms.mockServer import MockOpenAIServer
+from llms.asyncClient import gather_bounded
+
+# set logging level
+logging.basicConfig(level=logging.INFO)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+def run_threads(llm, prompts, thread_num):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=thread_num) as executor:
+        responses = list(executor.map(lambda prompt: llm.complete(prompt).text, prompts))
+    return responses, {}
+
+
+def run_async(llm, prompts, window):
+    async def main():
+        try:
+            responses = await gather_bounded(lambda prompt: llm.acomplete(prompt), prompts, window)
+            return [response.text for response in responses], llm.client_stats()
+        finally:
+            await llm.aclose()
+    return asyncio.run(main())
+
+
+def run_benchmark(config):
+    """
+    Send config["num_requests"] prompts through SetLLM with thread pools of every size in
+    config["thread_nums"] and through the async client, against the local mock server when
+    config["mock_server"] is set. Results go to config["output_file"].
+    """
+    server = None
+    llm_config = dict(config.get("llm_config", {}))
+    if "mock_server" in config:
+        server = MockOpenAIServer(**config["mock_server"]).start()
+        llm_config["api_base"] = server.api_base
+    prompt = "x" * config.get("prompt_chars", 2000)
+    prompts = [f"{idx} {prompt}" for idx in range(config.get("num_requests", 200))]
+
+    runs = [(f"threads_{thread_num}", run_threads, thread_num) for thread_num in config.get("thread_nums", [1, 8])]
+    runs.append(("async", run_async, config.get("async_window", 256)))
+    rows = []
+    for name, run, width in runs:
+        llm = SetLLM(model=config.get("base_llm", "gpt-3.5-turbo-0301"), **llm_config)
+        if server is not None:
+            server.stats.clear()
+        start = time.time()
+        responses, client_stats = run(llm, prompts, width)
+        seconds = time.time() - start
+        rows.append({"mode": name, "seconds": round(seconds, 3),
+                     "requests_per_s": round(len(prompts) / max(seconds, 1e-6), 2),
+                     "failed": sum(response is None for response in responses),
+                     "server_429": server.stats[429] if server is not None else '',
+                     "server_max_in_flight": server.stats["max_in_flight"] if server is not None else '',
+                     "final_concurrency": client_stats.get("concurrency_limit", '')})
+        logging.info(f"{name}: {rows[-1]}")
+        if server is not None:
+            # let the rate window of the mock server drain so runs start alike
+            time.sleep(server.window)
+    if server is not None:
+        server.stop()
+
+    output_file = config.get("output_file", "llm_benchmark.csv")
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    logging.info(f"Benchmark results saved to {output_file}")
+    return rows
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: python run_llm_benchmark.py <benchmark_config_path>")
+        exit(1)
+    run_benchmark(json.load(open(sys.argv[1])))
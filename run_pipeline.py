@@ -1,8 +1,7 @@
 import json
 import sys
-import os
 import logging
-from utils import import_class
+from pipeline_scheduler import PipelineScheduler
 
 # set logging level
 logging.basicConfig(level=logging.INFO)
@@ -14,41 +13,11 @@ if len(sys.argv) != 2:
 
 config_path = sys.argv[1]
 config = json.load(open(config_path))
-prev_operators = ''
 
+scheduler = PipelineScheduler(max_workers=config.get("max_parallel_stages", 1))
 for dataset in config["datasets"]:
-    inp_folder = os.path.join('datasets', dataset, config["start_point"])
-    save_folder_prefix_list = config["save_folder_prefix_list"]
-    current_prefix = []
-    if config["start_prefix"]:
-        current_prefix.append(config["start_prefix"])
-    for operation in config["pipeline"]:
-        operator_name = operation["operator"]
+    scheduler.add_pipeline(config, dataset)
 
-        config_name = operation["config_name"]
-        operator_config_path = os.path.join(operator_name, "config", f"{config_name}.json")
-        operator_config = json.load(open(operator_config_path))
-        class_name = operator_config["class_name"]
-        class_file = operator_config["class_file"]
-        module_path = f"{operator_name}.{class_file}"
-        current_prefix += [operation[key] for key in save_folder_prefix_list if key in operation]
-        ouput_folder = os.path.join('datasets', dataset, '_'.join(current_prefix))
-        # Dynamically importing the operator class
-        OpClass = import_class(module_path, class_name)
-        
-        # Instantiate the operator with its configuration
-        operator = OpClass(operator_config, inp_folder)
-
-        if hasattr(operator, "process"):
-            if not os.path.exists(ouput_folder):
-                os.makedirs(ouput_folder)
-            ouput_folder = operator.process(inp_folder, ouput_folder)
-            operation['input_folder'] = inp_folder
-            operation['operator_config'] = operator_config
-            inp_folder = ouput_folder
-            with open(os.path.join(ouput_folder, f"config.json"), "w") as f:
-                json.dump(operation, f, indent=2, ensure_ascii=False)
-        else:
-            logging.info(f"The operator {class_name} does not support processing")
-            exit(1)
-        logging.info(f"Finished processing {operator_name}")
+if not scheduler.run():
+    logging.error("Some stages failed, see the log above")
+    sys.exit(1)
@@ -0,0 +1,104 @@
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import logging
+import tempfile
+
+import numpy as np
+
+from format_converter import read_node_file
+from search.denseIndex import DenseIndex
+from search.sparseIndex import BM25Index
+from search.shardedIndex import ShardPool, ShardedDenseIndex, ShardedSparseIndex, shard_bounds, shard_sparse_index
+from run_ann_benchmark import load_matrix, load_queries
+
+# set logging level
+logging.basicConfig(level=logging.INFO)
+
+
+def load_texts(chunk_folder):
+    texts = []
+    for file in sorted(os.listdir(chunk_folder)):
+        if file.endswith('.node'):
+            nodes, _ = read_node_file(os.path.join(chunk_folder, file))
+            texts.extend(node.text for node in nodes)
+    return texts
+
+
+def queries_per_second(index, queries, top_k, batch_size):
+    start = time.perf_counter()
+    results = [index.search(queries[lo:lo + batch_size], top_k) for lo in range(0, len(queries), batch_size)]
+    return len(queries) / (time.perf_counter() - start), results
+
+
+def run_benchmark(config):
+    """
+    Queries/s and memory (uss, pss and rss) per worker of sharded search for every shard count in config["num_shards"],
+    checked against unsharded search. Results go to <chunk_folder>/shard_benchmark.csv.
+    """
+    top_k = config.get("top_k", 30)
+    batch_size = config.get("batch_size", 64)
+    chunk_folder = config["chunk_folder"]
+    matrix = np.asarray(load_matrix(chunk_folder), dtype=np.float32)
+    queries = load_queries(config, matrix)
+    work_dir = tempfile.mkdtemp(dir=chunk_folder, prefix="shard_benchmark_")
+    dense_path = os.path.join(work_dir, "dense.npy")
+    np.save(dense_path, matrix)
+
+    sparse_index, text_queries = None, None
+    if config.get("sparse", False):
+        texts = load_texts(chunk_folder)
+        if len(texts) == len(matrix):
+            sparse_index = BM25Index.build(texts)
+            rng = np.random.default_rng(config.get("seed", 0))
+            # the first sentence-ish piece of sampled chunks as keyword queries
+            text_queries = [texts[idx][:64] for idx in rng.choice(len(texts), len(queries), replace=True)]
+        else:
+            logging.warning(f"{len(texts)} node texts for {len(matrix)} embeddings, skipping the sparse benchmark")
+    logging.info(f"Benchmarking over {len(matrix)} rows with {len(queries)} queries, top_k={top_k}")
+
+    dense_qps, dense_expected = queries_per_second(DenseIndex(matrix), queries, top_k, batch_size)
+    sparse_qps, sparse_expected = queries_per_second(sparse_index, text_queries, top_k, batch_size) if sparse_index else (0.0, None)
+    rows = []
+    for num_shards in config.get("num_shards", [1, 2, 4]):
+        sparse_paths = None
+        if sparse_index is not None:
+            sparse_paths = [os.path.join(work_dir, f"sparse_shard{shard_id}of{num_shards}.npz") for shard_id in range(num_shards)]
+            for path, (lo, hi) in zip(sparse_paths, shard_bounds(len(matrix), num_shards)):
+                shard_sparse_index(sparse_index, lo, hi).save(path)
+        pool = ShardPool(len(matrix), num_shards, dense_path=dense_path, sparse_paths=sparse_paths)
+        # uss is what each worker adds, rss also counts the pages still shared with this process
+        row = {"num_shards": num_shards}
+        for kind in ["uss", "pss", "rss"]:
+            row[f"{kind}_mb_per_worker"] = json.dumps([round(m[kind]) if m[kind] is not None else None for m in pool.loaded_memory_mb])
+        row["unsharded_dense_qps"] = round(dense_qps, 1)
+        qps, results = queries_per_second(ShardedDenseIndex(pool), queries, top_k, batch_size)
+        row["dense_qps"] = round(qps, 1)
+        row["dense_matches_unsharded"] = all(np.array_equal(a[1], b[1]) for a, b in zip(results, dense_expected))
+        if sparse_index is not None:
+            qps, results = queries_per_second(ShardedSparseIndex(pool, sparse_index.vocab), text_queries, top_k, batch_size)
+            row["unsharded_sparse_qps"] = round(sparse_qps, 1)
+            row["sparse_qps"] = round(qps, 1)
+            row["sparse_matches_unsharded"] = all(np.allclose(a[0], b[0], atol=1e-5) for a, b in zip(results, sparse_expected))
+        pool.close()
+        rows.append(row)
+        logging.info(f"{num_shards} shards: {row}")
+    shutil.rmtree(work_dir)
+
+    output_file = os.path.join(chunk_folder, "shard_benchmark.csv")
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[-1]))
+        writer.writeheader()
+        writer.writerows(rows)
+    logging.info(f"Benchmark results saved to {output_file}")
+    return rows
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: python run_shard_benchmark.py <benchmark_config_path>")
+        exit(1)
+    run_benchmark(json.load(open(sys.argv[1])))
@@ -0,0 +1,128 @@
+import os
+import sys
+import csv
+import copy
+import json
+import itertools
+import logging
+from pipeline_scheduler import PipelineScheduler, Stage, load_operator_config, root_fingerprint
+
+# set logging level
+logging.basicConfig(level=logging.INFO)
+
+METRIC_FILES = ["eval_results_scores.csv", "statistic.csv"]
+
+
+def grid_for_operation(grid, operation):
+    """
+    Grid entries "<operator or operation name>.<config key>" that apply to this operation.
+    """
+    params = []
+    for key, values in grid.items():
+        target, param = key.split('.', 1)
+        if target in (operation["operator"], operation.get("name")):
+            params.append((key, param, values))
+    return params
+
+
+def expand_sweep(scheduler, config, dataset):
+    """
+    Expand the pipeline into a tree of stages, one branch per grid combination.
+    Stages whose config and upstream are identical share one fingerprint, so the
+    scheduler runs shared prefixes once and fans them out to the downstream variants.
+    Returns the leaves as (assignment, stages on the path).
+    """
+    dataset_folder = os.path.join('datasets', dataset)
+    start_folder = os.path.join(dataset_folder, config["start_point"])
+    root = root_fingerprint(config, dataset)
+    save_folder_prefix_list = config["save_folder_prefix_list"]
+    start_prefix = [config["start_prefix"]] if config["start_prefix"] else []
+    grid = config.get("grid", {})
+
+    branches = [({}, start_prefix, [])]
+    for operation in config["pipeline"]:
+        base_config = load_operator_config(operation["operator"], operation["config_name"])
+        params = grid_for_operation(grid, operation)
+        combos = list(itertools.product(*[values for _, _, values in params]))
+        new_branches = []
+        for assignment, prefix, path in branches:
+            for combo in combos:
+                operator_config = copy.deepcopy(base_config)
+                variant = {}
+                for (key, param, _), value in zip(params, combo):
+                    operator_config[param] = value
+                    variant[key] = value
+                stage_prefix = prefix + [operation[key] for key in save_folder_prefix_list if key in operation]
+                stage_prefix += [f"{param}-{value}" for (_, param, _), value in zip(params, combo)]
+                output_folder = os.path.join(dataset_folder, '_'.join(stage_prefix))
+                stage = Stage(f"{dataset}/{'_'.join(stage_prefix)}", dict(operation), operator_config, output_folder,
+                              upstream=path[-1] if path else None, input_folder=start_folder, root_fingerprint=root)
+                stage = scheduler.add_stage(stage)
+                new_branches.append(({**assignment, **variant}, stage_prefix, path + [stage]))
+        branches = new_branches
+    return [(assignment, path) for assignment, _, path in branches]
+
+
+def read_metrics(folder):
+    metrics = {}
+    scores_file = os.path.join(folder, "eval_results_scores.csv")
+    if os.path.exists(scores_file):
+        with open(scores_file, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                metrics[row["metric"]] = row["value"]
+    statistic_file = os.path.join(folder, "statistic.csv")
+    if os.path.exists(statistic_file):
+        with open(statistic_file, newline='', encoding='utf-8') as f:
+            for row in csv.reader(f):
+                if len(row) == 2:
+                    metrics[row[0]] = row[1]
+    return metrics
+
+
+def write_comparison(leaves, output_file):
+    rows = []
+    for assignment, path in leaves:
+        row = dict(assignment)
+        for stage in path:
+            row.update(read_metrics(stage.output_folder))
+        row["output_folder"] = path[-1].output_folder
+        rows.append(row)
+    fieldnames = []
+    for row in rows:
+        fieldnames += [key for key in row if key not in fieldnames]
+    with open(output_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+    return fieldnames, rows
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: python run_sweep.py <sweep_config_path>")
+        sys.exit(1)
+
+    config_path = sys.argv[1]
+    config = json.load(open(config_path))
+    sweep_name = os.path.splitext(os.path.basename(config_path))[0]
+
+    scheduler = PipelineScheduler(max_workers=config.get("max_parallel_stages", 1))
+    leaves_by_dataset = {dataset: expand_sweep(scheduler, config, dataset) for dataset in config["datasets"]}
+    num_leaves = sum(len(leaves) for leaves in leaves_by_dataset.values())
+    logging.info(f"Sweep expanded to {num_leaves} variants sharing {len(scheduler.stages)} distinct stages")
+    success = scheduler.run()
+
+    for dataset, leaves in leaves_by_dataset.items():
+        # a report, kept apart from the dataset files stages read
+        sweep_folder = os.path.join('datasets', dataset, 'sweeps')
+        os.makedirs(sweep_folder, exist_ok=True)
+        output_file = os.path.join(sweep_folder, f"{sweep_name}_results.csv")
+        fieldnames, rows = write_comparison(leaves, output_file)
+        logging.info(f"Comparison table for {dataset} written to {output_file}")
+        print('\t'.join(fieldnames))
+        for row in rows:
+            print('\t'.join(str(row.get(key, '')) for key in fieldnames))
+
+    if not success:
+        logging.error("Some stages failed, see the log above")
+        sys.exit(1)
@@ -0,0 +1,163 @@
+import os
+import time
+import logging
+
+import numpy as np
+
+from search.denseIndex import normalize_rows
+from utils import atomic_write
+
+
+def assign_to_centroids(matrix, centroids, block_size=65536):
+    assignment = np.empty(len(matrix), dtype=np.int64)
+    for start in range(0, len(matrix), block_size):
+        block = np.asarray(matrix[start:start + block_size], dtype=np.float32)
+        assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignment
+
+
+def spherical_kmeans(matrix, nlist, iterations=10, sample_per_list=64, seed=0):
+    """
+    k-means on the unit sphere over a sample of the rows, returns (nlist, dim) normalized centroids.
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(matrix), nlist * sample_per_list)
+    sample = np.asarray(matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = assign_to_centroids(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        counts = np.bincount(assignment, minlength=nlist)
+        empty = counts == 0
+        # reseed empty lists with random sample points
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted file index: rows are bucketed by their nearest of nlist centroids and a query
+    only scores the rows of its nprobe closest buckets. Works on the normalized dense matrix.
+    """
+    backend = "ivf"
+
+    def __init__(self, matrix, centroids, order, offsets, nprobe=16):
+        self.matrix = matrix
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(cls, matrix, nlist=1024, nprobe=16, iterations=10, **kwargs):
+        nlist = min(nlist, len(matrix))
+        centroids = spherical_kmeans(matrix, nlist, iterations=iterations)
+        assignment = assign_to_centroids(matrix, centroids)
+        order = np.argsort(assignment, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))])
+        return cls(matrix, centroids, order, offsets, nprobe=nprobe)
+
+    @classmethod
+    def load(cls, path, matrix, nprobe=16, **kwargs):
+        data = np.load(path)
+        return cls(matrix, data["centroids"], data["order"], data["offsets"], nprobe=nprobe)
+
+    def save(self, path):
+        with atomic_write(path, suffix='.npz') as tmp_path:
+            np.savez(tmp_path, centroids=self.centroids, order=self.order, offsets=self.offsets)
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def search(self, query_embeddings, top_k):
+        queries = normalize_rows(np.asarray(query_embeddings, dtype=np.float32))
+        nprobe = min(self.nprobe, len(self.centroids))
+        centroid_scores = queries @ self.centroids.T
+        probes = np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe]
+        all_scores = np.full((len(queries), top_k), -np.inf, dtype=np.float32)
+        all_indices = np.full((len(queries), top_k), -1, dtype=np.int64)
+        for qi, query in enumerate(queries):
+            # sorted row ids keep reads from a memory-mapped matrix sequential
+            candidates = np.sort(np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]] for l in probes[qi]]))
+            if len(candidates) == 0:
+                continue
+            scores = np.asarray(self.matrix[candidates], dtype=np.float32) @ query
+            k = min(top_k, len(candidates))
+            part = np.argpartition(-scores, k - 1)[:k]
+            part = part[np.argsort(-scores[part], kind='stable')]
+            all_scores[qi, :k] = scores[part]
+            all_indices[qi, :k] = candidates[part]
+        return all_scores, all_indices
+
+
+class HNSWIndex:
+    """
+    Hierarchical navigable small world graph from hnswlib (optional dependency), inner product space.
+    """
+    backend = "hnsw"
+
+    def __init__(self, index, ef=128):
+        self.index = index
+        self.ef = ef
+        self.index.set_ef(ef)
+
+    @classmethod
+    def build(cls, matrix, M=32, ef_construction=200, ef=128, batch_size=65536, **kwargs):
+        import hnswlib
+        index = hnswlib.Index(space='ip', dim=matrix.shape[1])
+        index.init_index(max_elements=len(matrix), ef_construction=ef_construction, M=M)
+        for start in range(0, len(matrix), batch_size):
+            block = np.asarray(matrix[start:start + batch_size], dtype=np.float32)
+            index.add_items(block, np.arange(start, start + len(block)))
+        return cls(index, ef=ef)
+
+    @classmethod
+    def load(cls, path, matrix, ef=128, **kwargs):
+        import hnswlib
+        index = hnswlib.Index(space='ip', dim=matrix.shape[1])
+        index.load_index(path, max_elements=len(matrix))
+        return cls(index, ef=ef)
+
+    def save(self, path):
+        with atomic_write(path) as tmp_path:
+            self.index.save_index(tmp_path)
+
+    def __len__(self):
+        return self.index.get_current_count()
+
+    def search(self, query_embeddings, top_k):
+        queries = normalize_rows(np.asarray(query_embeddings, dtype=np.float32))
+        self.index.set_ef(max(self.ef, top_k))
+        labels, distances = self.index.knn_query(queries, k=min(top_k, len(self)))
+        # hnswlib's inner product distance is 1 - <q, x>
+        return (1 - distances).astype(np.float32), labels.astype(np.int64)
+
+
+ANN_BACKENDS = {
+    "ivf": (IVFIndex, "npz", ["nlist", "iterations"]),
+    "hnsw": (HNSWIndex, "bin", ["M", "ef_construction"]),
+}
+
+
+def load_ann_index(backend, matrix, path_prefix, params, persist=True):
+    """
+    Load the ANN index at path_prefix (+ build params + extension) or build and persist it.
+    Build parameters are part of the file name, search parameters (nprobe, ef) are not.
+    """
+    if backend not in ANN_BACKENDS:
+        raise ValueError(f"Unknown ANN backend {backend}. Valid backends are {list(ANN_BACKENDS)}")
+    index_class, extension, build_keys = ANN_BACKENDS[backend]
+    suffix = '_'.join(f"{key}-{params[key]}" for key in build_keys if key in params)
+    path = f"{path_prefix}_{backend}{'_' + suffix if suffix else ''}.{extension}"
+    if persist and os.path.exists(path):
+        logging.info(f"Loading {backend} index from {path}")
+        return index_class.load(path, matrix, **params)
+    start = time.time()
+    index = index_class.build(matrix, **params)
+    logging.info(f"Built {backend} index over {len(matrix)} rows in {time.time() - start:.1f}s")
+    if persist:
+        index.save(path)
+        logging.info(f"Persisted {backend} index to {path}")
+    return index
@@ -1,21 +1,25 @@
-from typing import Optional, List, Mapping, Any, Dict
+from typing import Optional, List, Mapping, Any, Dict, Iterator
 from abc import ABC, abstractmethod
 import os
 import logging
 import json
 from tqdm import tqdm
+import numpy as np
 import concurrent.futures
 
 from llama_index.core.schema import NodeWithScore, BaseNode, MetadataMode
 from llama_index.core.indices.query.schema import QueryBundle
 
-from utils import set_mit_llm
+from utils import set_llm, atomic_write
 from query_engine import BaseQueryEngine
-from format_converter import nodefile2node
+from format_converter import read_node_file, resume_jsonl, node_refs, RECALL_RESULTS_FILE, COMPLETE_MARKER_SUFFIX, PARSED_FILES_FILE
 from dataset_filters import filters_registry
+from normalized_text import NormalizedTextStore, NORMALIZED_TEXT_FILE, is_current
 
 class BaseSearcher(ABC):
     show_progress = True
+    # an interrupted run continues after the last example in recall_results.jsonl
+    resumable = True
 
     @abstractmethod
     def load_query_engine(self, nodes: List[BaseNode]) -> BaseQueryEngine:
@@ -27,16 +31,26 @@ class BaseSearcher(ABC):
     def __init__(self, config, inp_folder):
         self.remove_if_exists = config.get("remove_if_exists", False)
         self.thread_num = config.get("thread_num", 1)
+        self.search_batch_size = config.get("search_batch_size", 256)
+        # examples between two flushes of recall_results.jsonl to disk
+        self.flush_every = config.get("flush_every", 100)
+        # store (node_id, score, rank) per result, resolved against parsed_files.json, instead of whole nodes
+        self.store_node_refs = config.get("store_node_refs", True)
         self.input_folder = inp_folder
         self.excluded_embed_metadata_keys = config.get('excluded_embed_metadata_keys', None)
  
-        set_mit_llm()
+        set_llm()
+        # (offset into self.nodes, (n, dim) embedding matrix), memory-mapped where the .node file has a sidecar
+        self.embedding_blocks = []
         self.nodes = self.load_nodes(inp_folder)
         self.query_engine = self.load_query_engine(self.nodes)
         self.dataset_filter = filters_registry[config.get('dataset_filter', 'no_filter')]
 
     def process(self, input_folder: str, output_folder: str):
-        if os.path.exists(os.path.join(output_folder, "recall_results.json")):
+        output_file = os.path.join(output_folder, RECALL_RESULTS_FILE)
+        marker_file = output_file + COMPLETE_MARKER_SUFFIX
+        # recall_results.json is the output of runs before results were streamed
+        if os.path.exists(marker_file) or os.path.exists(os.path.join(output_folder, "recall_results.json")):
             if self.remove_if_exists:
                 logging.info(f"Output folder {output_folder} already exists, removing it.")
                 os.system(f"rm -rf {output_folder}")
@@ -47,52 +61,60 @@ class BaseSearcher(ABC):
  
         parent_folder = os.path.dirname(input_folder)
         rag_dataset_raw = json.load(open(os.path.join(parent_folder, "rag_dataset.json")))
-        rag_dataset = {'examples': []}
-        for example in rag_dataset_raw['examples']:
-            if self.dataset_filter(example):
-                rag_dataset['examples'].append(example)
+        examples = [example for example in rag_dataset_raw['examples'] if self.dataset_filter(example)]
 
-        recall_results_list = []
-        if self.thread_num > 1:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=self.thread_num) as executor:
-                task = []
-                for example in rag_dataset['examples']:
-                    query = example["query"]
-                    query_bundle = QueryBundle(query_str=query)
-                    task.append(executor.submit(self.query_engine.retrieve, query_bundle))
-                example_idx = 0
-                for t in tqdm(task):
-                    example = rag_dataset['examples'][example_idx]
-                    recall_results = t.result()
-                    example["recall_results"] = self.nodes2dict(recall_results)
-                    recall_results_list.append(example)
-                    example_idx += 1
-        else:
-            for example in tqdm(rag_dataset['examples']):
-                query = example["query"]
-                query_bundle = QueryBundle(query_str=query)
-                recall_results = self.query_engine.retrieve(query_bundle)
+        # the node store recall results refer to, also the offline data for evaluation
+        if not os.path.exists(os.path.join(output_folder, PARSED_FILES_FILE)):
+            self.save_parsed_files(self.nodes, os.path.join(output_folder, PARSED_FILES_FILE))
+        if not is_current(os.path.join(output_folder, NORMALIZED_TEXT_FILE)):
+            NormalizedTextStore.write(os.path.join(output_folder, NORMALIZED_TEXT_FILE),
+                                      ({'id_': node.node_id, 'text': node.text} for node in self.nodes))
+
+        # keep what an interrupted run already wrote
+        done = resume_jsonl(output_file, [example["query"] for example in examples])
+        if done:
+            logging.info(f"Resuming search after {done}/{len(examples)} examples already in {output_file}")
+        query_bundles = [QueryBundle(query_str=example["query"]) for example in examples[done:]]
+        with open(output_file, "a", encoding='utf-8') as f, tqdm(total=len(examples), initial=done) as progress:
+            for count, (example, recall_results) in enumerate(zip(examples[done:], self.retrieve_all(query_bundles)), 1):
                 example["recall_results"] = self.nodes2dict(recall_results)
-                recall_results_list.append(example)
+                f.write(json.dumps(example, ensure_ascii=False) + '\n')
+                if count % self.flush_every == 0:
+                    f.flush()
+                    os.fsync(f.fileno())
+                progress.update(1)
 
-        output_file = os.path.join(output_folder, "recall_results.json")
-        with open(output_file, "w") as f:
-            json.dump(recall_results_list, f, indent=2, ensure_ascii=False)
+        with open(marker_file, "w") as f:
+            json.dump({"examples": len(examples)}, f)
+        return output_folder
 
-        # save offline data for evaluation
-        if not os.path.exists(os.path.join(output_folder, "parsed_files.json")):
-            self.save_parsed_files(self.nodes, os.path.join(output_folder, "parsed_files.json"))
+    def retrieve_all(self, query_bundles: List[QueryBundle]) -> Iterator[List[NodeWithScore]]:
+        """
+        Yield the final nodes of every query, in order, retrieving search_batch_size queries at a time.
+        """
+        for start in range(0, len(query_bundles), self.search_batch_size):
+            yield from self.retrieve_batch(query_bundles[start:start + self.search_batch_size])
 
-        return output_folder
+    def retrieve_batch(self, query_bundles: List[QueryBundle]) -> List[List[NodeWithScore]]:
+        """
+        Retrieve the final nodes of many queries at once. By default the query engine
+        runs once per query, in thread_num threads.
+        """
+        if self.thread_num > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.thread_num) as executor:
+                return list(executor.map(self.query_engine.retrieve, query_bundles))
+        return [self.query_engine.retrieve(query_bundle) for query_bundle in query_bundles]
 
     def save_parsed_files(self, parsed_files, out_file):
-        parsed_files_fmt = []
-        for node in parsed_files:
-            node = node.to_dict()
-            if 'embedding' in node:
-                del node['embedding']
-            parsed_files_fmt.append(node)
-        json.dump(parsed_files_fmt, open(out_file, 'w'), indent=2, ensure_ascii=False)
+        # one node at a time, parsed_files may be read from disk row by row (sharded search)
+        with atomic_write(out_file) as tmp_file, open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write('[')
+            for idx, node in enumerate(parsed_files):
+                node = node.to_dict()
+                if 'embedding' in node:
+                    del node['embedding']
+                f.write((',\n' if idx else '\n') + json.dumps(node, indent=2, ensure_ascii=False))
+            f.write('\n]')
 
     def load_nodes(self, input_folder):
         files = os.listdir(input_folder)
@@ -106,7 +128,11 @@ class BaseSearcher(ABC):
                 logging.info(f"Skipping {input_file} as it is not supported")
                 continue
             logging.info(f"Parsing ({processed}/{len(files)}) {input_file}")
-            nodes = nodefile2node(input_file)
+            nodes, embeddings = read_node_file(input_file)
+            if embeddings is None and len(nodes) > 0 and all(node.embedding is not None for node in nodes):
+                embeddings = np.asarray([node.embedding for node in nodes], dtype=np.float32)
+            if embeddings is not None:
+                self.embedding_blocks.append((len(parsed_files), embeddings))
             if self.excluded_embed_metadata_keys is not None:
                 for node in nodes:
                     node.excluded_embed_metadata_keys = self.excluded_embed_metadata_keys
@@ -116,12 +142,25 @@ class BaseSearcher(ABC):
             parsed_files.extend(nodes)
         return parsed_files
 
+    def attach_embeddings(self, nodes):
+        """
+        Copy the rows of the embedding blocks into node.embedding for consumers that need python lists.
+        """
+        for offset, embeddings in self.embedding_blocks:
+            for idx, embedding in enumerate(embeddings):
+                node = nodes[offset + idx]
+                if node.embedding is None and not np.isnan(embedding[0]):
+                    node.embedding = embedding.astype(np.float32).tolist()
+
     def nodes2dict(self, nodes: NodeWithScore) -> List[Dict[str, Any]]:
         resp_dict = {
             "response": None,
             "source_nodes": [],
             "metadata": None
         }
+        if self.store_node_refs:
+            resp_dict["source_nodes"] = node_refs(nodes)
+            return resp_dict
         for node in nodes:
             resp_dict["source_nodes"].append(node.to_dict())
         return resp_dict
\ No newline at end of file
@@ -0,0 +1,152 @@
+import re
+import time
+import logging
+import threading
+import functools
+from typing import Any, List, Optional
+
+import numpy as np
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import NodeWithScore, MetadataMode, QueryBundle
+
+CJK_PATTERN = re.compile(r"[\u4e00-\u9fff]")
+
+
+@functools.lru_cache(maxsize=None)
+def load_cross_encoder(model_name):
+    """
+    FlagReranker shared by every searcher of the process.
+    """
+    from FlagEmbedding import FlagReranker
+    return FlagReranker(model_name, use_fp16=False)
+
+
+def estimate_tokens(text):
+    """
+    Tokens of text without tokenizing it: one per CJK character, about four characters per token otherwise.
+    """
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk) // 4
+
+
+class BatchReranker:
+    """
+    Cross-encoder reranking for many queries at once. The (query, candidate) pairs of all
+    queries are sorted by token length and cut into batches of at most max_tokens_per_batch
+    padded tokens, so short pairs are not padded to the longest chunk of their query.
+    Scores are regrouped per query and each query keeps its top_n candidates. Pairs found in
+    the optional RerankCache never reach the model. Safe to share between threads.
+    """
+    def __init__(self, model, top_n, max_tokens_per_batch=16384, max_length=512, cache=None):
+        # a FlagReranker, see load_cross_encoder
+        self.model = model
+        self.top_n = top_n
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.max_length = max_length
+        self.cache = cache
+        self.pairs_scored = 0
+        self.padded_tokens = 0
+        self.score_time = 0.0
+        # the rerank stage of the search pipeline may run several workers
+        self.stats_lock = threading.Lock()
+
+    def pair_lengths(self, pairs):
+        """
+        Estimated token lengths of the pairs, the model tokenizes each pair once when scoring it.
+        """
+        return np.asarray([min(self.max_length, estimate_tokens(query) + estimate_tokens(text) + 3) for query, text in pairs])
+
+    def make_batches(self, lengths):
+        """
+        Indices of the pairs in each batch; a batch costs its size times its longest pair.
+        """
+        batches, batch, longest = [], [], 0
+        for idx in np.argsort(lengths, kind='stable'):
+            longest_if_added = max(longest, lengths[idx])
+            if batch and (len(batch) + 1) * longest_if_added > self.max_tokens_per_batch:
+                batches.append(batch)
+                batch, longest_if_added = [], lengths[idx]
+            batch.append(idx)
+            longest = longest_if_added
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def score(self, pairs):
+        scores = np.empty(len(pairs), dtype=np.float32)
+        missing = list(range(len(pairs)))
+        if self.cache is not None and pairs:
+            cached = self.cache.get_many(pairs)
+            for idx, score in cached.items():
+                scores[idx] = score
+            missing = [idx for idx in missing if idx not in cached]
+        if not missing:
+            return scores
+        start = time.time()
+        missing_pairs = [pairs[idx] for idx in missing]
+        missing_scores = np.empty(len(missing), dtype=np.float32)
+        lengths = self.pair_lengths(missing_pairs)
+        padded_tokens = 0
+        for batch in self.make_batches(lengths):
+            batch_scores = self.model.compute_score([missing_pairs[idx] for idx in batch], batch_size=len(batch), max_length=self.max_length)
+            missing_scores[batch] = np.atleast_1d(np.asarray(batch_scores, dtype=np.float32))
+            padded_tokens += len(batch) * int(lengths[batch].max())
+        scores[missing] = missing_scores
+        if self.cache is not None:
+            self.cache.put_many(missing_pairs, missing_scores)
+        with self.stats_lock:
+            self.padded_tokens += padded_tokens
+            self.pairs_scored += len(missing)
+            self.score_time += time.time() - start
+        return scores
+
+    def rerank(self, query_bundles: List[QueryBundle], candidates: List[List[NodeWithScore]], top_n=None) -> List[List[NodeWithScore]]:
+        pairs, owners = [], []
+        for qi, (query_bundle, nodes) in enumerate(zip(query_bundles, candidates)):
+            for node in nodes:
+                pairs.append((query_bundle.query_str, node.node.get_content(metadata_mode=MetadataMode.EMBED)))
+                owners.append(qi)
+        scores = self.score(pairs)
+
+        reranked = [[] for _ in query_bundles]
+        flat_nodes = [node for nodes in candidates for node in nodes]
+        for node, owner, score in zip(flat_nodes, owners, scores):
+            reranked[owner].append(NodeWithScore(node=node.node, score=float(score)))
+        top_n = self.top_n if top_n is None else top_n
+        return [sorted(nodes, key=lambda node: -node.score)[:top_n] for nodes in reranked]
+
+    def stats(self):
+        stats = {
+            "pairs": self.pairs_scored,
+            "padded_tokens": self.padded_tokens,
+            "seconds": round(self.score_time, 2),
+            "pairs_per_second": round(self.pairs_scored / max(self.score_time, 1e-6), 1),
+        }
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+
+class CrossEncoderReranker(BaseNodePostprocessor):
+    """
+    Node postprocessor of the query engine's per-query path over a BatchReranker, so both paths
+    share its cross-encoder, batching and cache. top_n may be changed per searcher or generator.
+    """
+    top_n: int = Field(default=2, description="Top N nodes to return.")
+    _batch_reranker: Any = PrivateAttr()
+
+    def __init__(self, batch_reranker: BatchReranker, top_n: int = 2):
+        super().__init__(top_n=top_n)
+        self._batch_reranker = batch_reranker
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CrossEncoderReranker"
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        if query_bundle is None:
+            raise ValueError("Missing query bundle in extra info.")
+        if not nodes:
+            return []
+        return self._batch_reranker.rerank([query_bundle], [nodes], top_n=self.top_n)[0]
@@ -0,0 +1,115 @@
+import logging
+from typing import List
+
+import numpy as np
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+from utils import atomic_write
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def embed_queries(embed_model, queries, batch_size=64):
+    """
+    Embed queries in batches, with the model's query instruction where it has one.
+    """
+    batch_fn = getattr(embed_model, "_get_query_embeddings", None)
+    embeddings = []
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        if batch_fn is not None:
+            embeddings.extend(batch_fn(batch))
+        else:
+            embeddings.extend(embed_model.get_query_embedding(query) for query in batch)
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+def merge_topk(scores, indices, top_k):
+    """
+    Keep the top_k columns of each row of (scores, indices), sorted by descending score.
+    """
+    if scores.shape[1] > top_k:
+        part = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        indices = np.take_along_axis(indices, part, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+class DenseIndex:
+    """
+    Exact inner product search over a contiguous, row-normalized float32 matrix,
+    scored with blocked matrix multiplication and top-k selection by argpartition.
+    """
+    def __init__(self, matrix, block_size=65536, query_block_size=1024):
+        self.matrix = matrix
+        self.block_size = block_size
+        self.query_block_size = query_block_size
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        return cls(np.load(path, mmap_mode='r'), **kwargs)
+
+    def save(self, path):
+        with atomic_write(path, suffix='.npy') as tmp_path:
+            np.save(tmp_path, np.ascontiguousarray(self.matrix, dtype=np.float32))
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def search(self, query_embeddings, top_k):
+        """
+        Returns (scores, indices), both (num_queries, top_k) and sorted by descending score.
+        """
+        queries = normalize_rows(np.asarray(query_embeddings, dtype=np.float32))
+        top_k = min(top_k, len(self))
+        all_scores = np.empty((len(queries), top_k), dtype=np.float32)
+        all_indices = np.empty((len(queries), top_k), dtype=np.int64)
+        for q_start in range(0, len(queries), self.query_block_size):
+            query_block = queries[q_start:q_start + self.query_block_size]
+            best_scores = np.empty((len(query_block), 0), dtype=np.float32)
+            best_indices = np.empty((len(query_block), 0), dtype=np.int64)
+            for start in range(0, len(self), self.block_size):
+                block = self.matrix[start:start + self.block_size]
+                scores = query_block @ block.T
+                k = min(top_k, scores.shape[1])
+                part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                block_scores = np.take_along_axis(scores, part, axis=1)
+                best_scores = np.concatenate([best_scores, block_scores], axis=1)
+                best_indices = np.concatenate([best_indices, part + start], axis=1)
+                best_scores, best_indices = merge_topk(best_scores, best_indices, top_k)
+            all_scores[q_start:q_start + len(query_block)] = best_scores
+            all_indices[q_start:q_start + len(query_block)] = best_indices
+        return all_scores, all_indices
+
+
+class DenseIndexRetriever(BaseRetriever):
+    """
+    llama_index retriever over a DenseIndex, or an ANN index with the same search method,
+    so query engines built on it keep working one query at a time.
+    """
+    def __init__(self, index: DenseIndex, nodes, embed_model, similarity_top_k):
+        self._index = index
+        self._nodes = nodes
+        self._embed_model = embed_model
+        self._similarity_top_k = similarity_top_k
+        super().__init__()
+
+    def to_nodes(self, scores, indices) -> List[NodeWithScore]:
+        # approximate indexes pad with -1 when they find fewer than top_k rows
+        return [NodeWithScore(node=self._nodes[idx], score=float(score)) for score, idx in zip(scores, indices) if idx >= 0]
+
+    def retrieve_batch(self, query_embeddings) -> List[List[NodeWithScore]]:
+        scores, indices = self._index.search(query_embeddings, self._similarity_top_k)
+        return [self.to_nodes(row_scores, row_indices) for row_scores, row_indices in zip(scores, indices)]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        query_embedding = query_bundle.embedding
+        if query_embedding is None:
+            query_embedding = self._embed_model.get_query_embedding(query_bundle.query_str)
+        return self.retrieve_batch([query_embedding])[0]
@@ -0,0 +1,148 @@
+import time
+import queue
+import asyncio
+import logging
+import threading
+from typing import Callable, List
+
+
+class PipelineStage:
+    """
+    One step of a SearchPipeline: fn maps a list of items to a list of results of the same
+    length, called from `workers` threads on batches of up to batch_size items.
+    """
+    def __init__(self, name, fn: Callable[[List], List], workers=1, batch_size=32):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.batch_size = batch_size
+        self.items = 0
+        self.batches = 0
+        self.busy_time = 0.0
+        self.depth_samples = []
+
+    def stats(self, elapsed):
+        depths = self.depth_samples or [0]
+        return {
+            "workers": self.workers,
+            "batch_size": self.batch_size,
+            "items": self.items,
+            "batches": self.batches,
+            "busy_seconds": round(self.busy_time, 2),
+            "items_per_second": round(self.items / max(elapsed, 1e-6), 1),
+            # busy worker time over available worker time
+            "utilization": round(self.busy_time / max(elapsed * self.workers, 1e-6), 2),
+            "mean_queue_depth": round(sum(depths) / len(depths), 1),
+            "max_queue_depth": max(depths),
+        }
+
+
+class SearchPipeline:
+    """
+    Producer/consumer pipeline over bounded asyncio queues. Stage functions run in threads,
+    so a CPU-bound model call in one stage (embedding) overlaps with the others (reranking).
+    Results come back in input order.
+    """
+    def __init__(self, stages: List[PipelineStage], queue_size=1024):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.elapsed = 0.0
+
+    async def worker(self, stage, inbox, outbox):
+        while True:
+            first = await inbox.get()
+            if first is None:
+                return
+            stage.depth_samples.append(inbox.qsize() + 1)
+            batch = [first]
+            while len(batch) < stage.batch_size and not inbox.empty():
+                item = inbox.get_nowait()
+                if item is None:
+                    # leave the end marker for this worker's next get
+                    inbox.put_nowait(None)
+                    break
+                batch.append(item)
+            start = time.time()
+            outputs = await asyncio.to_thread(stage.fn, [payload for _, payload in batch])
+            stage.busy_time += time.time() - start
+            stage.items += len(batch)
+            stage.batches += 1
+            for (seq, _), output in zip(batch, outputs):
+                await outbox.put((seq, output))
+
+    async def run_async(self, items, on_result=None):
+        """
+        Returns the results in input order, or passes each to on_result(index, result) as it completes.
+        """
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        results = [None] * len(items) if on_result is None else None
+
+        async def produce():
+            for seq, item in enumerate(items):
+                await queues[0].put((seq, item))
+            for _ in range(self.stages[0].workers):
+                await queues[0].put(None)
+
+        async def run_stage(idx, stage):
+            await asyncio.gather(*[self.worker(stage, queues[idx], queues[idx + 1]) for _ in range(stage.workers)])
+            # every worker of this stage is done, hand one end marker to each worker downstream
+            downstream = self.stages[idx + 1].workers if idx + 1 < len(self.stages) else 1
+            for _ in range(downstream):
+                await queues[idx + 1].put(None)
+
+        async def collect():
+            while True:
+                item = await queues[-1].get()
+                if item is None:
+                    return
+                seq, output = item
+                if on_result is None:
+                    results[seq] = output
+                else:
+                    on_result(seq, output)
+
+        start = time.time()
+        await asyncio.gather(produce(), collect(), *[run_stage(idx, stage) for idx, stage in enumerate(self.stages)])
+        self.elapsed = time.time() - start
+        return results
+
+    def run(self, items, on_result=None):
+        return asyncio.run(self.run_async(items, on_result))
+
+    def iter_results(self, items):
+        """
+        Run the pipeline in a background thread and yield results in input order as they complete.
+        """
+        ready = queue.Queue()
+        errors = []
+
+        def target():
+            try:
+                self.run(items, on_result=lambda seq, output: ready.put((seq, output)))
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                ready.put(None)
+
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        pending, next_seq = {}, 0
+        while True:
+            item = ready.get()
+            if item is None:
+                break
+            pending[item[0]] = item[1]
+            while next_seq in pending:
+                yield pending.pop(next_seq)
+                next_seq += 1
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    def stats(self):
+        return {stage.name: stage.stats(self.elapsed) for stage in self.stages}
+
+    def log_stats(self):
+        logging.info(f"Search pipeline finished {len(self.stages)} stages in {self.elapsed:.1f}s")
+        for name, stats in self.stats().items():
+            logging.info(f"  {name}: {stats}")
@@ -0,0 +1,237 @@
+import os
+import gc
+import json
+import heapq
+import logging
+import resource
+import threading
+import itertools
+import multiprocessing
+
+import numpy as np
+from llama_index.core.schema import TextNode
+
+from search.denseIndex import DenseIndex
+from search.sparseIndex import BM25Index
+from utils import atomic_write
+
+
+def shard_bounds(num_rows, num_shards):
+    """
+    [(lo, hi)] row ranges of num_shards contiguous, near equal shards.
+    """
+    edges = np.linspace(0, num_rows, num_shards + 1).astype(np.int64)
+    return list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+
+
+def shard_sparse_index(index: BM25Index, lo, hi):
+    """
+    The postings of documents lo..hi-1, renumbered from 0. Weights keep their corpus-wide idf,
+    so shard scores are comparable with each other and with the unsharded index.
+    """
+    keep = (index.doc_ids >= lo) & (index.doc_ids < hi)
+    term_of_posting = np.repeat(np.arange(len(index.df)), index.df)
+    counts = np.bincount(term_of_posting[keep], minlength=len(index.df))
+    indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return BM25Index(index.vocab, indptr, index.doc_ids[keep] - lo, index.weights[keep], hi - lo)
+
+
+class NodeRows:
+    """
+    The nodes of a searcher as a read-only sequence backed by a json lines file and the byte
+    offsets of its rows, so the nodes are read by row id when a query returns them instead of
+    all being held in memory. Reads use pread and are safe from several threads.
+    """
+    offsets_suffix = '.offsets.npy'
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = np.load(path + self.offsets_suffix)
+        self.fd = os.open(path, os.O_RDONLY)
+
+    @classmethod
+    def write(cls, path, nodes):
+        offsets = [0]
+        # the offsets are moved into place first, the rows file marks a complete write
+        with atomic_write(path) as tmp_path, atomic_write(path + cls.offsets_suffix, suffix='.npy') as tmp_offsets:
+            with open(tmp_path, 'wb') as f:
+                for node in nodes:
+                    node_dict = node.to_dict()
+                    node_dict.pop('embedding', None)
+                    line = (json.dumps(node_dict, ensure_ascii=False) + '\n').encode('utf-8')
+                    f.write(line)
+                    offsets.append(offsets[-1] + len(line))
+            np.save(tmp_offsets, np.asarray(offsets, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        idx = int(idx)
+        if idx < 0:
+            idx += len(self)
+        lo, hi = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        return TextNode.from_dict(json.loads(os.pread(self.fd, hi - lo, lo)))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def close(self):
+        os.close(self.fd)
+
+
+def process_memory_mb():
+    """
+    {"rss", "pss", "uss"} of this process in MB. Pages a forked worker still shares copy-on-write
+    with its parent count fully in rss, split among the sharers in pss and not at all in uss
+    (private pages only), so uss is what a worker adds. rss only where smaps_rollup is missing.
+    """
+    fields = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    except OSError:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * resource.getpagesize() / (1 << 20)
+        return {"rss": rss, "pss": None, "uss": None}
+    return {"rss": fields["Rss"], "pss": fields["Pss"], "uss": fields["Private_Clean"] + fields["Private_Dirty"]}
+
+
+def shard_worker(conn, lo, hi, dense_path, sparse_path, block_size):
+    """
+    Serve searches over rows lo..hi-1: loads its slice of the dense matrix into memory and its
+    sparse postings, then answers (kind, payload, top_k) requests with global row indices.
+    """
+    dense = None
+    if dense_path is not None:
+        dense = DenseIndex(np.array(np.load(dense_path, mmap_mode='r')[lo:hi]), block_size=block_size)
+    sparse = BM25Index.load(sparse_path) if sparse_path is not None else None
+    conn.send(process_memory_mb())
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        kind, payload, top_k = request
+        if kind == "stats":
+            conn.send(process_memory_mb())
+            continue
+        index = dense if kind == "dense" else sparse
+        scores, indices = index.search(payload, min(top_k, hi - lo))
+        indices = np.where(indices >= 0, indices + lo, -1)
+        conn.send((scores, indices))
+    conn.close()
+
+
+def merge_shard_results(shard_results, top_k):
+    """
+    Heap merge of the per-shard (scores, indices), each sorted by descending score, into the
+    global top_k per query. Padding (-1) rows are dropped.
+    """
+    num_queries = shard_results[0][0].shape[0]
+    all_scores = np.zeros((num_queries, top_k), dtype=np.float32)
+    all_indices = np.full((num_queries, top_k), -1, dtype=np.int64)
+    for qi in range(num_queries):
+        rows = [zip(scores[qi].tolist(), indices[qi].tolist()) for scores, indices in shard_results]
+        merged = heapq.merge(*rows, key=lambda item: -item[0])
+        best = [(score, idx) for score, idx in itertools.islice((item for item in merged if item[1] >= 0), top_k)]
+        for rank, (score, idx) in enumerate(best):
+            all_scores[qi, rank] = score
+            all_indices[qi, rank] = idx
+    return all_scores, all_indices
+
+
+def format_memory(memory):
+    """
+    Per worker "uss/pss/rss" of process_memory_mb results.
+    """
+    return [f"{round(m['uss'])}/{round(m['pss'])}/{round(m['rss'])}" if m["uss"] is not None else f"rss {round(m['rss'])}"
+            for m in memory]
+
+
+class ShardPool:
+    """
+    N local worker processes, each holding one contiguous slice of the dense matrix (read from
+    its .npy file) and of the sparse postings. Queries are broadcast to every shard in batches
+    and the per-shard top-k merged with a heap.
+    """
+    def __init__(self, num_rows, num_shards, dense_path=None, sparse_paths=None, block_size=65536):
+        self.num_rows = num_rows
+        # workers inherit whatever the parent holds when they fork, free what is no longer referenced
+        gc.collect()
+        self.bounds = shard_bounds(num_rows, num_shards)
+        # retrieve stages of the search pipeline may share the pool from several threads
+        self.lock = threading.Lock()
+        # fork like the parse stage, the pipeline entry points are not import safe for spawn
+        ctx = multiprocessing.get_context("fork")
+        self.connections = []
+        self.processes = []
+        for shard_id, (lo, hi) in enumerate(self.bounds):
+            parent_conn, child_conn = ctx.Pipe()
+            sparse_path = sparse_paths[shard_id] if sparse_paths is not None else None
+            proc = ctx.Process(target=shard_worker, args=(child_conn, lo, hi, dense_path, sparse_path, block_size), daemon=True)
+            proc.start()
+            child_conn.close()
+            self.connections.append(parent_conn)
+            self.processes.append(proc)
+        self.loaded_memory_mb = [conn.recv() for conn in self.connections]
+        logging.info(f"Started {num_shards} search shards, uss/pss/rss per worker (MB): {format_memory(self.loaded_memory_mb)}")
+
+    def broadcast(self, kind, payload, top_k):
+        with self.lock:
+            for conn in self.connections:
+                conn.send((kind, payload, top_k))
+            shard_results = [conn.recv() for conn in self.connections]
+        return merge_shard_results(shard_results, top_k)
+
+    def memory_mb(self):
+        """
+        process_memory_mb of every worker.
+        """
+        with self.lock:
+            for conn in self.connections:
+                conn.send(("stats", None, 0))
+            return [conn.recv() for conn in self.connections]
+
+    def close(self):
+        for conn, proc in zip(self.connections, self.processes):
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            proc.join(timeout=10)
+        self.connections, self.processes = [], []
+
+
+class ShardedDenseIndex:
+    """
+    DenseIndex interface over the dense slices of a ShardPool.
+    """
+    def __init__(self, pool: ShardPool):
+        self.pool = pool
+
+    def __len__(self):
+        return self.pool.num_rows
+
+    def search(self, query_embeddings, top_k):
+        return self.pool.broadcast("dense", np.asarray(query_embeddings, dtype=np.float32), min(top_k, len(self)))
+
+
+class ShardedSparseIndex:
+    """
+    BM25Index interface over the sparse slices of a ShardPool.
+    """
+    def __init__(self, pool: ShardPool, vocab):
+        self.pool = pool
+        self.vocab = vocab
+
+    def __len__(self):
+        return self.pool.num_rows
+
+    def search(self, queries, top_k):
+        return self.pool.broadcast("sparse", list(queries), top_k)
@@ -1,6 +1,8 @@
 import re
 import json
 import os
+import shutil
+import logging
 from typing import Optional, List, Mapping, Any, Dict
 from llama_index.core import StorageContext, load_index_from_storage
 from llama_index.core.indices.query.schema import QueryBundle
@@ -10,6 +12,22 @@ from query_engine import RetrieverQueryEngine
 import requests
 from llama_index.core.embeddings import BaseEmbedding
 from llama_index.core.bridge.pydantic import Field
+from llama_index.core.schema import MetadataMode
+from utils import load_embed_model, stable_hash, atomic_write
+from embedding_cache import EmbeddingCache, embed_texts
+from rerank_cache import RerankCache
+import numpy as np
+import concurrent.futures
+from search.denseIndex import DenseIndex, DenseIndexRetriever, embed_queries, normalize_rows
+from search.annIndex import load_ann_index
+from search.sparseIndex import BM25Index, HybridRetriever
+from search.batchReranker import BatchReranker, CrossEncoderReranker, load_cross_encoder
+from search.searchPipeline import SearchPipeline, PipelineStage
+from search.shardedIndex import ShardPool, ShardedDenseIndex, ShardedSparseIndex, NodeRows, shard_bounds, shard_sparse_index, format_memory
+
+# files and directories persisted in the chunk folder, named by the first 16 hex digits of index_key
+PERSISTED_INDEX_PATTERN = re.compile(r"^(?:vector_index|dense_index|sparse_index|ann_index|node_rows|index_key)_([0-9a-f]{16})(?![0-9a-f])")
+
 
 class SimpleHybridSearcher(BaseSearcher):
     def __init__(self, config, inp_folder):
@@ -19,6 +37,35 @@ class SimpleHybridSearcher(BaseSearcher):
         self.rerank_model = config["rerank_model"]
         self.regenerate_emb = config.get("regenerate_emb", False)
         self.use_async = config.get("use_async", False)
+        self.embed_batch_size = config.get("embed_batch_size", 64)
+        self.embed_cache_path = config.get("embed_cache_path", None)
+        self.embed_cache_max_entries = config.get("embed_cache_max_entries", None)
+        self.persist_index = config.get("persist_index", True)
+        # "llama_index": VectorStoreIndex, one query at a time; "numpy": batched DenseIndex
+        self.retrieval_engine = config.get("retrieval_engine", "llama_index")
+        self.dense_block_size = config.get("dense_block_size", 65536)
+        # approximate search over the dense index: None, "ivf" (nlist/nprobe) or "hnsw" (M/ef_construction/ef)
+        self.ann_backend = config.get("ann_backend", None)
+        self.ann_params = config.get("ann_params", {})
+        # "weighted": vector_ratio * dense + (1 - vector_ratio) * BM25, "rrf": reciprocal-rank fusion
+        self.fusion = config.get("fusion", "weighted")
+        self.rrf_k = config.get("rrf_k", 60)
+        self.sparse_top_k = config.get("sparse_top_k", self.rerank_size)
+        self.bm25_k1 = config.get("bm25_k1", 1.2)
+        self.bm25_b = config.get("bm25_b", 0.75)
+        # rerank the candidates of a whole search batch together, in length sorted token-budget batches
+        self.rerank_batching = config.get("rerank_batching", False)
+        self.rerank_max_tokens_per_batch = config.get("rerank_max_tokens_per_batch", 16384)
+        self.rerank_max_length = config.get("rerank_max_length", 512)
+        # scores of (query, candidate) pairs already seen, reranking goes through the batched path when set
+        self.rerank_cache_path = config.get("rerank_cache_path", None)
+        self.rerank_cache_max_entries = config.get("rerank_cache_max_entries", None)
+        # run embed -> retrieve -> rerank as overlapping stages, each with its own workers and batch size
+        self.search_pipeline = config.get("search_pipeline", None)
+        # split the dense and sparse indexes over this many local worker processes (numpy engine)
+        self.num_shards = config.get("num_shards", 1)
+        self.shard_pool = None
+        self._index_key = None
         super(SimpleHybridSearcher, self).__init__(config, inp_folder)
 
     
@@ -26,36 +73,317 @@ class SimpleHybridSearcher(BaseSearcher):
         """
         Load the query engine from nodes.
         """
-        node_postprocessors = self.load_node_postprocessors()
-        retriever = self.load_retriever(nodes)
+        node_postprocessors = self.node_postprocessors = self.load_node_postprocessors()
+        self.embed_model = load_embed_model(self.embed_model_name)
+        if self.persist_index or self.num_shards > 1:
+            self.prune_stale_indexes(nodes)
+        sparse_index = None
+        if self.retrieval_engine == "numpy" and self.num_shards > 1:
+            if self.ann_backend:
+                logging.warning(f"ann_backend {self.ann_backend} is ignored when searching {self.num_shards} shards")
+            # the node list is swapped for rows read from disk before the shard workers fork
+            nodes = self.persist_sharded_indexes(nodes)
+            index, sparse_index = self.start_shard_pool(len(nodes))
+            retriever = DenseIndexRetriever(index, nodes, self.embed_model, self.rerank_size)
+        elif self.retrieval_engine == "numpy":
+            index = self.load_dense_index(nodes)
+            if self.ann_backend:
+                path_prefix = os.path.join(self.input_folder, f"ann_index_{self.index_key(nodes)[:16]}")
+                index = load_ann_index(self.ann_backend, index.matrix, path_prefix, self.ann_params, persist=self.persist_index)
+            retriever = DenseIndexRetriever(index, nodes, self.embed_model, self.rerank_size)
+        else:
+            retriever = self.load_retriever(nodes)
+        if self.use_sparse():
+            if sparse_index is None:
+                sparse_index = self.load_sparse_index(nodes)
+            retriever = HybridRetriever(retriever, sparse_index, nodes, self.rerank_size,
+                                        sparse_top_k=self.sparse_top_k, vector_ratio=self.vector_ratio,
+                                        fusion=self.fusion, rrf_k=self.rrf_k)
+        self.retriever = retriever
         query_engine = RetrieverQueryEngine(
             retriever=retriever,
             node_postprocessors=node_postprocessors
         )
         return query_engine
 
+    def use_sparse(self):
+        # vector_ratio 1 with weighted fusion is pure vector search, no need for the sparse index
+        return self.fusion == "rrf" or self.vector_ratio < 1
+
+    def sparse_index_path(self, nodes, suffix=''):
+        return os.path.join(self.input_folder, f"sparse_index_{self.index_key(nodes)[:16]}_k1-{self.bm25_k1}_b-{self.bm25_b}{suffix}.npz")
+
+    def load_sparse_index(self, nodes, persist=None):
+        """
+        BM25 index over the node texts, persisted next to the chunk output.
+        """
+        persist = self.persist_index if persist is None else persist
+        path = self.sparse_index_path(nodes)
+        if persist and os.path.exists(path):
+            logging.info(f"Loading sparse index from {path}")
+            return BM25Index.load(path)
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        index = BM25Index.build(texts, k1=self.bm25_k1, b=self.bm25_b)
+        logging.info(f"Built sparse index over {len(nodes)} nodes with {len(index.vocab)} terms")
+        if persist:
+            index.save(path)
+            logging.info(f"Persisted sparse index to {path}")
+        return index
+
+    def node_rows_path(self, nodes):
+        return os.path.join(self.input_folder, f"node_rows_{self.index_key(nodes)[:16]}.jsonl")
+
+    def persist_sharded_indexes(self, nodes):
+        """
+        Write the dense index, the sparse postings of each shard and the node rows to disk
+        (whatever persist_index says) without keeping the full indexes, and replace self.nodes
+        with NodeRows over them. Returns the NodeRows; callers must drop their node list too,
+        the shard workers fork from this process and would inherit it.
+        """
+        dense_path = self.dense_index_path(nodes)
+        if not os.path.exists(dense_path):
+            self.load_dense_index(nodes, persist=True)
+        self.shard_dense_path = dense_path
+        self.shard_sparse_paths, self.shard_vocab = None, None
+        if self.use_sparse():
+            bounds = shard_bounds(len(nodes), self.num_shards)
+            sparse_paths = [self.sparse_index_path(nodes, f"_shard{shard_id}of{self.num_shards}") for shard_id in range(self.num_shards)]
+            if all(os.path.exists(path) for path in sparse_paths):
+                # every shard holds the corpus-wide vocabulary, only its terms are read
+                with np.load(sparse_paths[0]) as data:
+                    self.shard_vocab = {term: idx for idx, term in enumerate(data["terms"].tolist())}
+            else:
+                sparse_index = self.load_sparse_index(nodes, persist=True)
+                for path, (lo, hi) in zip(sparse_paths, bounds):
+                    if not os.path.exists(path):
+                        shard_sparse_index(sparse_index, lo, hi).save(path)
+                self.shard_vocab = sparse_index.vocab
+                del sparse_index
+            self.shard_sparse_paths = sparse_paths
+        rows_path = self.node_rows_path(nodes)
+        if not os.path.exists(rows_path):
+            NodeRows.write(rows_path, nodes)
+        self.nodes = NodeRows(rows_path)
+        self.embedding_blocks = []
+        return self.nodes
+
+    def start_shard_pool(self, num_rows):
+        """
+        Start num_shards worker processes over slices of the indexes persist_sharded_indexes wrote,
+        each worker loads its slice from disk.
+        """
+        self.shard_pool = ShardPool(num_rows, self.num_shards, dense_path=self.shard_dense_path, sparse_paths=self.shard_sparse_paths,
+                                    block_size=self.dense_block_size)
+        sparse_index = ShardedSparseIndex(self.shard_pool, self.shard_vocab) if self.shard_sparse_paths is not None else None
+        return ShardedDenseIndex(self.shard_pool), sparse_index
+
     def load_node_postprocessors(self):
-        from llama_index.postprocessor.flag_embedding_reranker import FlagEmbeddingReranker
-        reranker = FlagEmbeddingReranker(
-                    top_n=self.rerank_size,
-                    model=self.rerank_model,
-                    use_fp16=False
-            )
-        return [reranker]
+        # the cross-encoder weights are shared, top_n is set per searcher
+        rerank_cache = None
+        if self.rerank_cache_path:
+            rerank_cache = RerankCache(self.rerank_cache_path, self.rerank_model, self.rerank_max_length, self.rerank_cache_max_entries)
+        reranker = BatchReranker(load_cross_encoder(self.rerank_model), self.rerank_size,
+                                 max_tokens_per_batch=self.rerank_max_tokens_per_batch, max_length=self.rerank_max_length, cache=rerank_cache)
+        # set when the candidates of a whole search batch are reranked together
+        self.batch_reranker = reranker if self.rerank_batching or self.rerank_cache_path else None
+        return [CrossEncoderReranker(reranker, top_n=self.rerank_size)]
+
+    def index_key(self, nodes):
+        """
+        Identifies a built index: the node set, the embedding model and what changes the embedded text.
+        """
+        if self._index_key is None:
+            self._index_key = self.compute_index_key(nodes)
+        return self._index_key
+
+    def compute_index_key(self, nodes):
+        return stable_hash({
+            "nodes": [[node.node_id, node.hash] for node in nodes],
+            "embed_model_name": self.embed_model_name,
+            "regenerate_emb": self.regenerate_emb,
+            "excluded_embed_metadata_keys": self.excluded_embed_metadata_keys,
+        })
+
+    def prune_stale_indexes(self, nodes):
+        """
+        Remove the persisted indexes of other node sets, e.g. of an earlier chunking, from the chunk
+        folder. Each index key has an index_key_<key>.json marker naming its node set, so indexes of
+        the same nodes under another embedding model or embedding options are kept.
+        """
+        key = self.index_key(nodes)[:16]
+        nodes_key = stable_hash([[node.node_id, node.hash] for node in nodes])
+        marker = os.path.join(self.input_folder, f"index_key_{key}.json")
+        if not os.path.exists(marker):
+            with atomic_write(marker) as tmp_path, open(tmp_path, 'w') as f:
+                json.dump({"nodes": nodes_key}, f)
+        stale = {}
+        for name in os.listdir(self.input_folder):
+            match = PERSISTED_INDEX_PATTERN.match(name)
+            if match is None or match.group(1) == key:
+                continue
+            other = match.group(1)
+            if other not in stale:
+                other_marker = os.path.join(self.input_folder, f"index_key_{other}.json")
+                try:
+                    stale[other] = json.load(open(other_marker)).get("nodes") != nodes_key
+                except (OSError, ValueError):
+                    # written before markers existed or without one, not of the current node set
+                    stale[other] = True
+            if stale[other]:
+                path = os.path.join(self.input_folder, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.exists(path):
+                    os.remove(path)
+                logging.info(f"Removed {path}, an index of another node set")
+
+    def load_embed_cache(self):
+        if not self.embed_cache_path:
+            return None
+        return EmbeddingCache(self.embed_cache_path, self.embed_model_name, self.embed_cache_max_entries)
+
+    def dense_index_path(self, nodes):
+        return os.path.join(self.input_folder, f"dense_index_{self.index_key(nodes)[:16]}.npy")
+
+    def load_dense_index(self, nodes, persist=None):
+        """
+        Contiguous normalized embedding matrix of the nodes, persisted next to the chunk output.
+        """
+        persist = self.persist_index if persist is None else persist
+        path = self.dense_index_path(nodes)
+        if persist and os.path.exists(path):
+            logging.info(f"Loading dense index from {path}")
+            return DenseIndex.load(path, block_size=self.dense_block_size)
+
+        matrix = None
+        present = np.zeros(len(nodes), dtype=bool)
+        if not self.regenerate_emb:
+            for offset, embeddings in self.embedding_blocks:
+                if matrix is None:
+                    matrix = np.empty((len(nodes), embeddings.shape[1]), dtype=np.float32)
+                matrix[offset:offset + len(embeddings)] = embeddings
+                present[offset:offset + len(embeddings)] = ~np.isnan(embeddings[:, 0])
+        missing = np.flatnonzero(~present)
+        if len(missing) > 0:
+            embed_cache = self.load_embed_cache()
+            texts = [nodes[idx].get_content(metadata_mode=MetadataMode.EMBED) for idx in missing]
+            embeddings = np.asarray(embed_texts(self.embed_model, texts, batch_size=self.embed_batch_size, cache=embed_cache), dtype=np.float32)
+            if matrix is None:
+                matrix = np.empty((len(nodes), embeddings.shape[1]), dtype=np.float32)
+            matrix[missing] = embeddings
+            if embed_cache is not None:
+                logging.info(f"Embedding cache: {embed_cache.stats()}")
+        index = DenseIndex(normalize_rows(matrix), block_size=self.dense_block_size)
+        if persist:
+            index.save(path)
+            logging.info(f"Persisted dense index to {path}")
+        return index
+
+    def process(self, input_folder: str, output_folder: str):
+        output_folder = super(SimpleHybridSearcher, self).process(input_folder, output_folder)
+        if self.batch_reranker is not None:
+            logging.info(f"Batched reranking: {self.batch_reranker.stats()}")
+        if self.shard_pool is not None:
+            logging.info(f"Search shard uss/pss/rss (MB): {format_memory(self.shard_pool.memory_mb())}")
+            self.shard_pool.close()
+            self.shard_pool = None
+        return output_folder
+
+    def retrieve_all(self, query_bundles):
+        if not self.search_pipeline:
+            yield from super(SimpleHybridSearcher, self).retrieve_all(query_bundles)
+            return
+        stage_fns = [
+            ("embed", self.embed_stage),
+            ("retrieve", lambda batch: list(zip(batch, self.retrieve_stage(batch)))),
+            ("rerank", lambda batch: self.rerank_batch([query_bundle for query_bundle, _ in batch], [nodes for _, nodes in batch])),
+        ]
+        stages = [PipelineStage(name, fn, **self.search_pipeline.get(name, {})) for name, fn in stage_fns]
+        pipeline = SearchPipeline(stages, queue_size=self.search_pipeline.get("queue_size", 1024))
+        yield from pipeline.iter_results(query_bundles)
+        pipeline.log_stats()
+
+    def retrieve_batch(self, query_bundles):
+        if self.retrieval_engine != "numpy" and self.batch_reranker is None:
+            return super(SimpleHybridSearcher, self).retrieve_batch(query_bundles)
+        return self.rerank_batch(query_bundles, self.retrieve_stage(self.embed_stage(query_bundles)))
+
+    def embed_stage(self, query_bundles):
+        """
+        Attach query embeddings in batches, unless only the sparse index is searched.
+        """
+        if self.use_sparse() and self.fusion != "rrf" and self.vector_ratio == 0:
+            return query_bundles
+        embeddings = embed_queries(self.embed_model, [query_bundle.query_str for query_bundle in query_bundles], self.embed_batch_size)
+        for query_bundle, embedding in zip(query_bundles, embeddings):
+            query_bundle.embedding = embedding.tolist()
+        return query_bundles
+
+    def retrieve_stage(self, query_bundles):
+        """
+        Candidates of each query before reranking.
+        """
+        if self.retrieval_engine != "numpy":
+            return self.retrieve_candidates(query_bundles)
+        query_embeddings = None
+        if query_bundles[0].embedding is not None:
+            query_embeddings = np.asarray([query_bundle.embedding for query_bundle in query_bundles], dtype=np.float32)
+        if self.use_sparse():
+            return self.retriever.retrieve_batch(query_embeddings, [query_bundle.query_str for query_bundle in query_bundles])
+        return self.retriever.retrieve_batch(query_embeddings)
+
+    def retrieve_candidates(self, query_bundles):
+        if self.thread_num > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.thread_num) as executor:
+                return list(executor.map(self.retriever.retrieve, query_bundles))
+        return [self.retriever.retrieve(query_bundle) for query_bundle in query_bundles]
+
+    def rerank_batch(self, query_bundles, candidates):
+        if self.batch_reranker is not None:
+            return self.batch_reranker.rerank(query_bundles, candidates)
+        def rerank(query_bundle, nodes):
+            for postprocessor in self.node_postprocessors:
+                nodes = postprocessor.postprocess_nodes(nodes, query_bundle=query_bundle)
+            return nodes
+        if self.thread_num > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.thread_num) as executor:
+                return list(executor.map(rerank, query_bundles, candidates))
+        return [rerank(query_bundle, nodes) for query_bundle, nodes in zip(query_bundles, candidates)]
 
     def load_retriever(self, nodes):
         """
         Load the retriever from the given folder.
         """
-        from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-        embed_model = HuggingFaceEmbedding(model_name=self.embed_model_name)
+        embed_model = self.embed_model
+        persist_dir = os.path.join(self.input_folder, f"vector_index_{self.index_key(nodes)[:16]}")
+        if self.persist_index and os.path.exists(persist_dir):
+            logging.info(f"Loading vector index from {persist_dir}")
+            storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
+            vector_index = load_index_from_storage(storage_context, embed_model=embed_model)
+            return vector_index.as_retriever(similarity_top_k=self.rerank_size)
+
         if self.regenerate_emb:
             new_nodes = []
             for node in nodes:
                 node.embedding = None
                 new_nodes.append(node)
             nodes = new_nodes
+        else:
+            self.attach_embeddings(nodes)
+        missing = [node for node in nodes if node.embedding is None]
+        if missing and self.embed_cache_path:
+            # embed here so the cache is consulted, VectorStoreIndex keeps existing embeddings
+            embed_cache = self.load_embed_cache()
+            texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in missing]
+            embeddings = embed_texts(embed_model, texts, batch_size=self.embed_batch_size, cache=embed_cache)
+            for node, embedding in zip(missing, embeddings):
+                node.embedding = embedding
+            logging.info(f"Embedding cache: {embed_cache.stats()}")
         vector_index = VectorStoreIndex(nodes, embed_model=embed_model, show_progress=self.show_progress, use_async=self.use_async, insert_batch_size=2048)
+        if self.persist_index:
+            with atomic_write(persist_dir) as tmp_dir:
+                vector_index.storage_context.persist(persist_dir=tmp_dir)
+            logging.info(f"Persisted vector index to {persist_dir}")
         vector_retriever = vector_index.as_retriever(similarity_top_k=self.rerank_size)
         return vector_retriever
 
@@ -0,0 +1,263 @@
+import re
+import logging
+from collections import Counter
+from typing import List
+
+import numpy as np
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+from utils import atomic_write
+
+# CJK characters are single tokens, product codes like "AB-12.5" are kept whole besides their parts
+TOKEN_PATTERN = re.compile(r"[\u4e00-\u9fff]|[^\W_\u4e00-\u9fff]+")
+COMPOUND_PATTERN = re.compile(r"[^\W_\u4e00-\u9fff]+(?:[-./_][^\W_\u4e00-\u9fff]+)+")
+
+
+def tokenize(text):
+    text = text.lower()
+    return TOKEN_PATTERN.findall(text) + COMPOUND_PATTERN.findall(text)
+
+
+class BM25Index:
+    """
+    Inverted index with BM25 weights precomputed per posting, stored as term-major CSR arrays
+    (indptr, doc_ids, weights), scored a block of queries at a time with array operations.
+
+    Rare terms are gathered into (query, doc) keys and summed with np.unique + np.bincount, the
+    contribution of frequent terms is then looked up for those candidates only. As in MaxScore,
+    a document matching frequent terms only can score at most the sum of their maximum weights;
+    the few queries whose k-th candidate falls below that bound are scored exhaustively.
+    """
+    def __init__(self, vocab, indptr, doc_ids, weights, num_docs, frequent_term_ratio=0.01,
+                 query_block_size=1024, max_block_cells=1 << 24):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.num_docs = num_docs
+        self.df = np.diff(indptr)
+        self.max_weights = np.maximum.reduceat(weights, indptr[:-1]) if len(weights) else np.zeros(0, dtype=np.float32)
+        # terms in more than this many documents are looked up rather than gathered
+        self.frequent_df = max(1, int(num_docs * frequent_term_ratio))
+        self.query_block_size = query_block_size
+        # bound on queries x documents of an exhaustively scored block
+        self.max_block_cells = max_block_cells
+
+    @classmethod
+    def build(cls, texts, k1=1.2, b=0.75, **kwargs):
+        vocab = {}
+        term_ids, doc_ids, tfs = [], [], []
+        doc_len = np.zeros(len(texts), dtype=np.float32)
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_len[doc_id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind='stable')
+        doc_ids = np.asarray(doc_ids, dtype=np.int32)[order]
+        tfs = np.asarray(tfs, dtype=np.float32)[order]
+        df = np.bincount(term_ids, minlength=len(vocab))
+        indptr = np.concatenate([[0], np.cumsum(df)]).astype(np.int64)
+
+        idf = np.log(1 + (len(texts) - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avg_len = max(float(doc_len.mean()), 1.0) if len(texts) else 1.0
+        norm = k1 * (1 - b + b * doc_len[doc_ids] / avg_len)
+        weights = np.repeat(idf, df) * tfs * (k1 + 1) / (tfs + norm)
+        return cls(vocab, indptr, doc_ids, weights.astype(np.float32), len(texts), **kwargs)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        data = np.load(path)
+        vocab = {term: idx for idx, term in enumerate(data["terms"].tolist())}
+        return cls(vocab, data["indptr"], data["doc_ids"], data["weights"], int(data["num_docs"]), **kwargs)
+
+    def save(self, path):
+        terms = np.asarray(sorted(self.vocab, key=self.vocab.get))
+        with atomic_write(path, suffix='.npz') as tmp_path:
+            np.savez(tmp_path, terms=terms, indptr=self.indptr, doc_ids=self.doc_ids, weights=self.weights, num_docs=self.num_docs)
+
+    def __len__(self):
+        return self.num_docs
+
+    def query_terms(self, query):
+        return sorted({self.vocab[token] for token in tokenize(query) if token in self.vocab})
+
+    def search(self, queries: List[str], top_k):
+        """
+        Returns (scores, indices), both (num_queries, top_k) and sorted by descending score,
+        padded with 0 / -1 when a query matches fewer than top_k documents.
+        """
+        all_scores = np.zeros((len(queries), top_k), dtype=np.float32)
+        all_indices = np.full((len(queries), top_k), -1, dtype=np.int64)
+        if self.num_docs == 0:
+            return all_scores, all_indices
+        terms = [np.asarray(self.query_terms(query), dtype=np.int64) for query in queries]
+        for start in range(0, len(queries), self.query_block_size):
+            end = min(start + self.query_block_size, len(queries))
+            self.search_block(terms[start:end], top_k, all_scores[start:end], all_indices[start:end])
+        return all_scores, all_indices
+
+    def search_block(self, terms, top_k, out_scores, out_indices):
+        frequent = [query_terms[self.df[query_terms] > self.frequent_df] for query_terms in terms]
+        rare = [query_terms[self.df[query_terms] <= self.frequent_df] for query_terms in terms]
+        query_ids, doc_ids, scores = self.score_candidates(rare, frequent)
+        self.top_k_candidates(query_ids, doc_ids, scores, top_k, out_scores, out_indices)
+
+        bound = np.asarray([self.max_weights[query_terms].sum() for query_terms in frequent], dtype=np.float32)
+        unresolved = np.flatnonzero((bound > 0) & (out_scores[:, -1] < bound))
+        if len(unresolved) > 0:
+            block_scores = np.zeros((len(unresolved), top_k), dtype=np.float32)
+            block_indices = np.full((len(unresolved), top_k), -1, dtype=np.int64)
+            block_size = max(1, self.max_block_cells // self.num_docs)
+            for start in range(0, len(unresolved), block_size):
+                rows = slice(start, start + block_size)
+                self.top_k_dense([terms[row] for row in unresolved[rows]], top_k, block_scores[rows], block_indices[rows])
+            out_scores[unresolved], out_indices[unresolved] = block_scores, block_indices
+
+    def score_candidates(self, rare, frequent):
+        """
+        Exact scores of the (query, doc) pairs where doc contains one of the query's rare terms.
+        """
+        flat_terms = np.concatenate(rare)
+        lengths = self.df[flat_terms]
+        query_of_term = np.repeat(np.arange(len(rare)), [len(query_terms) for query_terms in rare])
+        # positions of every posting of every term, without a python loop over terms
+        offsets = np.repeat(self.indptr[flat_terms] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        keys = np.repeat(query_of_term, lengths) * self.num_docs + self.doc_ids[offsets]
+        keys, inverse = np.unique(keys, return_inverse=True)
+        scores = np.bincount(inverse, weights=self.weights[offsets], minlength=len(keys)).astype(np.float32)
+        query_ids, doc_ids = keys // self.num_docs, keys % self.num_docs
+
+        flat_frequent = np.concatenate(frequent)
+        if len(keys) > 0 and len(flat_frequent) > 0:
+            query_of_frequent = np.repeat(np.arange(len(frequent)), [len(query_terms) for query_terms in frequent])
+            for term in np.unique(flat_frequent):
+                has_term = np.zeros(len(frequent), dtype=bool)
+                has_term[query_of_frequent[flat_frequent == term]] = True
+                pairs = np.flatnonzero(has_term[query_ids])
+                # doc ids are sorted within a posting list
+                postings = self.doc_ids[self.indptr[term]:self.indptr[term + 1]]
+                positions = np.minimum(np.searchsorted(postings, doc_ids[pairs]), len(postings) - 1)
+                found = postings[positions] == doc_ids[pairs]
+                scores[pairs[found]] += self.weights[self.indptr[term] + positions[found]]
+        return query_ids, doc_ids, scores
+
+    def top_k_candidates(self, query_ids, doc_ids, scores, top_k, out_scores, out_indices):
+        # sort by query, then by descending score, then keep the first top_k of each query
+        order = np.lexsort((doc_ids, -scores, query_ids))
+        query_ids, doc_ids, scores = query_ids[order], doc_ids[order], scores[order]
+        rank = np.arange(len(query_ids)) - np.searchsorted(query_ids, query_ids, side='left')
+        keep = rank < top_k
+        out_scores[query_ids[keep], rank[keep]] = scores[keep]
+        out_indices[query_ids[keep], rank[keep]] = doc_ids[keep]
+
+    def top_k_dense(self, terms, top_k, out_scores, out_indices):
+        """
+        Add every posting list into a (queries, docs) score matrix, then argpartition. A frequent
+        term is expanded to a dense row once and added to all its queries, a rare one is scattered
+        per query (the doc ids of one posting list are unique, so a fancy-indexed += is exact).
+        """
+        scores = np.zeros((len(terms), self.num_docs), dtype=np.float32)
+        rows = np.repeat(np.arange(len(terms)), [len(query_terms) for query_terms in terms])
+        flat_terms = np.concatenate(terms)
+        order = np.argsort(flat_terms, kind='stable')
+        unique_terms, starts = np.unique(flat_terms[order], return_index=True)
+        for term, term_rows in zip(unique_terms, np.split(rows[order], starts[1:])):
+            start, end = self.indptr[term], self.indptr[term + 1]
+            if len(term_rows) > 1 and end - start > self.frequent_df:
+                dense_row = np.zeros(self.num_docs, dtype=np.float32)
+                dense_row[self.doc_ids[start:end]] = self.weights[start:end]
+                scores[term_rows] += dense_row
+            else:
+                for row in term_rows:
+                    scores[row, self.doc_ids[start:end]] += self.weights[start:end]
+        k = min(top_k, self.num_docs)
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        part_scores = np.take_along_axis(scores, part, axis=1)
+        order = np.lexsort((part, -part_scores), axis=1)
+        part_scores = np.take_along_axis(part_scores, order, axis=1)
+        part = np.take_along_axis(part, order, axis=1)
+        # BM25 weights are positive, a zero score means the document did not match
+        out_scores[:, :k] = part_scores
+        out_indices[:, :k] = np.where(part_scores > 0, part, -1)
+
+
+def fuse_weighted(dense: List[NodeWithScore], sparse: List[NodeWithScore], vector_ratio, top_k):
+    """
+    vector_ratio * dense + (1 - vector_ratio) * sparse, each side min-max normalized over its candidates.
+    """
+    def normalized(results):
+        if not results:
+            return {}
+        scores = [result.score for result in results]
+        low, span = min(scores), max(scores) - min(scores)
+        return {result.node.node_id: (result.score - low) / span if span > 0 else 1.0 for result in results}
+
+    dense_scores, sparse_scores = normalized(dense), normalized(sparse)
+    nodes = {result.node.node_id: result.node for result in sparse + dense}
+    fused = {node_id: vector_ratio * dense_scores.get(node_id, 0.0) + (1 - vector_ratio) * sparse_scores.get(node_id, 0.0) for node_id in nodes}
+    ranked = sorted(fused.items(), key=lambda item: -item[1])[:top_k]
+    return [NodeWithScore(node=nodes[node_id], score=score) for node_id, score in ranked]
+
+
+def fuse_rrf(dense: List[NodeWithScore], sparse: List[NodeWithScore], top_k, rrf_k=60):
+    """
+    Reciprocal-rank fusion: sum of 1 / (rrf_k + rank) over the lists a node appears in.
+    """
+    fused, nodes = {}, {}
+    for results in (dense, sparse):
+        for rank, result in enumerate(results):
+            nodes[result.node.node_id] = result.node
+            fused[result.node.node_id] = fused.get(result.node.node_id, 0.0) + 1.0 / (rrf_k + rank + 1)
+    ranked = sorted(fused.items(), key=lambda item: -item[1])[:top_k]
+    return [NodeWithScore(node=nodes[node_id], score=score) for node_id, score in ranked]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Fuses a dense retriever with a BM25Index, by vector_ratio ("weighted") or by reciprocal rank ("rrf").
+    """
+    def __init__(self, dense_retriever, sparse_index: BM25Index, nodes, similarity_top_k, sparse_top_k=None,
+                 vector_ratio=0.5, fusion="weighted", rrf_k=60):
+        self._dense_retriever = dense_retriever
+        self._sparse_index = sparse_index
+        self._nodes = nodes
+        self._similarity_top_k = similarity_top_k
+        self._sparse_top_k = sparse_top_k or similarity_top_k
+        self._vector_ratio = vector_ratio
+        self._fusion = fusion
+        self._rrf_k = rrf_k
+        super().__init__()
+
+    def sparse_retrieve_batch(self, queries: List[str]) -> List[List[NodeWithScore]]:
+        scores, indices = self._sparse_index.search(queries, self._sparse_top_k)
+        return [[NodeWithScore(node=self._nodes[idx], score=float(score)) for score, idx in zip(row_scores, row_indices) if idx >= 0]
+                for row_scores, row_indices in zip(scores, indices)]
+
+    def fuse(self, dense, sparse):
+        if self._fusion == "rrf":
+            return fuse_rrf(dense, sparse, self._similarity_top_k, self._rrf_k)
+        return fuse_weighted(dense, sparse, self._vector_ratio, self._similarity_top_k)
+
+    def retrieve_batch(self, query_embeddings, queries: List[str]) -> List[List[NodeWithScore]]:
+        """
+        Batched retrieval, the dense retriever must provide retrieve_batch(query_embeddings).
+        """
+        if self._fusion != "rrf" and self._vector_ratio == 0:
+            dense = [[] for _ in queries]
+        else:
+            dense = self._dense_retriever.retrieve_batch(query_embeddings)
+        sparse = self.sparse_retrieve_batch(queries)
+        return [self.fuse(dense_results, sparse_results) for dense_results, sparse_results in zip(dense, sparse)]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if self._fusion != "rrf" and self._vector_ratio == 0:
+            dense = []
+        else:
+            dense = self._dense_retriever.retrieve(query_bundle)
+        sparse = self.sparse_retrieve_batch([query_bundle.query_str])[0]
+        return self.fuse(dense, sparse)
@@ -0,0 +1,128 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+
+# eviction makes room for this fraction of max_entries new keys at once
+EVICT_TO = 0.9
+# the table is counted again after this fraction of max_entries puts, so writes of other processes are seen
+RECOUNT_EVERY = 0.1
+
+
+class SQLiteCache:
+    """
+    Persistent key -> bytes store in one SQLite table with hit/miss counters and
+    least-recently-used eviction once more than max_entries keys are stored, down to
+    EVICT_TO of max_entries. The table is counted again after RECOUNT_EVERY of max_entries puts,
+    so N processes sharing the file exceed max_entries by at most N times that many keys.
+    With ttl (seconds) set, entries written longer ago than ttl are misses and are dropped on the next put.
+    Safe to share between threads; several processes may open the same file.
+    """
+    def __init__(self, path, table, max_entries=None, ttl=None):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # rows in the table as of the last count, advanced by our own puts since; replaced keys make
+        # it a recount early, writes of other processes are seen at the next recount
+        self.count = None
+        self.puts_since_count = 0
+        self.lock = threading.Lock()
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value BLOB, last_used REAL, created REAL)")
+        # tables written before entries had a creation time, their entries age from their last use
+        if 'created' not in [row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")]:
+            self.conn.execute(f"ALTER TABLE {table} ADD COLUMN created REAL")
+            self.conn.execute(f"UPDATE {table} SET created = last_used")
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_last_used ON {table} (last_used)")
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_created ON {table} (created)")
+        self.conn.commit()
+
+    def get_many(self, keys, batch_size=500):
+        """
+        Return {key: value} for the keys found, refreshing their recency.
+        """
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        expiry = self.expiry()
+        with self.lock:
+            for start in range(0, len(keys), batch_size):
+                batch = keys[start:start + batch_size]
+                placeholders = ','.join('?' * len(batch))
+                rows = self.conn.execute(f"SELECT key, value FROM {self.table} WHERE key IN ({placeholders}) "
+                                         f"AND created >= ?", batch + [expiry]).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self.conn.executemany(f"UPDATE {self.table} SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+                self.conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items):
+        if not items:
+            return
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(f"INSERT OR REPLACE INTO {self.table} (key, value, last_used, created) VALUES (?, ?, ?, ?)",
+                                  [(key, value, now, now) for key, value in items.items()])
+            self.conn.commit()
+            if self.count is not None:
+                self.count += len(items)
+            self.puts_since_count += len(items)
+            self.evict()
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def expiry(self):
+        """
+        Creation time before which entries have expired, -inf without a ttl.
+        """
+        return time.time() - self.ttl if self.ttl else float('-inf')
+
+    def evict(self):
+        if self.ttl:
+            expired = self.conn.execute(f"DELETE FROM {self.table} WHERE created < ?", (self.expiry(),)).rowcount
+            self.conn.commit()
+            if expired:
+                if self.count is not None:
+                    self.count -= expired
+                logging.info(f"Dropped {expired} expired entries from {self.path}:{self.table}")
+        if not self.max_entries:
+            return
+        if self.count is None or self.count > self.max_entries or self.puts_since_count >= self.max_entries * RECOUNT_EVERY:
+            self.count = self.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            self.puts_since_count = 0
+        if self.count <= self.max_entries:
+            return
+        excess = self.count - int(self.max_entries * EVICT_TO)
+        self.conn.execute(f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} ORDER BY last_used LIMIT ?)",
+                          (excess,))
+        self.conn.commit()
+        self.count -= excess
+        logging.info(f"Evicted {excess} least recently used entries from {self.path}:{self.table}")
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return f"{self.hits} hits, {self.misses} misses ({self.hit_rate() * 100:.1f}% hit rate)"
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -1,14 +1,107 @@
 import os
+import json
+import uuid
+import shutil
+import asyncio
+import threading
+import hashlib
+import logging
+import functools
+import contextlib
 
 from llama_index.core import Settings
 from llms.SetLLM import SetLLM
 
-def set_llm(base_llm='gpt-3.5-turbo-0301'):
-        Settings.llm = SetLLM(model=base_llm)
+def set_llm(base_llm='gpt-3.5-turbo-0301', **llm_config):
+        """
+        llm_config: further SetLLM fields, e.g. api_base, rpm_limit, tpm_limit, max_concurrency.
+        """
+        Settings.llm = SetLLM(model=base_llm, **llm_config)
         Settings.context_window = Settings.llm.max_tokens + Settings.llm.max_input_tokens
         Settings.num_output = Settings.llm.max_tokens
 
 
+def log_llm_stats():
+    """
+    Log the async client and completion cache stats of Settings.llm.
+    """
+    # _llm, since reading Settings.llm would resolve a default llm when none was set
+    llm = Settings._llm
+    if isinstance(llm, SetLLM):
+        logging.info(f"LLM client stats: {llm.client_stats()}")
+
+
+def run_async(coro):
+    """
+    asyncio.run(coro), then close the connections of the async client of Settings.llm.
+    """
+    async def main():
+        try:
+            return await coro
+        finally:
+            if isinstance(Settings._llm, SetLLM):
+                await Settings._llm.aclose()
+    return asyncio.run(main())
+
+
+def stable_hash(obj):
+    """
+    sha256 of the canonical json encoding of obj, stable across runs and key order.
+    """
+    payload = json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def fork_is_safe(purpose):
+    """
+    Whether this process may fork workers for purpose: no other python thread runs in it. A child
+    forked while another thread holds a lock (logging, the stage threads of a PipelineScheduler
+    with max_parallel_stages > 1, torch/OpenMP pools they started) can deadlock on it; callers
+    fall back to running in process and this logs that.
+    """
+    if threading.active_count() == 1:
+        return True
+    logging.warning(f"{threading.active_count()} threads are running, {purpose} runs in this process instead of forked workers")
+    return False
+
+
+@contextlib.contextmanager
+def atomic_write(path, suffix=''):
+    """
+    Yield a temporary path of its own next to path, ending in suffix for writers that append an
+    extension (np.save, np.savez), and move what was written there to path once the block exits.
+    Readers never see a partial path, concurrent writers never write the same file, and a block
+    that raises leaves no temporary file behind. A directory is not moved over one that exists
+    meanwhile, e.g. persisted by another process; the temporary one is removed instead.
+    """
+    tmp_path = f"{path}.tmp{uuid.uuid4().hex}{suffix}"
+    try:
+        yield tmp_path
+        if not os.path.isdir(tmp_path):
+            os.replace(tmp_path, path)
+        elif not os.path.exists(path):
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                if not os.path.exists(path):
+                    raise
+    finally:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+@functools.lru_cache(maxsize=None)
+def load_embed_model(model_name):
+    """
+    HuggingFace embedding model shared by every operator of the process, so stages
+    of a sweep that use the same model load it once.
+    """
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+    return HuggingFaceEmbedding(model_name=model_name)
+
+
 # Importing module and class dynamically
 def import_class(module_path, class_name):
     module = __import__(module_path, fromlist=[class_name])